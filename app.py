@@ -1,12 +1,14 @@
 from flask import Flask, jsonify, request
+import hmac
 import json
 from flask_cors import CORS
 from utils.question_parser import question_chooser
 from utils.team_log import team_log_get_answer
 from utils.player_log import player_log_get_answer
 from utils.playbyplay import play_by_play_get_answer
-from utils.executor import execute_query, extract_sql_query
+from utils.executor import execute_query, extract_sql_query, cancel_queries, repair_stats, explain_stats, ResultTooLarge, RESULT_TOKEN_BUDGET, RESULT_ROW_BUDGET
 from utils.answer_parser import get_answer
+from utils.answer_parser import static_input_tokens as answer_static_tokens
 from flask_socketio import SocketIO
 from flask_socketio import send, emit
 from utils.player_and_team import player_and_team_log_get_answer
@@ -15,7 +17,26 @@ from utils.teamlogandprops import team_log_and_props_get_answer
 from utils.props import props_log_get_answer
 from utils.perplexity import ask_expert
 from utils.futures import futures_log_get_answer
-from utils.CountUtil import count_tokens
+from utils.CountUtil import count_tokens, estimate_cost
+from utils.db_pool import PoolTimeout, pool_stats
+from utils.eventlet_db import eventlet_db_stats, patch_for_eventlet
+from utils.result_cache import result_cache_stats
+from utils.embedding_cache import embedding_cache_stats
+from utils.vector_index import vector_index_stats
+from utils.llm_clients import warm_clients
+from utils.llm_resilience import llm_resilience_stats
+from utils.cache import get_closest_match, get_embedding, start_example_index
+from utils.prompt_layout import prompt_layout_stats
+from utils.sql_stream import cancel_generation, sql_stream_stats
+from utils.response_cache import get_cached_response, store_response, replay_chunks, response_cache_stats
+from utils.model_tiers import answer_tier, can_escalate, record_escalation, record_request, sql_escalation, stage_call, model_tier_stats
+from utils.sql_candidates import SQL_CANDIDATES, run_candidates, cancel_candidates, sql_candidates_stats
+from utils.schema_pruning import record_schema_outcome, schema_pruning_stats
+from utils.pre_router import pre_route, pre_router_stats
+from utils.bucket_classifier import classifier_ready, classify_question, bucket_classifier_stats
+from utils.sql_reuse import SQL_REUSE_MODE, reuse_sql, record_execution, record_shadow, is_plausible, sql_reuse_stats
+from utils.team_games import refresh_team_games, register_team_games_columns
+from utils.data_version import bump_data_version, get_data_version
 from flask import request
 import tiktoken
 from supabase import create_client, Client
@@ -40,6 +61,14 @@ supabase: Client = create_client(supabase_url, supabase_key)
 
 
 socketio = SocketIO(app, cors_allowed_origins='*')
+# Keeps running queries from blocking the eventlet hub, so disconnects can cancel them
+patch_for_eventlet()
+
+# Few-shot examples are served from a local mirror of the Pinecone index
+start_example_index()
+warm_clients()
+# The validator's teamgames columns come from the view itself, not a copy of teamlog's
+register_team_games_columns()
 
 global_bucket = None
 
@@ -80,7 +109,8 @@ def process_expert_analysis(question):
     return ''
 
 
-def process_database_query(bucket, question):
+def process_database_query(bucket, question, embedding=None, answer_usage=None, pipeline=None):
+    # If a pipeline dict is passed, it gets the query and result the answer is based on
     bucket_to_function = {
         'TeamGameLog': team_log_get_answer,
         'PlayerGameLog': player_log_get_answer,
@@ -98,25 +128,108 @@ def process_database_query(bucket, question):
     
 
 
-    raw_query, sql_input_tokens, sql_output_tokens = get_answer_func('openai', question)
-    if 'error' in raw_query.lower() or 'cannot' in raw_query.lower():
-        return process_expert_analysis(question)
+    if embedding is None:
+        embedding = get_embedding(question)
+
+    matched_question, matched_sql_query, score = get_closest_match(question, embedding=embedding)
+    reused_query = reuse_sql(question, matched_question, matched_sql_query, score)
+    # The bucket's prompt uses the same example, so it doesn't have to look it up again
+    match = (matched_question, matched_sql_query)
 
-    query = extract_sql_query(raw_query)
-    emit('billy', {'response': query, 'type': 'query', 'status': 'generating'})
-    result = execute_query(query)
+    result = None
+    sql_tier = 0
+    if reused_query and SQL_REUSE_MODE == 'on':
+        query = reused_query
+        raw_query = f"```sql\n{query}\n```"
+        sql_input_tokens = sql_output_tokens = 0
+        emit('billy', {'response': query, 'type': 'query', 'status': 'generating'})
+        try:
+            result = execute_query(query, max_tokens=RESULT_TOKEN_BUDGET, max_rows=RESULT_ROW_BUDGET,
+                                   bucket=bucket, owner=request.sid)
+        except ResultTooLarge as e:
+            print(f"Result too large: {e}")
+            return process_expert_analysis(question)
+        record_execution(result)
+        if not is_plausible(result):
+            print("Reused SQL came back empty, generating a new query")
+            result = None
+
+    if result is None and SQL_CANDIDATES > 1:
+        # Several queries generated and run at once; the first one with rows is used
+        try:
+            raw_query, query, result, sql_input_tokens, sql_output_tokens, sql_tier = run_candidates(
+                get_answer_func, bucket, question, embedding=embedding, match=match, owner=request.sid,
+                max_tokens=RESULT_TOKEN_BUDGET, max_rows=RESULT_ROW_BUDGET)
+        except ResultTooLarge as e:
+            print(f"Result too large: {e}")
+            return process_expert_analysis(question)
+        # Each candidate's schema outcome is recorded as it finishes
+        if query is None:
+            return process_expert_analysis(question)
+        if reused_query and SQL_REUSE_MODE == 'shadow':
+            record_shadow(reused_query, result, bucket)
+        emit('billy', {'response': query, 'type': 'query', 'status': 'generating'})
+
+    elif result is None:
+        # Starts on the cheap model when tiering is on, and regenerates on the strong one
+        # if the cheap query can't be used or doesn't run
+        record_request('sql')
+        sql_input_tokens = sql_output_tokens = 0
+        while True:
+            with stage_call('sql', sql_tier):
+                raw_query, input_tokens, output_tokens = get_answer_func('openai', question, embedding=embedding, match=match,
+                                                                         tier=sql_tier, owner=request.sid)
+            sql_input_tokens += input_tokens
+            sql_output_tokens += output_tokens
+
+            query = extract_sql_query(raw_query)
+            escalate = can_escalate('sql', sql_tier)
+            reason = sql_escalation(raw_query, query, bucket) if escalate else None
+            if reason is None:
+                if 'error' in raw_query.lower() or 'cannot' in raw_query.lower():
+                    record_schema_outcome(bucket, question, False, owner=request.sid)
+                    return process_expert_analysis(question)
+
+                emit('billy', {'response': query, 'type': 'query', 'status': 'generating'})
+                try:
+                    result = execute_query(query, max_tokens=RESULT_TOKEN_BUDGET, max_rows=RESULT_ROW_BUDGET,
+                                           bucket=bucket, owner=request.sid)
+                except ResultTooLarge as e:
+                    print(f"Result too large: {e}")
+                    record_schema_outcome(bucket, question, True, owner=request.sid)
+                    return process_expert_analysis(question)
+                # Not a list means the repair loop gave up on the query
+                if escalate and not isinstance(result, list):
+                    reason = 'execution_error'
+
+            if reason is None:
+                break
+            record_escalation('sql', reason)
+            sql_tier += 1
+
+        if reused_query and SQL_REUSE_MODE == 'shadow':
+            record_shadow(reused_query, result, bucket)
+        record_schema_outcome(bucket, question, is_plausible(result), owner=request.sid)
     print(f"Result: {result}")
 
-    tokens = count_tokens(str(result))
-    if tokens > 5000:
-        return process_expert_analysis(question)
-    
-    answer_input_tokens = count_tokens(question) + count_tokens(raw_query) + count_tokens(str(result)) + 700
+    # Estimate only; replaced by the provider's count once the answer has streamed
+    result_tokens = count_tokens(str(result))
+    answer_input_tokens = answer_static_tokens + count_tokens(question) + count_tokens(query or "") + result_tokens
 
     print("running up to get_answer")
 
-    
-    return get_answer('openai', question, query, result), sql_input_tokens, sql_output_tokens, answer_input_tokens, raw_query
+    tier = answer_tier(result_tokens, sql_escalated=sql_tier > 0)
+    if pipeline is not None:
+        pipeline.update(query=query, result=result)
+    return get_answer('openai', question, query, result, usage=answer_usage, tier=tier), sql_input_tokens, sql_output_tokens, answer_input_tokens, raw_query
+
+
+@socketio.on('disconnect')
+def on_disconnect():
+    # Nobody is listening for the answer anymore, so stop any query still running for this client
+    cancelled = cancel_generation(request.sid) + cancel_queries(request.sid) + cancel_candidates(request.sid)
+    if cancelled:
+        print(f"Cancelled {cancelled} running queries for {request.sid}")
 
 
 @socketio.on('billy')
@@ -134,7 +247,41 @@ def chat(data):
     print(f"IP: {ip}")
     print(f"Session: {session}")
 
-    bucket, question, question_chooser_input_count, question_chooser_output_count = question_chooser('openai', message)
+    routed = pre_route(message)
+    if routed:
+        bucket, response = routed
+        print(f"Pre-routed: {bucket}")
+        emit('billy', {'response': response,
+             'type': 'answer', 'status': 'done'})
+        return
+
+    cached = get_cached_response(message)
+    if cached:
+        print(f"Response cache hit: {cached['bucket']}")
+        emit('billy', {'response': cached['query'], 'type': 'query', 'status': 'generating'})
+        for answer_string in replay_chunks(cached['answer']):
+            emit('billy', {'response': answer_string, 'type': 'answer',
+                'status': 'generating', 'bucket': cached['bucket']})
+        emit('billy', {'response': cached['answer'],
+            'type': 'answer', 'status': 'done'})
+        return cached['answer']
+
+    # Only embedded here when the classifier can use it; otherwise retrieval embeds the routed question
+    embedding = None
+    if classifier_ready(message):
+        try:
+            embedding = get_embedding(message)
+        except Exception as e:
+            print(f"Could not embed the message, using the router: {e}")
+    bucket, confidence = classify_question(message, embedding)
+    if bucket:
+        # Confident enough to skip the GPT-4 router. The question is used as typed, which is why
+        # messages the router would rewrite (relative dates, pronouns) never get a bucket here
+        question = message
+        question_chooser_input_count = question_chooser_output_count = 0
+        print(f"Classifier confidence: {confidence:.2f}")
+    else:
+        bucket, question, question_chooser_input_count, question_chooser_output_count = question_chooser('openai', message)
     print(f"Bucket: {bucket}")
     print(f"Question: {question}")
 
@@ -158,7 +305,11 @@ def chat(data):
     
     try:
 
-        answer_generator, input_sql_tokens, output_sql_tokens, answer_input_tokens, raw_sql_query = process_database_query(bucket, question)
+        answer_usage = {}
+        pipeline = {}
+        answer_generator, input_sql_tokens, output_sql_tokens, answer_input_tokens, raw_sql_query = process_database_query(
+            bucket, question, embedding=embedding if question == message else None, answer_usage=answer_usage,
+            pipeline=pipeline)
         answer_string = ''
         for next_answer in answer_generator:
             answer_string += next_answer
@@ -169,21 +320,25 @@ def chat(data):
         emit('billy', {'response': answer_string,
             'type': 'answer', 'status': 'done'})
         
+        if answer_usage:
+            answer_input_tokens = answer_usage['input_tokens']
+            answer_output_tokens = answer_usage['output_tokens']
+        else:
+            answer_output_tokens = count_tokens(answer_string)
+
         #store_query()
         print(f"Input SQL Tokens: {input_sql_tokens}")
         print(f"Output SQL Tokens: {output_sql_tokens}")
         print(f"Question Chooser Input Tokens: {question_chooser_input_count}")
         print(f"Question Chooser Output Tokens: {question_chooser_output_count}")
         print(f"Answer Input Tokens: {answer_input_tokens}")
+        print(f"Answer Output Tokens: {answer_output_tokens}")
 
-        answer_output_tokens = count_tokens(answer_string)
-
-        #cost is sum(inputs) * (3.50/1,000,000) + sum(outputs) * (15/1,000,000)
+        cost = estimate_cost(question_chooser_input_count + input_sql_tokens + answer_input_tokens,
+                             question_chooser_output_count + output_sql_tokens + answer_output_tokens)
 
+        store_response(message, bucket, question, pipeline.get('query'), pipeline.get('result'), answer_string, cost)
 
-
-        cost = (question_chooser_input_count + input_sql_tokens + answer_input_tokens) * (3.50/1000000) + (question_chooser_output_count + output_sql_tokens + answer_output_tokens) * (15/1000000)
-        
         #TODO: Store the chat in the db with 
         supabase.table('billy_answers').insert({
             'question': question,
@@ -203,6 +358,14 @@ def chat(data):
 
     
         return answer_string
+    except PoolTimeout as e:
+        print(f"Database busy: {e}")
+        emit('billy', {
+            'response': "I'm getting a lot of questions right now. Please try again in a moment.",
+            'type': 'answer',
+            'status': 'done'
+        })
+        return
     except Exception as e:
         emit('billy', {
             'response': "I'm sorry, an error occurred while processing your request. Please try again.",
@@ -213,6 +376,57 @@ def chat(data):
         return 
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'db_pool': pool_stats(),
+        'eventlet_db': eventlet_db_stats(),
+        'result_cache': result_cache_stats(),
+        'response_cache': response_cache_stats(),
+        'embedding_cache': embedding_cache_stats(),
+        'vector_index': vector_index_stats(),
+        'sql_reuse': sql_reuse_stats(),
+        'bucket_classifier': bucket_classifier_stats(),
+        'pre_router': pre_router_stats(),
+        'prompt_layout': prompt_layout_stats(),
+        'schema_pruning': schema_pruning_stats(),
+        'sql_stream': sql_stream_stats(),
+        'sql_candidates': sql_candidates_stats(),
+        'model_tiers': model_tier_stats(),
+        'llm_resilience': llm_resilience_stats(),
+        'sql_repair': repair_stats(),
+        'explain_gate': explain_stats(),
+    }), 200
+
+
+@app.route('/data-version', methods=['GET', 'POST'])
+def data_version():
+    # Called by the ingestion job after new weeks are loaded
+    if request.method == 'GET':
+        return jsonify({'data_version': get_data_version()}), 200
+
+    # Refreshing teamgames and dropping the caches is expensive, so this fails closed
+    token = os.environ.get('DATA_VERSION_TOKEN')
+    if not token:
+        return jsonify({'error': 'DATA_VERSION_TOKEN is not configured'}), 503
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied.encode('utf-8'), f'Bearer {token}'.encode('utf-8')):
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    data = request.get_json(silent=True) or {}
+
+    # Rebuild the derived tables before anything can cache results computed from them
+    if data.get('refresh', True):
+        try:
+            refresh_team_games()
+        except Exception as e:
+            print(f'Error refreshing teamgames: {e}')
+            return jsonify({'error': 'Could not refresh teamgames'}), 500
+
+    version = bump_data_version(data.get('version'))
+    return jsonify({'data_version': version}), 200
+
+
 @app.route('/store-query', methods=['POST'])
 def store_query():
     data = request.get_json()
@@ -0,0 +1,31 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.getenv('DATABASE_URL'), reason='needs a Postgres DATABASE_URL')
+
+
+def test_cancel_query_mid_flight():
+    from utils.executor import QueryCancelled, cancel_queries, execute_query
+
+    outcome = {}
+
+    def run():
+        start = time.monotonic()
+        try:
+            execute_query('SELECT pg_sleep(10)', owner='test-cancel')
+        except QueryCancelled:
+            outcome['cancelled'] = True
+        outcome['seconds'] = time.monotonic() - start
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(1)
+    assert cancel_queries('test-cancel') == 1
+    thread.join(5)
+
+    assert outcome.get('cancelled')
+    assert outcome['seconds'] < 5
+
@@ -0,0 +1,42 @@
+import psycopg2
+import pytest
+
+from utils import db_pool
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    replica = db_pool.Replica('test', 'postgresql://localhost/test')
+    monkeypatch.setattr(db_pool, '_replicas', [replica])
+    monkeypatch.setattr(db_pool, 'DB_POOL_TIMEOUT', 0.01)
+    return replica
+
+
+def test_pool_timeout_does_not_eject(replica):
+    for _ in range(db_pool.DB_POOL_MAX):
+        replica.slots.acquire()
+
+    for _ in range(db_pool.REPLICA_MAX_FAILURES + 1):
+        with pytest.raises(db_pool.PoolTimeout):
+            with db_pool.get_connection():
+                pass
+
+    assert replica.stats['timeouts'] == db_pool.REPLICA_MAX_FAILURES + 1
+    assert replica.consecutive_failures == 0
+    assert replica.stats['ejections'] == 0
+    assert replica.outstanding == 0
+
+
+def test_connection_errors_eject(replica):
+    for _ in range(db_pool.REPLICA_MAX_FAILURES):
+        db_pool.choose_replica()
+        db_pool.replica_finished(replica, not db_pool.is_connection_failure(psycopg2.OperationalError('gone')))
+
+    assert replica.stats['ejections'] == 1
+    assert not replica.is_available(0)
+
+
+def test_is_connection_failure():
+    assert db_pool.is_connection_failure(psycopg2.InterfaceError('closed'))
+    assert not db_pool.is_connection_failure(db_pool.PoolTimeout('busy'))
+    assert not db_pool.is_connection_failure(psycopg2.errors.QueryCanceled('timeout'))
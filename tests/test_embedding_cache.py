@@ -0,0 +1,41 @@
+import pytest
+
+from utils import embedding_cache
+
+
+@pytest.fixture(autouse=True)
+def memory_only(monkeypatch):
+    monkeypatch.setattr(embedding_cache, 'EMBEDDING_CACHE_PATH', '')
+    monkeypatch.setattr(embedding_cache, '_db', None)
+    embedding_cache._memory.clear()
+
+
+def test_api_gets_text_as_typed():
+    sent = []
+
+    def embed(texts):
+        sent.extend(texts)
+        return [[1.0, 0.0] for _ in texts]
+
+    embedding_cache.cached_embeddings(['How many yards does Saquon Barkley have?  Thanks!'], 'model', embed)
+
+    assert sent == ['How many yards does Saquon Barkley have?  Thanks!']
+
+
+def test_variants_share_one_api_call():
+    calls = []
+
+    def embed(texts):
+        calls.append(list(texts))
+        return [[float(i), 1.0] for i in range(len(texts))]
+
+    vectors = embedding_cache.cached_embeddings(
+        ['How many yards does Saquon have?', 'how many yards does saquon have', 'Who won?'], 'model', embed)
+
+    assert calls == [['How many yards does Saquon have?', 'Who won?']]
+    assert vectors[0] == vectors[1]
+    assert vectors[2] != vectors[0]
+
+    # Served from the cache the second time
+    assert embedding_cache.cached_embeddings(['HOW MANY YARDS DOES SAQUON HAVE'], 'model', embed) == [vectors[0]]
+    assert len(calls) == 1
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from utils import cache, embedding_cache, vector_index
+from utils.cache import get_closest_embedding, get_closest_match, get_embedding
+from utils.vector_index import set_index
+
+
+QUESTION = 'How many rushing yards did Saquon Barkley have in 2023?'
+EMBEDDING = [0.0, 1.0, 0.0]
+
+
+@pytest.fixture(autouse=True)
+def local_index(monkeypatch):
+    monkeypatch.setattr(embedding_cache, 'EMBEDDING_CACHE_PATH', '')
+    monkeypatch.setattr(embedding_cache, '_db', None)
+    embedding_cache._memory.clear()
+    monkeypatch.setattr(vector_index, '_index', ([], np.zeros((0, 0), dtype=np.float32), []))
+    set_index(['a', 'b'], [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
+              [{'question': 'How many passing yards did Josh Allen have?', 'sql_query': 'SELECT 1;'},
+               {'question': 'How many rushing yards did Derrick Henry have?', 'sql_query': 'SELECT 2;'}], 'test')
+
+
+@pytest.fixture
+def embed_calls(monkeypatch):
+    calls = []
+
+    def embed(texts, model):
+        calls.append(list(texts))
+        return [EMBEDDING for _ in texts]
+
+    monkeypatch.setattr(cache, '_embed', embed)
+    return calls
+
+
+def test_passed_embedding_is_not_recomputed(embed_calls):
+    matched_question, matched_sql_query, score = get_closest_match(QUESTION, embedding=EMBEDDING)
+
+    assert embed_calls == []
+    assert matched_sql_query == 'SELECT 2;'
+    assert score == pytest.approx(1.0)
+    assert get_closest_embedding(QUESTION, embedding=EMBEDDING) == (matched_question, matched_sql_query)
+    assert embed_calls == []
+
+
+def test_one_api_call_per_question(embed_calls):
+    # The classifier's embedding and retrieval's lookup of the same message share one call
+    embedding = get_embedding(QUESTION)
+    get_closest_match(QUESTION)
+    get_closest_match(QUESTION, embedding=embedding)
+
+    assert embed_calls == [[QUESTION]]
+
+
+def test_clients_are_not_created_on_import():
+    # Importing cache must not need credentials or the network
+    assert cache._client.cache_info().currsize == 0
+    assert cache._index.cache_info().currsize == 0
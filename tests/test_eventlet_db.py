@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from utils import eventlet_db
+
+needs_database = pytest.mark.skipif(not os.getenv('DATABASE_URL'), reason='needs a Postgres DATABASE_URL')
+
+
+def test_not_patched_outside_eventlet():
+    assert eventlet_db.patch_for_eventlet() is False
+    assert eventlet_db.eventlet_db_stats() == {'patched': False}
+
+
+# The way production runs it: a query in a green thread under eventlet, cancelled from another one
+EVENTLET_SCRIPT = '''
+import eventlet
+eventlet.monkey_patch()
+import time
+from utils.eventlet_db import patch_for_eventlet
+assert patch_for_eventlet()
+from utils.executor import QueryCancelled, cancel_queries, execute_query
+
+def run():
+    try:
+        execute_query('SELECT pg_sleep(10)', owner='test-cancel')
+    except QueryCancelled:
+        return 'cancelled'
+
+start = time.monotonic()
+query = eventlet.spawn(run)
+eventlet.sleep(1)
+cancelled = cancel_queries('test-cancel')
+print(query.wait(), cancelled, round(time.monotonic() - start))
+'''
+
+
+@needs_database
+def test_cancel_query_under_eventlet():
+    pytest.importorskip('eventlet')
+    pytest.importorskip('psycogreen')
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', EVENTLET_SCRIPT], cwd=root, capture_output=True,
+                            text=True, timeout=30)
+
+    assert result.returncode == 0, result.stderr
+    status, cancelled, seconds = result.stdout.split()[-3:]
+    assert status == 'cancelled'
+    assert cancelled == '1'
+    assert int(seconds) < 5
@@ -0,0 +1,59 @@
+import pytest
+
+from utils import executor
+from utils.executor import ResultTooLarge, fetch_bounded
+
+
+class Cursor:
+    # Hands out rows in batches the way a named psycopg2 cursor does
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetched = 0
+
+    def fetchmany(self, size):
+        batch = self.rows[self.fetched:self.fetched + size]
+        self.fetched += len(batch)
+        return batch
+
+
+ROWS = [(f'Player {i}', i * 10) for i in range(25)]
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(executor, 'FETCH_BATCH_SIZE', 10)
+    monkeypatch.setattr(executor, 'count_tokens', len)
+
+
+def test_fetches_everything_within_budget():
+    assert fetch_bounded(Cursor(ROWS), max_tokens=10 ** 6, max_rows=25) == ROWS
+
+
+def test_no_budget():
+    assert fetch_bounded(Cursor(ROWS)) == ROWS
+    assert fetch_bounded(Cursor([])) == []
+
+
+def test_row_budget_stops_after_the_batch_that_crosses_it():
+    cursor = Cursor(ROWS)
+
+    with pytest.raises(ResultTooLarge):
+        fetch_bounded(cursor, max_rows=15)
+    assert cursor.fetched == 20
+
+
+def test_token_budget_stops_early():
+    cursor = Cursor(ROWS)
+    first_batch = len(str(ROWS[:10]))
+
+    with pytest.raises(ResultTooLarge):
+        fetch_bounded(cursor, max_tokens=first_batch + 1)
+    assert cursor.fetched == 20
+
+
+def test_token_budget_counts_every_batch():
+    budget = sum(len(str(ROWS[i:i + 10])) for i in range(0, 25, 10))
+
+    assert fetch_bounded(Cursor(ROWS), max_tokens=budget) == ROWS
+    with pytest.raises(ResultTooLarge):
+        fetch_bounded(Cursor(ROWS), max_tokens=budget - 1)
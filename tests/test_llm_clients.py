@@ -0,0 +1,60 @@
+import pytest
+
+from utils import llm_clients
+from utils.llm_resilience import ResilientLLM
+
+
+@pytest.fixture(autouse=True)
+def empty_registry(monkeypatch):
+    monkeypatch.setattr(llm_clients, '_clients', {})
+    monkeypatch.setattr(llm_clients, '_raw_clients', {})
+    monkeypatch.setattr(llm_clients, '_openai_http', None)
+    monkeypatch.setattr(llm_clients, 'LLM_RESILIENCE', False)
+    # Clients are only constructed here, nothing is sent
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    monkeypatch.delenv('ANTHROPIC_API_KEY', raising=False)
+
+
+def test_same_settings_share_one_client():
+    llm = llm_clients.get_llm('openai', 'gpt-4o', 0.9)
+
+    assert llm_clients.get_llm('openai', 'gpt-4o', 0.9) is llm
+    assert llm_clients.get_llm('openai', 'gpt-4o', 0.3) is not llm
+    assert llm_clients.get_llm('openai', 'gpt-4o-mini', 0.9) is not llm
+
+
+def test_temperature_is_applied():
+    assert llm_clients.get_llm('openai', 'gpt-4o', 0.3).temperature == 0.3
+
+
+def test_openai_clients_share_connections():
+    first = llm_clients.get_raw_llm('openai', 'gpt-4o', 0.9)
+    second = llm_clients.get_raw_llm('openai', 'gpt-4', 0.3)
+
+    assert llm_clients._openai_http is not None
+    assert first.http_client is second.http_client is llm_clients._openai_http
+
+
+def test_unknown_provider():
+    with pytest.raises(ValueError):
+        llm_clients.get_raw_llm('cohere', 'command')
+
+
+def test_resilience_wraps_the_shared_client(monkeypatch):
+    monkeypatch.setattr(llm_clients, 'LLM_RESILIENCE', True)
+
+    llm = llm_clients.get_llm('openai', 'gpt-4o', 0.9)
+    assert isinstance(llm, ResilientLLM)
+    assert llm.llm is llm_clients.get_raw_llm('openai', 'gpt-4o', 0.9)
+    assert llm_clients.get_llm('openai', 'gpt-4o', 0.9) is llm
+    # No Anthropic key, so there is nothing to fall back to
+    assert llm._fallback() is None
+
+
+def test_fallback_needs_a_key_and_caps_temperature(monkeypatch):
+    assert llm_clients._fallback_factory('openai', 1.2) is None
+
+    monkeypatch.setenv('ANTHROPIC_API_KEY', 'test')
+    provider, llm = llm_clients._fallback_factory('openai', 1.2)()
+    assert provider == 'anthropic'
+    assert llm.temperature == 1.0
@@ -0,0 +1,119 @@
+import time
+
+import httpx
+import openai
+import pytest
+
+from utils import llm_resilience
+from utils.llm_resilience import ResilientLLM, is_open, is_provider_failure, record_failure, record_success
+
+
+REQUEST = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+
+
+def status_error(cls, status):
+    return cls('failed', response=httpx.Response(status, request=REQUEST), body=None)
+
+
+class FakeLLM:
+    def __init__(self, answer=None, error=None, delay=0.0):
+        self.answer = answer
+        self.error = error
+        self.delay = delay
+        self.calls = 0
+
+    def invoke(self, input, config=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(llm_resilience, '_providers', {})
+    monkeypatch.setattr(llm_resilience, '_stats', {'fallbacks': 0, 'hedges': 0, 'hedge_wins': 0, 'hedges_abandoned': 0})
+    monkeypatch.setattr(llm_resilience, 'BREAKER_FAILURES', 3)
+
+
+def state(provider):
+    return llm_resilience.llm_resilience_stats()['providers'][provider]['state']
+
+
+def open_breaker(provider):
+    for _ in range(3):
+        record_failure(provider, status_error(openai.InternalServerError, 500))
+
+
+def test_provider_failures():
+    assert is_provider_failure(status_error(openai.InternalServerError, 500))
+    assert is_provider_failure(openai.APITimeoutError(REQUEST))
+    assert is_provider_failure(openai.APIConnectionError(request=REQUEST))
+    assert is_provider_failure(httpx.ReadTimeout('timed out'))
+    assert not is_provider_failure(status_error(openai.BadRequestError, 400))
+    assert not is_provider_failure(status_error(openai.RateLimitError, 429))
+    assert not is_provider_failure(ValueError('Could not parse the output'))
+
+
+def test_breaker_opens_after_failures():
+    for _ in range(2):
+        record_failure('openai', status_error(openai.InternalServerError, 503))
+    assert not is_open('openai')
+
+    record_failure('openai', status_error(openai.InternalServerError, 503))
+    assert is_open('openai')
+    assert state('openai') == 'open'
+
+
+def test_client_errors_do_not_open_breaker():
+    for _ in range(10):
+        record_failure('openai', status_error(openai.BadRequestError, 400))
+    assert not is_open('openai')
+    assert state('openai') == 'closed'
+
+
+def test_breaker_half_open_after_cooldown():
+    open_breaker('openai')
+    # Cooldown over
+    llm_resilience._providers['openai']['open_until'] = time.time() - 1
+    assert not is_open('openai')
+    assert state('openai') == 'half_open'
+
+    # One more failure while half open is enough to open it again
+    record_failure('openai', openai.APITimeoutError(REQUEST))
+    assert is_open('openai')
+
+
+def test_breaker_closes_on_success():
+    open_breaker('openai')
+    llm_resilience._providers['openai']['open_until'] = time.time() - 1
+
+    record_success('openai', total_ms=100)
+    assert state('openai') == 'closed'
+    record_failure('openai', openai.APITimeoutError(REQUEST))
+    assert not is_open('openai')
+
+
+def test_open_breaker_sends_calls_to_fallback():
+    primary = FakeLLM(answer='primary')
+    secondary = FakeLLM(answer='secondary')
+    llm = ResilientLLM('openai', primary, lambda: ('anthropic', secondary))
+    open_breaker('openai')
+
+    assert llm.invoke('question') == 'secondary'
+    assert primary.calls == 0
+
+
+def test_hedge_winner_abandons_running_loser(monkeypatch):
+    monkeypatch.setattr(llm_resilience, 'HEDGE_DEFAULT_MS', 10)
+    primary = FakeLLM(answer='primary', delay=0.5)
+    secondary = FakeLLM(answer='secondary')
+    llm = ResilientLLM('openai', primary, lambda: ('anthropic', secondary))
+
+    assert llm._hedged_invoke(llm._backends(), 'question', None, {}) == 'secondary'
+    stats = llm_resilience.llm_resilience_stats()
+    assert stats['hedges'] == 1
+    assert stats['hedge_wins'] == 1
+    # The primary was already running, so it can only be abandoned
+    assert stats['hedges_abandoned'] == 1
@@ -0,0 +1,87 @@
+import pytest
+from langchain_core.messages import AIMessage
+
+from utils import model_tiers, schema
+from utils.model_tiers import answer_tier, repair_tier, router_escalation, sql_escalation, stage_model, stage_models
+from utils.schema import register_metadata
+
+
+METADATA = """
+Table: playerlog
+Name (TEXT): Player name.
+PassingYards (DOUBLE PRECISION): Passing yards.
+"""
+
+
+@pytest.fixture(autouse=True)
+def tiering(monkeypatch):
+    monkeypatch.setattr(model_tiers, 'MODEL_TIERING', True)
+    monkeypatch.setattr(schema, '_tables', {})
+    register_metadata(METADATA)
+
+
+def reasons(stage):
+    return model_tiers.model_tier_stats()['stages'][stage]['reasons']
+
+
+def router_response(content, logprobs):
+    tokens = [{'token': token, 'logprob': logprob} for token, logprob in logprobs]
+    return AIMessage(content=content, response_metadata={'logprobs': {'content': tokens}})
+
+
+def test_stage_models_with_and_without_tiering(monkeypatch):
+    assert stage_models('sql') == [model_tiers.CHEAP_MODEL, model_tiers.STRONG_MODELS['sql']]
+    assert stage_model('sql', 5) == model_tiers.STRONG_MODELS['sql']
+
+    monkeypatch.setattr(model_tiers, 'MODEL_TIERING', False)
+    assert stage_models('sql') == [model_tiers.STRONG_MODELS['sql']]
+    assert stage_model('sql', 0) == model_tiers.STRONG_MODELS['sql']
+
+
+def test_router_escalates_unknown_bucket():
+    assert router_escalation(AIMessage(content='Bucket: Weather'), 'Weather') == 'unknown_bucket'
+
+
+def test_router_escalates_low_confidence():
+    unsure = router_response('Bucket: Props', [('Bucket', 0.0), (': ', 0.0), ('Props', -1.0)])
+    sure = router_response('Bucket: Props', [('Bucket', 0.0), (': ', 0.0), ('Props', -0.01)])
+
+    assert router_escalation(unsure, 'Props') == 'low_confidence'
+    assert router_escalation(sure, 'Props') is None
+    # Without logprobs there is nothing to judge confidence on
+    assert router_escalation(AIMessage(content='Bucket: Props'), 'Props') is None
+
+
+def test_sql_escalation_reasons():
+    assert sql_escalation('Error: Cannot answer question with data provided.', None) == 'cannot_answer'
+    assert sql_escalation('Here is what I found', None) == 'no_sql'
+    assert sql_escalation('```sql\nSELECT "Sacks" FROM playerlog;\n```', 'SELECT "Sacks" FROM playerlog;') == 'validation_failed'
+    assert sql_escalation('```sql\nSELECT "Name" FROM playerlog;\n```', 'SELECT "Name" FROM playerlog;') is None
+
+
+def test_repair_escalates_after_a_failed_fix():
+    before = reasons('repair').get('fix_failed', 0)
+
+    assert repair_tier(0) == 0
+    assert repair_tier(1) == 1
+    assert repair_tier(2) == 1
+    assert reasons('repair').get('fix_failed', 0) == before + 1
+
+
+def test_answer_tier_reasons(monkeypatch):
+    monkeypatch.setattr(model_tiers, 'ANSWER_STRONG_MIN_RESULT_TOKENS', 100)
+    before = reasons('answer')
+
+    assert answer_tier(50) == 0
+    assert answer_tier(500) == 1
+    assert answer_tier(50, sql_escalated=True) == 1
+    after = reasons('answer')
+    assert after.get('large_result', 0) == before.get('large_result', 0) + 1
+    assert after.get('sql_escalated', 0) == before.get('sql_escalated', 0) + 1
+
+
+def test_no_escalation_without_tiering(monkeypatch):
+    monkeypatch.setattr(model_tiers, 'MODEL_TIERING', False)
+
+    assert stage_model('repair', repair_tier(1)) == model_tiers.STRONG_MODELS['repair']
+    assert answer_tier(10 ** 6, sql_escalated=True) == 0
@@ -0,0 +1,13 @@
+from utils.percentile import percentile
+
+
+def test_nearest_rank():
+    samples = [50, 10, 40, 20, 30]
+
+    assert percentile(samples, 0.5) == 30
+    assert percentile(samples, 0.95) == 50
+    assert percentile(samples, 0.0) == 10
+
+
+def test_no_samples():
+    assert percentile([], 0.95) == 0.0
@@ -0,0 +1,39 @@
+import pytest
+
+from utils import pre_router
+from utils.pre_router import OFF_TOPIC_RESPONSE, pre_route
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(pre_router, 'PRE_ROUTER_ENABLED', True)
+
+
+@pytest.mark.parametrize('message', ['hi', 'Hey Billy!', 'thanks so much', 'bye', 'what can you do?'])
+def test_small_talk_is_answered(message):
+    bucket, _ = pre_route(message)
+    assert bucket == 'Conversation'
+
+
+@pytest.mark.parametrize('message', [
+    'Who won the NBA finals?',
+    'What is the bitcoin price today',
+    'write me a poem about the ocean',
+])
+def test_off_topic_is_rejected(message):
+    assert pre_route(message) == ('NoBucket', OFF_TOPIC_RESPONSE)
+
+
+@pytest.mark.parametrize('message', [
+    'which player got paid in bitcoin',
+    'Which quarterback has a crypto sponsorship?',
+    'Did the Chiefs ever sign a baseball player?',
+    'How many games did Kansas City win in 2023?',
+    'hi, how many yards did Josh Allen throw for last week?',
+])
+def test_football_questions_go_through(message):
+    assert pre_route(message) is None
+
+
+def test_chat_history_goes_through():
+    assert pre_route('hi\nthanks') is None
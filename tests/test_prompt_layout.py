@@ -0,0 +1,66 @@
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.prompts import PromptTemplate
+
+from utils import prompt_layout
+from utils.prompt_layout import check_prompt_call, prompt_layout_stats, register_prompt, stable_prefix
+
+
+INSTRUCTIONS = 'You are a data analyst. Only respond with the sql query.\n' * 20
+SCHEMA = 'Name (text)\nTeam (text)\nPassingYards (double precision)\n'
+
+GOOD = PromptTemplate.from_template(INSTRUCTIONS + '{table_metadata_string}\nDate: {current_date}\nQuestion: {user_question}')
+BAD = PromptTemplate.from_template('Date: {current_date}\n' + INSTRUCTIONS + '{table_metadata_string}\nQuestion: {user_question}')
+
+VALUES = {'table_metadata_string': SCHEMA, 'current_date': '2024-10-03', 'user_question': 'How many yards?'}
+
+
+@pytest.fixture(autouse=True)
+def no_layouts(monkeypatch):
+    monkeypatch.setattr(prompt_layout, '_layouts', {})
+    monkeypatch.setattr(prompt_layout, 'count_tokens', len)
+
+
+def test_prefix_stops_at_first_per_request_value():
+    prefix, static_chars = stable_prefix(GOOD, {'table_metadata_string': SCHEMA})
+
+    assert prefix == INSTRUCTIONS + SCHEMA + '\nDate: '
+    assert static_chars == len(INSTRUCTIONS + SCHEMA + '\nDate: \nQuestion: ')
+
+
+def test_registered_ratio_shows_a_bad_layout():
+    register_prompt('good', GOOD, {'table_metadata_string': SCHEMA})
+    register_prompt('bad', BAD, {'table_metadata_string': SCHEMA})
+
+    stats = prompt_layout_stats()
+    assert stats['good']['prefix_ratio'] > 0.9
+    assert stats['bad']['prefix_ratio'] < 0.1
+    assert stats['good']['prefix_tokens'] == len(INSTRUCTIONS + SCHEMA + '\nDate: ')
+
+
+def test_disabled_prompt_is_not_registered():
+    register_prompt('pruned', GOOD, {}, enabled=False)
+
+    assert prompt_layout_stats() == {}
+
+
+def test_calls_count_unstable_prefixes_and_cached_tokens():
+    register_prompt('good', GOOD, {'table_metadata_string': SCHEMA})
+    response = AIMessage(content='SELECT 1;', usage_metadata={'input_tokens': 2000, 'output_tokens': 5, 'total_tokens': 2005},
+                         response_metadata={'token_usage': {'prompt_tokens_details': {'cached_tokens': 1536}}})
+
+    check_prompt_call('good', VALUES, response)
+    check_prompt_call('good', dict(VALUES, table_metadata_string='Name (text)\n'))
+
+    stats = prompt_layout_stats()['good']
+    assert stats['calls'] == 2
+    assert stats['unstable'] == 1
+    assert stats['input_tokens'] == 2000
+    assert stats['cached_tokens'] == 1536
+    assert stats['cached_ratio'] == pytest.approx(0.768)
+
+
+def test_unregistered_prompt_is_ignored():
+    check_prompt_call('unknown', VALUES)
+
+    assert prompt_layout_stats() == {}
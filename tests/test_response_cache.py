@@ -0,0 +1,82 @@
+import pytest
+
+from utils import data_version, response_cache
+from utils.data_version import bump_data_version
+from utils.lru import LRUCache
+from utils.response_cache import get_cached_response, replay_chunks, store_response
+
+
+MESSAGE = 'how many passing yards did josh allen have in 2023'
+QUESTION = 'How many passing yards did Josh Allen have in 2023?'
+QUERY = 'SELECT SUM("PassingYards") FROM playerlog WHERE "Name" = \'Josh Allen\' AND "Season" = 2023;'
+RESULT = [(4306.0,)]
+ANSWER = 'Josh Allen threw for 4,306 yards in 2023.'
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(response_cache, 'RESPONSE_CACHE_ENABLED', True)
+    monkeypatch.setattr(response_cache, '_responses', LRUCache(100))
+    monkeypatch.setattr(response_cache, '_routes', LRUCache(100))
+    monkeypatch.setattr(data_version, '_version', 'test')
+
+
+def store(message=MESSAGE, result=RESULT, answer=ANSWER):
+    store_response(message, 'PlayerGameLog', QUESTION, QUERY, result, answer, 0.01)
+
+
+def test_repeat_is_served_from_cache():
+    assert get_cached_response(MESSAGE) is None
+    store()
+
+    response = get_cached_response('How many passing yards did Josh Allen have in 2023?')
+    assert response['bucket'] == 'PlayerGameLog'
+    assert response['query'] == QUERY
+    assert response['answer'] == ANSWER
+
+
+def test_empty_or_failed_results_are_not_stored():
+    store(result=[])
+    store(result='Error: column does not exist')
+    store(answer='')
+
+    assert get_cached_response(MESSAGE) is None
+
+
+def test_chat_history_is_not_cached():
+    store(message='hi\n' + MESSAGE)
+
+    assert get_cached_response('hi\n' + MESSAGE) is None
+    assert get_cached_response(MESSAGE) is None
+
+
+def test_expires_after_ttl(monkeypatch):
+    store()
+    monkeypatch.setattr(response_cache, 'RESPONSE_CACHE_TTL', -1)
+
+    assert get_cached_response(MESSAGE) is None
+    # Dropped, not just skipped
+    monkeypatch.setattr(response_cache, 'RESPONSE_CACHE_TTL', 3600)
+    assert get_cached_response(MESSAGE) is None
+
+
+def test_data_version_change_clears_the_cache():
+    store()
+    bump_data_version('next')
+
+    assert len(response_cache._responses) == 0
+    assert get_cached_response(MESSAGE) is None
+
+
+def test_new_data_version_misses_even_before_clearing(monkeypatch):
+    store()
+    monkeypatch.setattr(data_version, '_version', 'next')
+
+    assert get_cached_response(MESSAGE) is None
+
+
+def test_replay_ends_with_the_whole_answer():
+    chunks = list(replay_chunks('x' * 100))
+
+    assert [len(chunk) for chunk in chunks] == [40, 80, 100]
+    assert list(replay_chunks('')) == []
@@ -0,0 +1,71 @@
+import pytest
+
+from utils import executor, result_cache
+from utils.lru import LRUCache
+from utils.result_cache import canonicalize_sql, get_cached_result, store_result
+
+
+QUERY = 'SELECT "Name", "PassingYards" FROM playerlog WHERE "Season" = 2023;'
+ROWS = [('Patrick Mahomes', 4183.0), ('Josh Allen', 4306.0), ('Jalen Hurts', 3858.0)]
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(result_cache, 'RESULT_CACHE_ENABLED', True)
+    monkeypatch.setattr(result_cache, '_cache', LRUCache(100, 1024 * 1024, sizeof=lambda entry: len(repr(entry[0]))))
+
+
+@pytest.fixture
+def database(monkeypatch):
+    calls = []
+
+    def execute(query, max_tokens, max_rows, bucket, owner):
+        calls.append(query)
+        return list(ROWS)
+
+    monkeypatch.setattr(executor, '_execute_with_repair', execute)
+    monkeypatch.setattr(executor, 'count_tokens', len)
+    return calls
+
+
+def test_canonical_form_ignores_layout_but_not_literals():
+    assert canonicalize_sql('select  "Name"\nFROM playerlog -- note\n;') == 'select "Name" from playerlog'
+    assert canonicalize_sql("SELECT 1 WHERE \"Name\" = 'A B'") != canonicalize_sql("SELECT 1 WHERE \"Name\" = 'a b'")
+
+
+def test_store_and_get():
+    store_result(QUERY, ROWS, 30)
+
+    assert get_cached_result(QUERY.replace(' ', '\n').rstrip(';')) == (ROWS, 30)
+    assert get_cached_result('SELECT 1;') is None
+
+
+def test_errors_are_not_cached():
+    store_result(QUERY, 'Error: relation does not exist', 10)
+
+    assert get_cached_result(QUERY) is None
+
+
+def test_repeated_query_is_served_from_cache(database):
+    assert executor.execute_query(QUERY, max_tokens=1000, max_rows=10) == ROWS
+    assert executor.execute_query(QUERY, max_tokens=1000, max_rows=10) == ROWS
+
+    assert len(database) == 1
+
+
+def test_hit_respects_token_budget(database):
+    executor.execute_query(QUERY)
+    tokens = get_cached_result(QUERY)[1]
+
+    executor.execute_query(QUERY, max_tokens=tokens)
+    assert len(database) == 1
+    # Cached under no budget, too big for this one: the query runs again so the budget is enforced
+    executor.execute_query(QUERY, max_tokens=tokens - 1)
+    assert len(database) == 2
+
+
+def test_hit_respects_row_budget(database):
+    executor.execute_query(QUERY)
+    executor.execute_query(QUERY, max_rows=2)
+
+    assert len(database) == 2
@@ -0,0 +1,87 @@
+import pytest
+
+from utils import schema
+from utils.schema import SchemaValidationError, register_metadata, validate_sql
+from utils.sql_repair import UNDEFINED_COLUMN, UNDEFINED_TABLE
+
+
+METADATA = """
+Table: playerlog
+PlayerID (BIGINT): Player id.
+Name (TEXT): Player name.
+Team (TEXT): Team abbreviation.
+Season (BIGINT): Season year.
+Week (BIGINT): Week of the season.
+PassingYards (DOUBLE PRECISION): Passing yards.
+
+Table: teamlog
+GameKey (TEXT): Game id.
+Team (TEXT): Team abbreviation.
+Score (BIGINT): Points scored.
+
+Table: props
+PlayerID (BIGINT): Player id.
+BettingMarketType (TEXT): Market.
+Value (DOUBLE PRECISION): Line.
+"""
+
+
+@pytest.fixture(autouse=True)
+def playerlog_schema(monkeypatch):
+    monkeypatch.setattr(schema, '_tables', {})
+    register_metadata(METADATA)
+
+
+def rejected(query, bucket=None):
+    with pytest.raises(SchemaValidationError) as error:
+        validate_sql(query, bucket)
+    return error.value
+
+
+@pytest.mark.parametrize('query', [
+    'SELECT "Name", SUM("PassingYards") FROM playerlog WHERE "Season" = 2023 GROUP BY "Name";',
+    'SELECT p."Name", AVG(p."PassingYards") AS avg_yards FROM playerlog p WHERE p."Team" = \'KC\' GROUP BY p."Name" ORDER BY avg_yards DESC;',
+    'WITH weekly AS (SELECT "Week", "PassingYards" FROM playerlog) SELECT MAX("PassingYards") FROM weekly;',
+    'SELECT pl."Name", pr."Value" FROM playerlog pl JOIN props pr ON pl."PlayerID" = pr."PlayerID";',
+    'SELECT "Name" FROM playerlog WHERE "Name" = \'"Unknown" Column\' -- "Bogus" in a comment',
+    'SELECT EXTRACT(YEAR FROM NOW()), COUNT(*) FROM playerlog;',
+    # Aliases without AS
+    'SELECT SUM("Score") "total_points" FROM teamlog WHERE "Team" = \'KC\' ORDER BY "total_points" DESC;',
+    'SELECT CASE WHEN "Score" > 20 THEN \'high\' ELSE \'low\' END "band", COUNT(*) "games" FROM teamlog GROUP BY 1;',
+    # CTEs with a column list
+    'WITH g("k", "s") AS (SELECT "GameKey", "Score" FROM teamlog) SELECT "k", MAX("s") FROM g GROUP BY "k";',
+    'WITH g (k) AS MATERIALIZED (SELECT "GameKey" FROM teamlog) SELECT COUNT(k) FROM g;',
+])
+def test_valid_queries_pass(query):
+    validate_sql(query, 'PlayerLogAndProps')
+
+
+def test_unknown_quoted_column_is_rejected():
+    error = rejected('SELECT "RushingYards" FROM playerlog;')
+    assert error.pgcode == UNDEFINED_COLUMN
+    assert 'RushingYards' in str(error)
+
+
+def test_unquoted_camel_case_column_is_rejected():
+    # Postgres folds it to passingyards, which doesn't exist
+    error = rejected('SELECT SUM(PassingYards) FROM playerlog;')
+    assert error.pgcode == UNDEFINED_COLUMN
+    assert 'passingyards' in str(error)
+
+
+def test_unknown_table_is_rejected():
+    error = rejected('SELECT "Name" FROM player_stats;')
+    assert error.pgcode == UNDEFINED_TABLE
+
+
+def test_column_from_other_table_is_rejected():
+    rejected('SELECT "BettingMarketType" FROM playerlog;')
+
+
+def test_unknown_column_inside_cte_is_rejected():
+    rejected('WITH g("k") AS (SELECT "Points" FROM teamlog) SELECT "k" FROM g;')
+
+
+def test_nothing_registered_lets_everything_through(monkeypatch):
+    monkeypatch.setattr(schema, '_tables', {})
+    validate_sql('SELECT "Anything" FROM anywhere;')
@@ -0,0 +1,122 @@
+import pytest
+
+from utils import schema_pruning
+from utils.lru import LRUCache
+from utils.schema_pruning import prune_metadata, prune_schema, record_schema_outcome, schema_last, schema_pruning_stats
+
+
+COLUMNS = ['Name', 'Team', 'Season', 'PassingYards', 'RushingYards', 'ReceivingYards', 'Sacks', 'Temperature']
+
+METADATA = '\n'.join([
+    'Table: playerlog',
+    'Name (text) - First Name and Last Name',
+    'Team (text)',
+    'Season (bigint)',
+    'PassingYards (double precision)',
+    'RushingYards (double precision)',
+    'ReceivingYards (double precision)',
+    'Sacks (double precision)',
+    'Temperature (double precision)',
+    '   Degrees Fahrenheit at kickoff',
+])
+
+
+def one_hot(column):
+    return [1.0 if name == column else 0.0 for name in COLUMNS]
+
+
+def kept(metadata):
+    return [line.split(' ')[0] for line in metadata.splitlines() if '(' in line]
+
+
+@pytest.fixture(autouse=True)
+def fake_embeddings(monkeypatch):
+    # Each column description embeds onto its own axis, so the closest column is the one asked about
+    def get_embeddings(texts):
+        return [one_hot(text.split(' ')[0]) for text in texts]
+
+    monkeypatch.setattr(schema_pruning, 'get_embeddings', get_embeddings)
+    monkeypatch.setattr(schema_pruning, 'get_embedding', lambda text: one_hot('Sacks'))
+    monkeypatch.setattr(schema_pruning, 'count_tokens', len)
+    monkeypatch.setattr(schema_pruning, '_indexes', {})
+    monkeypatch.setattr(schema_pruning, '_pending', LRUCache(100))
+    monkeypatch.setattr(schema_pruning, '_stats', {})
+    monkeypatch.setattr(schema_pruning, 'SCHEMA_PRUNING_ENABLED', True)
+    monkeypatch.setattr(schema_pruning, 'SCHEMA_PRUNING_SAMPLE', 1.0)
+    monkeypatch.setattr(schema_pruning, 'SCHEMA_PRUNING_TOP_K', 1)
+
+
+def test_keeps_closest_key_and_mentioned_columns():
+    pruned = prune_metadata(METADATA, one_hot('RushingYards'), 'who had the most passing yards', ['Name', 'Team'])
+
+    assert kept(pruned) == ['Name', 'Team', 'PassingYards', 'RushingYards']
+    assert pruned.startswith('Table: playerlog\n')
+
+
+def test_continuation_lines_follow_their_column():
+    pruned = prune_metadata(METADATA, one_hot('Temperature'), '', [])
+
+    assert pruned.splitlines()[-2:] == ['Temperature (double precision)', '   Degrees Fahrenheit at kickoff']
+
+
+def test_small_schema_is_left_alone():
+    assert prune_metadata(METADATA, one_hot('Sacks'), top_k=len(COLUMNS)) == METADATA
+
+
+def test_prune_schema_uses_the_passed_embedding():
+    (metadata,), pruned = prune_schema('PlayerGameLog', 'most rushing', one_hot('RushingYards'), [(METADATA, ['Name'])])
+
+    assert pruned
+    assert 'RushingYards' in kept(metadata)
+    assert 'Sacks' not in kept(metadata)
+    stats = schema_pruning_stats()['buckets']['PlayerGameLog']
+    assert stats['pruned'] == 1
+    assert stats['saved_tokens'] == len(METADATA) - len(metadata)
+
+
+def test_prune_schema_embeds_when_needed():
+    (metadata,), pruned = prune_schema('PlayerGameLog', 'most sacks', None, [(METADATA, [])])
+
+    assert pruned
+    assert 'Sacks' in kept(metadata)
+
+
+def test_full_schema_when_disabled(monkeypatch):
+    monkeypatch.setattr(schema_pruning, 'SCHEMA_PRUNING_ENABLED', False)
+
+    assert prune_schema('PlayerGameLog', 'most sacks', one_hot('Sacks'), [(METADATA, [])]) == ([METADATA], False)
+
+
+def test_full_schema_when_embedding_fails(monkeypatch):
+    def fail(texts):
+        raise RuntimeError('embeddings unavailable')
+
+    monkeypatch.setattr(schema_pruning, 'get_embeddings', fail)
+
+    assert prune_schema('PlayerGameLog', 'most sacks', one_hot('Sacks'), [(METADATA, [])]) == ([METADATA], False)
+
+
+def test_outcomes_are_attributed_per_call(monkeypatch):
+    prune_schema('PlayerGameLog', 'most sacks', one_hot('Sacks'), [(METADATA, [])], owner='a')
+    monkeypatch.setattr(schema_pruning, 'SCHEMA_PRUNING_ENABLED', False)
+    prune_schema('PlayerGameLog', 'most sacks', one_hot('Sacks'), [(METADATA, [])], owner='b')
+
+    record_schema_outcome('PlayerGameLog', 'most sacks', False, owner='b')
+    record_schema_outcome('PlayerGameLog', 'most sacks', True, owner='a')
+    # Already recorded
+    record_schema_outcome('PlayerGameLog', 'most sacks', True, owner='a')
+
+    outcomes = schema_pruning_stats()['buckets']['PlayerGameLog']['outcomes']
+    assert (outcomes['pruned']['ok'], outcomes['pruned']['failed']) == (1, 0)
+    assert (outcomes['full']['ok'], outcomes['full']['failed']) == (0, 1)
+
+
+def test_schema_last_moves_the_schema_next_to_the_request():
+    request = '\nQuestion: {user_question}\n'
+    template = 'Intro\n<database_schema>\n{table_metadata_string}\n</database_schema>\nRules\n' + request + 'Assistant: '
+
+    moved = schema_last(template, request)
+
+    assert moved.index('Rules') < moved.index('{table_metadata_string}') < moved.index('{user_question}')
+    assert moved.endswith(request + 'Assistant: ')
+    assert schema_last('No schema block' + request, request) == 'No schema block' + request
@@ -0,0 +1,141 @@
+import threading
+
+import pytest
+
+from utils import model_tiers, sql_candidates
+from utils.sql_candidates import cancel_candidates, run_candidates
+
+
+FAST = '```sql\nSELECT "Name" FROM playerlog;\n```'
+SLOW = '```sql\nSELECT "Name" FROM playerlog WHERE "Season" = 2023;\n```'
+
+
+class Candidates:
+    # Stands in for a bucket's get_answer function and the executor: answers per temperature,
+    # and the slow ones block until their owner is cancelled
+    def __init__(self, answers, results, slow=()):
+        self.answers = answers
+        self.results = results
+        self.slow = set(slow)
+        self.calls = []
+        self.cancelled = []
+        self.released = {}
+        self.lock = threading.Lock()
+
+    def get_answer(self, model, question, embedding=None, match=None, temperature=None, tier=0, owner=None):
+        with self.lock:
+            self.calls.append((temperature, tier, owner))
+            released = self.released.setdefault(owner, threading.Event())
+        if temperature in self.slow:
+            released.wait(5)
+        return self.answers[tier, temperature], 100, 10
+
+    def execute(self, query, max_tokens=None, max_rows=None, bucket=None, owner=None):
+        return self.results[query]
+
+    def cancel(self, owner):
+        with self.lock:
+            self.cancelled.append(owner)
+            self.released.setdefault(owner, threading.Event()).set()
+        return 1
+
+
+@pytest.fixture(autouse=True)
+def two_temperatures(monkeypatch):
+    monkeypatch.setattr(sql_candidates, 'SQL_CANDIDATE_TEMPERATURES', [0.2, 0.6])
+    monkeypatch.setattr(sql_candidates, 'SQL_CANDIDATES', 2)
+    monkeypatch.setattr(model_tiers, 'MODEL_TIERING', False)
+
+
+def run(monkeypatch, candidates, owner='sid'):
+    monkeypatch.setattr(sql_candidates, 'execute_query', candidates.execute)
+    monkeypatch.setattr(sql_candidates, 'cancel_generation', candidates.cancel)
+    monkeypatch.setattr(sql_candidates, 'cancel_queries', lambda owner: 0)
+    return run_candidates(candidates.get_answer, 'PlayerGameLog', 'who?', embedding=[1.0], match=('q', 'SELECT 1;'),
+                          owner=owner)
+
+
+def test_first_candidate_with_rows_wins_and_the_rest_are_stopped(monkeypatch):
+    candidates = Candidates({(0, 0.2): SLOW, (0, 0.6): FAST},
+                            {'SELECT "Name" FROM playerlog;': [('Josh Allen',)]}, slow={0.2})
+
+    raw_query, query, result, input_tokens, output_tokens, tier = run(monkeypatch, candidates)
+
+    assert raw_query == FAST
+    assert result == [('Josh Allen',)]
+    assert tier == 0
+    assert candidates.cancelled == ['sid#0.0']
+    # The stopped candidate's tokens are part of the request's cost
+    assert (input_tokens, output_tokens) == (200, 20)
+
+
+def test_empty_result_is_an_answer(monkeypatch):
+    candidates = Candidates({(0, 0.2): FAST, (0, 0.6): SLOW},
+                            {'SELECT "Name" FROM playerlog;': [], 'SELECT "Name" FROM playerlog WHERE "Season" = 2023;': []})
+
+    raw_query, query, result, _, _, _ = run(monkeypatch, candidates)
+
+    # Nobody had rows, so the lowest temperature's query is used
+    assert raw_query == FAST
+    assert result == []
+    assert candidates.cancelled == []
+
+
+def test_no_usable_candidate(monkeypatch):
+    cannot = 'Error: Cannot answer question with data provided.'
+    candidates = Candidates({(0, 0.2): cannot, (0, 0.6): cannot}, {})
+
+    raw_query, query, result, _, _, tier = run(monkeypatch, candidates)
+
+    assert query is None
+    assert result is None
+    assert 'cannot' in raw_query.lower()
+    assert tier == 0
+
+
+def test_cancel_candidates_stops_every_running_candidate(monkeypatch):
+    candidates = Candidates({(0, 0.2): SLOW, (0, 0.6): SLOW}, {'SELECT "Name" FROM playerlog WHERE "Season" = 2023;': []},
+                            slow={0.2, 0.6})
+    monkeypatch.setattr(sql_candidates, 'cancel_generation', candidates.cancel)
+    monkeypatch.setattr(sql_candidates, 'cancel_queries', lambda owner: 0)
+
+    def disconnect():
+        while len(candidates.calls) < 2:
+            threading.Event().wait(0.01)
+        cancel_candidates('sid')
+
+    thread = threading.Thread(target=disconnect)
+    thread.start()
+    run(monkeypatch, candidates)
+    thread.join(5)
+
+    assert sorted(candidates.cancelled) == ['sid#0.0', 'sid#0.1']
+
+
+def test_tiering_escalates_when_no_candidate_is_usable(monkeypatch):
+    monkeypatch.setattr(model_tiers, 'MODEL_TIERING', True)
+    cannot = 'Error: Cannot answer question with data provided.'
+    candidates = Candidates({(0, 0.2): cannot, (0, 0.6): cannot, (1, 0.2): FAST, (1, 0.6): FAST},
+                            {'SELECT "Name" FROM playerlog;': [('Josh Allen',)]})
+    before = model_tiers.model_tier_stats()['stages']['sql']['reasons'].get('cannot_answer', 0)
+
+    raw_query, query, result, input_tokens, _, tier = run(monkeypatch, candidates)
+
+    assert tier == 1
+    assert result == [('Josh Allen',)]
+    # Both cheap candidates ran, and the strong round ran under its own owners
+    assert sorted(temperature for temperature, tier, _ in candidates.calls if tier == 0) == [0.2, 0.6]
+    assert {owner for _, tier, owner in candidates.calls if tier == 1} <= {'sid#1.0', 'sid#1.1'}
+    assert input_tokens == 100 * len(candidates.calls)
+    assert model_tiers.model_tier_stats()['stages']['sql']['reasons']['cannot_answer'] == before + 1
+
+
+def test_tiering_keeps_an_empty_result(monkeypatch):
+    monkeypatch.setattr(model_tiers, 'MODEL_TIERING', True)
+    candidates = Candidates({(0, 0.2): FAST, (0, 0.6): FAST}, {'SELECT "Name" FROM playerlog;': []})
+
+    _, _, result, _, _, tier = run(monkeypatch, candidates)
+
+    assert tier == 0
+    assert result == []
+    assert {call[1] for call in candidates.calls} == {0}
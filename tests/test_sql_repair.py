@@ -0,0 +1,99 @@
+import pytest
+
+from utils import executor
+from utils.executor import QueryTooExpensive, ResultTooLarge, judge_plan
+from utils.schema import SchemaValidationError
+from utils.sql_repair import SYNTAX_ERROR, UNDEFINED_COLUMN, UNDEFINED_TABLE, classify_error, local_fix
+
+
+COLUMNS = ['Name', 'Team', 'Season', 'PassingYards', 'RushingYards', 'Touchdowns']
+
+
+def column_error(message):
+    return SchemaValidationError(message, UNDEFINED_COLUMN)
+
+
+def test_quotes_case_folded_column():
+    query = 'SELECT SUM(PassingYards) FROM playerlog WHERE "Name" = \'Josh Allen\';'
+    fixed = local_fix(query, column_error('column "passingyards" does not exist'), COLUMNS)
+
+    assert fixed == 'SELECT SUM("PassingYards") FROM playerlog WHERE "Name" = \'Josh Allen\';'
+
+
+def test_uses_postgres_hint():
+    query = 'SELECT "passing_yards" FROM playerlog;'
+    error = column_error('column "passing_yards" does not exist\n'
+                         'HINT:  Perhaps you meant to reference the column "playerlog.PassingYards".')
+
+    assert local_fix(query, error, COLUMNS) == 'SELECT "PassingYards" FROM playerlog;'
+
+
+def test_fixes_wrong_case_in_quotes():
+    query = 'SELECT "passingyards" FROM playerlog;'
+    fixed = local_fix(query, column_error('column "passingyards" does not exist'), COLUMNS)
+
+    assert fixed == 'SELECT "PassingYards" FROM playerlog;'
+
+
+def test_fixes_close_misspelling():
+    query = 'SELECT SUM("TouchDown") FROM playerlog;'
+    fixed = local_fix(query, column_error('column "TouchDown" does not exist'), COLUMNS)
+
+    assert fixed == 'SELECT SUM("Touchdowns") FROM playerlog;'
+
+
+def test_leaves_string_literals_alone():
+    query = "SELECT passingyards FROM playerlog WHERE \"Name\" = 'passingyards';"
+    fixed = local_fix(query, column_error('column "passingyards" does not exist'), COLUMNS)
+
+    assert fixed == "SELECT \"PassingYards\" FROM playerlog WHERE \"Name\" = 'passingyards';"
+
+
+def test_unknown_column_is_left_to_the_llm():
+    query = 'SELECT "Sacks" FROM playerlog;'
+    assert local_fix(query, column_error('column "Sacks" does not exist'), COLUMNS) is None
+
+
+def test_fixes_semicolon_inside_subquery():
+    query = 'SELECT * FROM (SELECT "Name" FROM playerlog;) AS p;'
+    error = SchemaValidationError('syntax error at or near ";"', SYNTAX_ERROR)
+
+    assert local_fix(query, error) == 'SELECT * FROM (SELECT "Name" FROM playerlog) AS p;'
+
+
+def test_fixes_doubled_semicolon():
+    error = SchemaValidationError('syntax error at or near ";"', SYNTAX_ERROR)
+    assert local_fix('SELECT 1;;', error) == 'SELECT 1;'
+
+
+def test_other_errors_are_left_to_the_llm():
+    error = SchemaValidationError('relation "player_stats" does not exist', UNDEFINED_TABLE)
+    assert classify_error(error) == 'undefined_table'
+    assert local_fix('SELECT * FROM player_stats;', error, COLUMNS) is None
+
+
+def test_plan_within_limits_runs_as_is():
+    assert judge_plan('SELECT 1;', cost=10, rows=1, width=8) == 'SELECT 1;'
+
+
+def test_expensive_plan_is_rejected(monkeypatch):
+    monkeypatch.setattr(executor, 'EXPLAIN_MAX_COST', 1000)
+    with pytest.raises(QueryTooExpensive):
+        judge_plan('SELECT 1;', cost=5000, rows=1, width=8)
+
+
+@pytest.mark.parametrize('action, expected', [('expert', ResultTooLarge), ('reject', QueryTooExpensive)])
+def test_oversized_plan(monkeypatch, action, expected):
+    monkeypatch.setattr(executor, 'EXPLAIN_MAX_ROWS', 100)
+    monkeypatch.setattr(executor, 'EXPLAIN_OVERSIZE_ACTION', action)
+    with pytest.raises(expected):
+        judge_plan('SELECT * FROM playerlog;', cost=10, rows=1000, width=8)
+
+
+def test_oversized_plan_limited(monkeypatch):
+    monkeypatch.setattr(executor, 'EXPLAIN_MAX_ROWS', 100)
+    monkeypatch.setattr(executor, 'EXPLAIN_OVERSIZE_ACTION', 'limit')
+    monkeypatch.setattr(executor, 'EXPLAIN_LIMIT_ROWS', 50)
+
+    limited = judge_plan('SELECT * FROM playerlog;', cost=10, rows=1000, width=8)
+    assert limited == 'SELECT * FROM (SELECT * FROM playerlog) AS limited_result LIMIT 50'
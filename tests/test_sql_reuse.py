@@ -0,0 +1,96 @@
+from decimal import Decimal
+
+import pytest
+
+from utils import schema, sql_reuse
+from utils.sql_reuse import _canonical, reuse_sql, substitute
+
+
+TEAM_SQL = """SELECT COUNT(*) FROM teamgames WHERE "Team" = 'KC' AND "Opponent" = 'BUF' AND "Season" = 2023 AND "Score" > "OpponentScore";"""
+PLAYER_SQL = """SELECT SUM("PassingYards") FROM playerlog WHERE "Name" = 'Patrick Mahomes' AND "Season" = 2023;"""
+
+
+@pytest.fixture(autouse=True)
+def shadow_mode(monkeypatch):
+    monkeypatch.setattr(sql_reuse, 'SQL_REUSE_MODE', 'shadow')
+    # No schema registered, so validation lets everything through
+    monkeypatch.setattr(schema, '_tables', {})
+
+
+def test_substitute_swaps_teams_both_ways():
+    query, used = substitute(TEAM_SQL, {'KC': 'BUF', 'BUF': 'KC'}, {}, [])
+
+    assert "\"Team\" = 'BUF' AND \"Opponent\" = 'KC'" in query
+    assert used == {('team', 'KC'), ('team', 'BUF')}
+
+
+def test_substitute_seasons_and_players():
+    query, used = substitute(PLAYER_SQL, {}, {'2023': '2022'}, [('Patrick Mahomes', 'Josh Allen')])
+
+    assert "'Josh Allen'" in query
+    assert '"Season" = 2022' in query
+    assert used == {('player', 'Patrick Mahomes'), ('season', '2023')}
+
+
+def test_substitute_leaves_unmatched_literals_alone():
+    query, used = substitute(TEAM_SQL, {'DAL': 'PHI'}, {}, [])
+
+    assert query == TEAM_SQL
+    assert used == set()
+
+
+def test_substitute_escapes_quotes():
+    sql = """SELECT * FROM playerlog WHERE "Name" = 'Ja''Marr Chase';"""
+    query, used = substitute(sql, {}, {}, [("Ja'Marr Chase", "D'Andre Swift")])
+
+    assert "'D''Andre Swift'" in query
+    assert used == {('player', "Ja'Marr Chase")}
+
+
+def test_reuse_sql_swaps_team_and_season():
+    query = reuse_sql('How many games did the Eagles beat the Cowboys in 2022?',
+                      'How many games did the Chiefs beat the Bills in 2023?', TEAM_SQL, 0.97)
+
+    assert query == TEAM_SQL.replace("'KC'", "'PHI'").replace("'BUF'", "'DAL'").replace('2023', '2022')
+
+
+def test_reuse_sql_swaps_player():
+    query = reuse_sql('How many passing yards did Josh Allen have in 2023?',
+                      'How many passing yards did Patrick Mahomes have in 2023?', PLAYER_SQL, 0.95)
+
+    assert query == PLAYER_SQL.replace('Patrick Mahomes', 'Josh Allen')
+
+
+def test_reuse_sql_rejects_low_score():
+    assert reuse_sql('How many games did the Chiefs beat the Bills in 2023?',
+                     'How many games did the Chiefs beat the Bills in 2023?', TEAM_SQL, 0.5) is None
+
+
+def test_reuse_sql_rejects_different_question():
+    assert reuse_sql('How many rushing yards did Josh Allen have in 2023?',
+                     'How many passing yards did Patrick Mahomes have in 2023?', PLAYER_SQL, 0.95) is None
+
+
+def test_reuse_sql_rejects_team_missing_from_sql():
+    sql = """SELECT COUNT(*) FROM teamgames WHERE "Season" = 2023;"""
+    assert reuse_sql('How many games did the Eagles win in 2023?',
+                     'How many games did the Chiefs win in 2023?', sql, 0.97) is None
+
+
+def test_reuse_sql_rejects_different_team_count():
+    assert reuse_sql('How many games did the Eagles win in 2023?',
+                     'How many games did the Chiefs beat the Bills in 2023?', TEAM_SQL, 0.97) is None
+
+
+def test_reuse_sql_off(monkeypatch):
+    monkeypatch.setattr(sql_reuse, 'SQL_REUSE_MODE', 'off')
+    assert reuse_sql('How many games did the Eagles beat the Cowboys in 2022?',
+                     'How many games did the Chiefs beat the Bills in 2023?', TEAM_SQL, 0.99) is None
+
+
+def test_shadow_results_compare_values_not_names():
+    generated = [{'wins': 3, 'avg': Decimal('24.50001')}, {'wins': 1, 'avg': Decimal('17.0')}]
+    reused = [(17.0, 1), (24.5, 3)]
+
+    assert _canonical(generated) == _canonical(reused)
+    assert _canonical(generated) != _canonical([(17.0, 1)])
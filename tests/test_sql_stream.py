@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import Runnable
+
+from utils import prompt_layout, sql_stream
+from utils.CountUtil import usage_counts
+from utils.sql_stream import cancel_generation, generate_sql
+
+
+PROMPT = PromptTemplate.from_template('Schema: {schema}\nQuestion: {question}')
+VALUES = {'schema': 'teamlog', 'question': 'How many games did KC win?'}
+USAGE = {'input_tokens': 1200, 'output_tokens': 30, 'total_tokens': 1230}
+ANSWER = ['Here is the query:\n``', '`sql\nSELECT COUNT(*) FROM teamlog', '\n``', '`\n', 'It counts the games.', ' Done.']
+
+
+class FakeOpenAI(Runnable):
+    # Streams like langchain-openai: usage only arrives, in a last empty chunk, when asked for
+    provider = 'openai'
+
+    def __init__(self, chunks=ANSWER, delay=0.0):
+        self.chunks = chunks
+        self.delay = delay
+        self.read = 0
+        self.stream_kwargs = None
+
+    def invoke(self, input, config=None, **kwargs):
+        return AIMessage(content=''.join(self.chunks), usage_metadata=USAGE)
+
+    def stream(self, input, config=None, **kwargs):
+        self.stream_kwargs = kwargs
+        for chunk in self.chunks:
+            time.sleep(self.delay)
+            self.read += 1
+            yield AIMessageChunk(content=chunk)
+        if (kwargs.get('stream_options') or {}).get('include_usage'):
+            yield AIMessageChunk(content='', usage_metadata=USAGE)
+
+
+@pytest.fixture(autouse=True)
+def streaming(monkeypatch):
+    monkeypatch.setattr(sql_stream, 'SQL_STREAMING', True)
+    monkeypatch.setattr(sql_stream, 'SQL_STREAM_STOP_EARLY', False)
+
+
+def test_streamed_run_records_provider_usage(monkeypatch):
+    monkeypatch.setattr(prompt_layout, 'count_tokens', len)
+    prompt_layout.register_prompt('stream test', PROMPT, {'schema': 'teamlog'})
+    llm = FakeOpenAI()
+
+    message = generate_sql(PROMPT, llm, VALUES)
+    prompt_layout.check_prompt_call('stream test', VALUES, message)
+
+    assert llm.stream_kwargs == {'stream_options': {'include_usage': True}}
+    assert message.content == ''.join(ANSWER)
+    assert usage_counts(message, 1) == (1200, 30)
+    assert prompt_layout.prompt_layout_stats()['stream test']['input_tokens'] == 1200
+
+
+def test_stop_early_stops_at_the_closing_fence(monkeypatch):
+    monkeypatch.setattr(sql_stream, 'SQL_STREAM_STOP_EARLY', True)
+    llm = FakeOpenAI()
+
+    message = generate_sql(PROMPT, llm, VALUES)
+
+    # The fence is split over chunks; nothing after it is read
+    assert llm.read == 4
+    assert message.content.endswith('```\n')
+    assert message.usage_metadata is None
+
+
+def test_other_providers_are_not_sent_stream_options():
+    llm = FakeOpenAI()
+    llm.provider = 'anthropic'
+
+    generate_sql(PROMPT, llm, VALUES)
+    assert llm.stream_kwargs == {}
+
+
+def test_cancel_stops_at_next_chunk():
+    llm = FakeOpenAI(chunks=['SELECT '] * 50, delay=0.01)
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(message=generate_sql(PROMPT, llm, VALUES, owner='sid#1')))
+    thread.start()
+    time.sleep(0.1)
+
+    assert cancel_generation('sid#1') == 1
+    thread.join(2)
+    assert llm.read < 50
+    assert cancel_generation('sid#1') == 0
+
+
+def test_cancel_unknown_owner():
+    assert cancel_generation('nobody') == 0
+
+
+def test_streaming_off_invokes(monkeypatch):
+    monkeypatch.setattr(sql_stream, 'SQL_STREAMING', False)
+    llm = FakeOpenAI()
+
+    message = generate_sql(PROMPT, llm, VALUES)
+    assert llm.stream_kwargs is None
+    assert message.usage_metadata == USAGE
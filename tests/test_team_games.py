@@ -0,0 +1,54 @@
+import pytest
+
+from utils import schema, team_games
+from utils.schema import SchemaValidationError, register_metadata, table_columns, validate_sql
+from utils.team_games import computed_columns, register_team_games_columns
+
+
+TEAMLOG_METADATA = """
+Table: teamlog
+GameKey (TEXT): Unique game id.
+Team (TEXT): Team abbreviation.
+Opponent (TEXT): Opponent abbreviation.
+Score (BIGINT): Points scored by Team.
+OpponentScore (BIGINT): Points scored by Opponent.
+PointSpread (DOUBLE PRECISION): Team's spread.
+"""
+
+
+@pytest.fixture(autouse=True)
+def fresh_schema(monkeypatch):
+    monkeypatch.setattr(schema, '_tables', {})
+    register_metadata(TEAMLOG_METADATA)
+    register_metadata(team_games.team_games_metadata)
+
+
+def test_computed_columns_come_from_the_view():
+    assert computed_columns == ['CoverMargin', 'ATSResult', 'OpponentCoverMargin', 'OpponentATSResult']
+
+
+def test_columns_from_catalog(monkeypatch):
+    # A column added to teamlog after the view was created isn't in it
+    monkeypatch.setattr(team_games, '_run', lambda *statements: [('GameKey',), ('Team',), ('CoverMargin',)])
+
+    assert register_team_games_columns() == ['GameKey', 'Team', 'CoverMargin']
+    assert list(table_columns('teamgames')) == ['GameKey', 'Team', 'CoverMargin']
+    # Descriptions of columns it still has are kept
+    assert table_columns('teamgames')['CoverMargin'].startswith('CoverMargin (DOUBLE PRECISION)')
+
+    validate_sql('SELECT "Team", "CoverMargin" FROM teamgames;')
+    with pytest.raises(SchemaValidationError):
+        validate_sql('SELECT "Score" FROM teamgames;')
+
+
+def test_columns_from_view_definition_without_database(monkeypatch):
+    def unavailable(*statements):
+        raise ConnectionError('no database')
+    monkeypatch.setattr(team_games, '_run', unavailable)
+
+    columns = register_team_games_columns()
+
+    assert columns == ['GameKey', 'Team', 'Opponent', 'Score', 'OpponentScore', 'PointSpread'] + computed_columns
+    validate_sql('SELECT "Score", "ATSResult" FROM teamgames;')
+    with pytest.raises(SchemaValidationError):
+        validate_sql('SELECT "Wins" FROM teamgames;')
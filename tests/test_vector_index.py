@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from utils import vector_index
+from utils.vector_index import index_size, load_snapshot, query, set_index, sync_from_pinecone
+
+
+IDS = ['a', 'b', 'c']
+VECTORS = [[1.0, 0.0, 0.0], [0.6, 0.8, 0.0], [0.0, 0.0, 2.0]]
+METADATA = [{'question': f'question {i}', 'sql_query': f'SELECT {i};'} for i in IDS]
+
+
+class Index:
+    # The parts of a Pinecone index the sync uses: paged ids from list(), vectors from fetch()
+    def __init__(self, ids, vectors, metadata, page_size=2):
+        self.vectors = {i: SimpleNamespace(values=v, metadata=m) for i, v, m in zip(ids, vectors, metadata)}
+        self.page_size = page_size
+        self.fetches = 0
+
+    def list(self):
+        ids = list(self.vectors)
+        for start in range(0, len(ids), self.page_size):
+            yield ids[start:start + self.page_size]
+
+    def fetch(self, ids):
+        self.fetches += 1
+        return SimpleNamespace(vectors={i: self.vectors[i] for i in ids})
+
+
+@pytest.fixture(autouse=True)
+def empty_index(monkeypatch, tmp_path):
+    monkeypatch.setattr(vector_index, '_index', ([], np.zeros((0, 0), dtype=np.float32), []))
+    monkeypatch.setattr(vector_index, 'VECTOR_INDEX_SNAPSHOT', str(tmp_path / 'vector_index.npz'))
+
+
+def test_empty_index_has_no_matches():
+    assert index_size() == 0
+    assert query([1.0, 0.0, 0.0]) == []
+
+
+def test_top_k_best_first():
+    set_index(IDS, VECTORS, METADATA, 'test')
+
+    matches = query([1.0, 0.2, 0.0], top_k=2)
+    assert [match['id'] for match in matches] == ['a', 'b']
+    assert matches[0]['score'] > matches[1]['score']
+    assert matches[0]['metadata'] == METADATA[0]
+
+
+def test_scores_are_cosine_similarity():
+    set_index(IDS, VECTORS, METADATA, 'test')
+
+    # Unnormalized on both sides
+    match, = query([0.0, 0.0, 5.0])
+    assert match['id'] == 'c'
+    assert match['score'] == pytest.approx(1.0)
+
+
+def test_top_k_larger_than_index():
+    set_index(IDS, VECTORS, METADATA, 'test')
+
+    assert len(query([1.0, 0.0, 0.0], top_k=10)) == 3
+
+
+def test_sync_loads_every_page_and_writes_a_snapshot(monkeypatch):
+    monkeypatch.setattr(vector_index, 'FETCH_BATCH', 2)
+    index = Index(IDS, VECTORS, METADATA)
+
+    sync_from_pinecone(index)
+    assert index_size() == 3
+    assert index.fetches == 2
+    assert query([0.0, 1.0, 0.0])[0]['id'] == 'b'
+
+    # A restart serves from the snapshot before the first sync finishes
+    monkeypatch.setattr(vector_index, '_index', ([], np.zeros((0, 0), dtype=np.float32), []))
+    assert load_snapshot()
+    assert index_size() == 3
+    assert query([0.0, 1.0, 0.0])[0]['metadata'] == METADATA[1]
+
+
+def test_empty_sync_keeps_the_current_index():
+    set_index(IDS, VECTORS, METADATA, 'test')
+
+    with pytest.raises(ValueError):
+        sync_from_pinecone(Index([], [], []))
+    assert index_size() == 3
+
+
+def test_missing_snapshot():
+    assert not load_snapshot()
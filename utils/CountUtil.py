@@ -1,8 +1,34 @@
+import os
+from functools import lru_cache
+
 import tiktoken
 
 
+# Blended gpt-4o list prices, dollars per million tokens
+INPUT_COST_PER_MILLION = float(os.getenv('INPUT_COST_PER_MILLION', 3.50))
+OUTPUT_COST_PER_MILLION = float(os.getenv('OUTPUT_COST_PER_MILLION', 15))
+
+
+@lru_cache(maxsize=None)
+def _encoding(name="o200k_base"):
+    return tiktoken.get_encoding(name)
+
 
 def count_tokens(string: str) -> int:
-    encoding = tiktoken.get_encoding("o200k_base")
-    num_tokens = len(encoding.encode(string))
+    num_tokens = len(_encoding().encode(string))
     return num_tokens
+
+
+def usage_counts(message, input_estimate, output_estimate=None):
+    # Exact counts from the provider when the response carries them, our own estimate otherwise
+    usage = getattr(message, 'usage_metadata', None)
+    if usage and usage.get('input_tokens') is not None:
+        return usage['input_tokens'], usage['output_tokens']
+
+    if output_estimate is None:
+        output_estimate = count_tokens(message.content)
+    return input_estimate, output_estimate
+
+
+def estimate_cost(input_tokens, output_tokens):
+    return input_tokens * (INPUT_COST_PER_MILLION / 1000000) + output_tokens * (OUTPUT_COST_PER_MILLION / 1000000)
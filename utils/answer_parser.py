@@ -10,6 +10,9 @@ import time
 from langchain_anthropic import ChatAnthropic
 import re
 import dotenv
+from utils.CountUtil import count_tokens
+from utils.llm_clients import get_llm
+from utils.model_tiers import stage_call, stage_model
 
 dotenv.load_dotenv()
 
@@ -85,19 +88,32 @@ Format the response to be clean, clear, and visually appealing for a chat interf
 billy_prompt = PromptTemplate.from_template(prompt_template)
 
 
-def get_answer(model, question, query, sql_response):
+# Tokens in the prompt around the question, query and result
+static_input_tokens = count_tokens(prompt_template)
+
+
+def get_answer(model, question, query, sql_response, usage=None, tier=0):
+    # If a usage dict is passed, it is filled with the provider's token counts once the stream ends
     start = time.time()
 
     llm = None
     if model == 'openai':
-        llm = ChatOpenAI(model='gpt-4o')
+        # Makes the last chunk carry the token usage for the whole completion
+        llm = get_llm('openai', stage_model('answer', tier)).bind(stream_options={'include_usage': True})
     elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-opus-20240229')
+        llm = get_llm('anthropic', 'claude-3-opus-20240229')
 
     llm_chain = billy_prompt | llm
 
     # This will act as a generator
-    for s in llm_chain.stream(
-            {'user_question': question, "sql_query": query, "result": sql_response}):
-        print(s.content)
-        yield s.content  # Keep yielding parts of the response
+    with stage_call('answer', tier):
+        for s in llm_chain.stream(
+                {'user_question': question, "sql_query": query, "result": sql_response}):
+            chunk_usage = getattr(s, 'usage_metadata', None)
+            if usage is not None and chunk_usage:
+                usage['input_tokens'] = usage.get('input_tokens', 0) + chunk_usage['input_tokens']
+                usage['output_tokens'] = usage.get('output_tokens', 0) + chunk_usage['output_tokens']
+            if not s.content:
+                continue
+            print(s.content)
+            yield s.content  # Keep yielding parts of the response
@@ -0,0 +1,222 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import dotenv
+import numpy as np
+
+from utils.cache import get_embeddings
+
+dotenv.load_dotenv()
+
+
+# kNN over labeled question embeddings, tried before the GPT-4 router. Only confident
+# answers are used; everything else still goes through question_chooser.
+
+BUCKET_CLASSIFIER_ENABLED = os.getenv('BUCKET_CLASSIFIER_ENABLED', 'true').lower() == 'true'
+
+# JSONL of {"question": ..., "bucket": ...}; a seed set ships with the repo and
+# `python -m utils.bucket_classifier build` regenerates it from answered questions
+BUCKET_CLASSIFIER_EXAMPLES = os.getenv('BUCKET_CLASSIFIER_EXAMPLES', 'bucket_examples.jsonl')
+
+BUCKET_CLASSIFIER_K = int(os.getenv('BUCKET_CLASSIFIER_K', 7))
+
+# Share of the neighbours' similarity that has to agree on one bucket
+BUCKET_CLASSIFIER_THRESHOLD = float(os.getenv('BUCKET_CLASSIFIER_THRESHOLD', 0.8))
+
+# The nearest example has to be at least this close, or the question is unlike anything labeled
+BUCKET_CLASSIFIER_MIN_SIMILARITY = float(os.getenv('BUCKET_CLASSIFIER_MIN_SIMILARITY', 0.6))
+
+# Conversation and NoBucket need the router's written reply, so they are never decided here
+FAST_PATH_BUCKETS = {
+    'TeamGameLog', 'PlayerGameLog', 'PlayByPlay', 'TeamAndPlayerLog', 'Props',
+    'PlayerLogAndProps', 'TeamLogAndProps', 'Futures', 'ExpertAnalysis',
+}
+
+
+# The router also rewrites the question it routes: it fills in the date for today or tonight
+# and works out who a pronoun refers to. A message that needs that is left to the router,
+# since on the fast path the question is used as typed.
+_NEEDS_REWRITE = re.compile(
+    r"\b(today|tonight|tomorrow|yesterday|he|she|him|her|his|hers|they|them|their|theirs|it|its)\b", re.IGNORECASE)
+
+
+_lock = threading.Lock()
+# Held while the examples load, so concurrent first messages embed them only once
+_load_lock = threading.Lock()
+_loaded = False
+
+# (labels, normalized matrix)
+_examples = ([], np.zeros((0, 0), dtype=np.float32))
+
+_stats = {
+    'classified': 0,
+    'fast_path': 0,
+    'low_confidence': 0,
+    'skipped': 0,
+    'buckets': {},
+    'ms': 0.0,
+}
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def load_examples(path=None):
+    global _examples, _loaded
+    path = path or BUCKET_CLASSIFIER_EXAMPLES
+
+    questions = []
+    labels = []
+    if not path or not os.path.exists(path):
+        print(f'Warning: bucket classifier examples not found at {path}, every question goes to the router')
+    else:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                example = json.loads(line)
+                if example.get('bucket') in FAST_PATH_BUCKETS and example.get('question'):
+                    questions.append(example['question'])
+                    labels.append(example['bucket'])
+
+    matrix = np.zeros((0, 0), dtype=np.float32)
+    if questions:
+        # Goes through the embedding cache, so restarts don't re-embed the whole file
+        matrix = _normalize(np.asarray(get_embeddings(questions), dtype=np.float32))
+
+    with _lock:
+        _examples = (labels, matrix)
+        _loaded = True
+    print(f'Bucket classifier loaded {len(labels)} examples from {path}')
+
+
+def _ensure_loaded():
+    global _loaded
+    if _loaded:
+        return
+    with _load_lock:
+        if _loaded:
+            return
+        try:
+            load_examples()
+        except Exception as e:
+            # Don't retry on every message; the router handles everything until a restart
+            print(f'Could not load bucket classifier examples: {e}')
+            _loaded = True
+
+
+def _needs_router(question):
+    # A message carrying chat history, or one the router would rewrite
+    return '\n' in question.strip() or bool(_NEEDS_REWRITE.search(question))
+
+
+def classifier_ready(question):
+    # Whether classify_question can use an embedding for this message; if not, don't pay for one
+    if not BUCKET_CLASSIFIER_ENABLED or not question or _needs_router(question):
+        return False
+    _ensure_loaded()
+    return bool(_examples[0])
+
+
+def classify(embedding):
+    # Returns (bucket, confidence); bucket is None when the router should decide
+    labels, matrix = _examples
+    if not labels:
+        return None, 0.0
+
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    scores = matrix @ (vector / norm if norm else vector)
+
+    k = min(BUCKET_CLASSIFIER_K, len(labels))
+    nearest = np.argpartition(-scores, k - 1)[:k]
+    if scores[nearest].max() < BUCKET_CLASSIFIER_MIN_SIMILARITY:
+        return None, 0.0
+
+    votes = {}
+    for i in nearest:
+        votes[labels[i]] = votes.get(labels[i], 0.0) + max(float(scores[i]), 0.0)
+    total = sum(votes.values())
+    if not total:
+        return None, 0.0
+
+    bucket = max(votes, key=votes.get)
+    return bucket, votes[bucket] / total
+
+
+def classify_question(question, embedding):
+    # Only single questions that can be used as typed
+    if not BUCKET_CLASSIFIER_ENABLED or embedding is None or _needs_router(question):
+        with _lock:
+            _stats['skipped'] += 1
+        return None, 0.0
+
+    _ensure_loaded()
+
+    start = time.perf_counter()
+    bucket, confidence = classify(embedding)
+
+    with _lock:
+        _stats['classified'] += 1
+        _stats['ms'] += (time.perf_counter() - start) * 1000
+        if bucket is None or confidence < BUCKET_CLASSIFIER_THRESHOLD:
+            _stats['low_confidence'] += 1
+        else:
+            _stats['fast_path'] += 1
+            _stats['buckets'][bucket] = _stats['buckets'].get(bucket, 0) + 1
+
+    if bucket is None or confidence < BUCKET_CLASSIFIER_THRESHOLD:
+        return None, confidence
+    return bucket, confidence
+
+
+def bucket_classifier_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['buckets'] = dict(_stats['buckets'])
+        stats['examples'] = len(_examples[0])
+
+    stats['enabled'] = BUCKET_CLASSIFIER_ENABLED
+    stats['threshold'] = BUCKET_CLASSIFIER_THRESHOLD
+    stats['fast_path_rate'] = stats['fast_path'] / stats['classified'] if stats['classified'] else 0.0
+    stats['avg_ms'] = stats['ms'] / stats['classified'] if stats['classified'] else 0.0
+    return stats
+
+
+def build_examples(path=None, limit=5000):
+    # Labels from questions the router already sent to a bucket, one entry per question
+    from supabase import create_client
+
+    from utils.embedding_cache import normalize_text
+
+    path = path or BUCKET_CLASSIFIER_EXAMPLES
+    supabase = create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'))
+    rows = supabase.table('billy_answers').select('question, bucket').limit(limit).execute().data
+
+    seen = set()
+    examples = []
+    for row in rows:
+        question = (row.get('question') or '').strip()
+        key = normalize_text(question)
+        if row.get('bucket') in FAST_PATH_BUCKETS and question and key not in seen:
+            seen.add(key)
+            examples.append({'question': question, 'bucket': row['bucket']})
+
+    with open(path, 'w') as f:
+        for example in examples:
+            f.write(json.dumps(example) + '\n')
+    print(f'Wrote {len(examples)} bucket examples to {path}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'build':
+        build_examples(*sys.argv[2:3])
+    else:
+        print('usage: python -m utils.bucket_classifier build [path]')
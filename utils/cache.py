@@ -1,41 +1,69 @@
 import os
+from functools import lru_cache
+
 import dotenv
 from pinecone import Pinecone, ServerlessSpec
 import pinecone
 from openai import OpenAI
 import time
+from utils.embedding_cache import cached_embeddings
+from utils.vector_index import index_size, start_vector_index
+from utils.vector_index import query as query_local
 
 dotenv.load_dotenv()
 
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
-
 index_name = "billybets"
 
-index = pc.Index(index_name)
+
+# Made on first use: opening the Pinecone index is a network call, which shouldn't happen
+# just because a module that may need an embedding was imported
+@lru_cache(maxsize=None)
+def _client():
+    return OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+
+@lru_cache(maxsize=None)
+def _index():
+    return Pinecone(api_key=os.getenv('PINECONE_API_KEY')).Index(index_name)
+
+
+def _embed(texts, model):
+    response = _client().embeddings.create(input=texts, model=model)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def get_embeddings(texts, model="text-embedding-3-large"):
+    return cached_embeddings(texts, model, lambda missing: _embed(missing, model))
 
 
 def get_embedding(text, model="text-embedding-3-large"):
-    text = text.replace("\n", " ")
-    return client.embeddings.create(input=[text], model=model).data[0].embedding
+    return get_embeddings([text], model)[0]
+
+
+def _query_matches(query_embedding, top_k):
+    # The local mirror answers in well under a millisecond; Pinecone is the fallback
+    # until the first snapshot or sync has loaded, or if the mirror is switched off
+    if index_size():
+        return query_local(query_embedding, top_k)
+
+    try:
+        results = _index().query(
+            vector=query_embedding, top_k=top_k, include_metadata=True)
+    except Exception as e:
+        print(f'Pinecone query failed: {e}')
+        return []
+    return results['matches']
 
 
-def get_closest_embedding(question, model="text-embedding-3-large", top_k=1):
-    # Get the embedding for the input question
-    query_embedding = get_embedding(question, model)
+def get_closest_match(question, model="text-embedding-3-large", top_k=1, embedding=None):
+    # Callers that already embedded the question pass it in, so it is only embedded once
+    query_embedding = embedding if embedding is not None else get_embedding(question, model)
 
-    # Query Pinecone for the closest match
-    results = index.query(
-        vector=query_embedding , top_k=top_k, include_metadata=True)
-    
-    print('results')
-    
-    print(results)
-    
+    matches = _query_matches(query_embedding, top_k)
 
     # Retrieve the most relevant result's metadata (which contains the SQL query and question)
-    if results['matches']:
-        closest_match = results['matches'][0]
+    if matches:
+        closest_match = matches[0]
         matched_question = closest_match['metadata']['question']
         matched_sql_query = closest_match['metadata']['sql_query']
         score = closest_match['score']
@@ -44,26 +72,33 @@ def get_closest_embedding(question, model="text-embedding-3-large", top_k=1):
         print(f"SQL Query: {matched_sql_query}")
         print(f"Similarity Score: {score}")
 
-        return matched_question, matched_sql_query
+        return matched_question, matched_sql_query, score
     else:
         print("No relevant embeddings found.")
         default_sql_query = """
         SELECT
-            SUM(CASE WHEN "Score" > "OpponentScore" THEN 1 ELSE 0 END) AS Wins,
-            SUM(CASE WHEN "Score" < "OpponentScore" THEN 1 ELSE 0 END) AS Losses
-        FROM (
-            SELECT DISTINCT ON ("GameKey")
-                "GameKey", "Team", "Score", "OpponentScore", "PointSpread"
-            FROM teamlog
-            WHERE "Team" = 'Any Team'
-                AND ABS("PointSpread") <= 3
-                AND "SeasonType" = 1
-        ) AS unique_games;
+            SUM(CASE WHEN ("Team" = 'Any Team' AND "Score" > "OpponentScore")
+                       OR ("Opponent" = 'Any Team' AND "OpponentScore" > "Score") THEN 1 ELSE 0 END) AS Wins,
+            SUM(CASE WHEN ("Team" = 'Any Team' AND "Score" < "OpponentScore")
+                       OR ("Opponent" = 'Any Team' AND "OpponentScore" < "Score") THEN 1 ELSE 0 END) AS Losses
+        FROM teamgames
+        WHERE ("Team" = 'Any Team' OR "Opponent" = 'Any Team')
+            AND ABS("PointSpread") <= 3
+            AND "SeasonType" = 1;
 
         """
 
         default_question = "What is the win-loss record for TeamName games where the spread closes at 3 points or fewer?"
 
-        return default_question, default_sql_query
+        return default_question, default_sql_query, 0.0
+
+
+def get_closest_embedding(question, model="text-embedding-3-large", top_k=1, embedding=None):
+    matched_question, matched_sql_query, score = get_closest_match(question, model, top_k, embedding)
+    return matched_question, matched_sql_query
+
+
+def start_example_index():
+    start_vector_index(_index())
 
 
@@ -0,0 +1,40 @@
+import os
+import threading
+import time
+
+import dotenv
+
+dotenv.load_dotenv()
+
+
+# Bumped by the ingestion job (POST /data-version) whenever new weeks are loaded.
+# Anything cached against database contents is keyed on it.
+_version = os.getenv('DATA_VERSION', str(int(time.time())))
+_lock = threading.Lock()
+_listeners = []
+
+
+def get_data_version():
+    return _version
+
+
+def bump_data_version(version=None):
+    global _version
+    with _lock:
+        _version = str(version) if version is not None else str(int(time.time() * 1000))
+        listeners = list(_listeners)
+
+    print(f'Data version is now {_version}')
+    for listener in listeners:
+        try:
+            listener(_version)
+        except Exception as e:
+            print(f'Error in data version listener: {e}')
+
+    return _version
+
+
+def on_data_version_change(listener):
+    with _lock:
+        _listeners.append(listener)
+    return listener
@@ -0,0 +1,277 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import dotenv
+import psycopg2
+from psycopg2 import errors, extensions, pool
+
+from utils.percentile import percentile
+
+dotenv.load_dotenv()
+
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# Read-only DSNs for the analytical queries, comma separated; defaults to DATABASE_URL
+DATABASE_READ_URLS = [dsn.strip() for dsn in os.getenv('DATABASE_READ_URLS', '').split(',') if dsn.strip()]
+
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+
+# How long (seconds) a caller waits for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+
+# Connections that sat idle longer than this (seconds) are pinged before being handed out
+DB_POOL_HEALTHCHECK_AFTER = float(os.getenv('DB_POOL_HEALTHCHECK_AFTER', 30))
+
+# A replica is taken out of rotation after this many consecutive connection failures,
+# and is tried again after REPLICA_RETRY_AFTER seconds
+REPLICA_MAX_FAILURES = int(os.getenv('REPLICA_MAX_FAILURES', 3))
+REPLICA_RETRY_AFTER = float(os.getenv('REPLICA_RETRY_AFTER', 30))
+
+LATENCY_WINDOW = 200
+
+
+class PoolTimeout(Exception):
+    # The replica is busy, not broken: back-pressure for the caller, never a reason to eject it
+    pass
+
+
+class NoHealthyReplica(Exception):
+    pass
+
+
+class Replica:
+
+    def __init__(self, name, dsn):
+        self.name = name
+        self.dsn = dsn
+
+        self.pool = None
+        # The psycopg2 pool raises instead of blocking when it is exhausted, so the
+        # semaphore is what makes callers queue up for a connection.
+        self.slots = threading.BoundedSemaphore(DB_POOL_MAX)
+        self.last_used = {}
+
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+        self.stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'failures': 0,
+            'ejections': 0,
+            'wait_total_ms': 0.0,
+            'wait_max_ms': 0.0,
+            'health_check_failures': 0,
+            'discarded': 0,
+        }
+
+    def get_pool(self):
+        if self.pool is None:
+            with _lock:
+                if self.pool is None:
+                    self.pool = pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, self.dsn)
+        return self.pool
+
+    def is_available(self, now):
+        return now >= self.ejected_until
+
+
+def _replica_name(index, dsn):
+    # Host and port only, the DSN itself carries credentials
+    try:
+        parsed = urlparse(dsn)
+        if parsed.hostname:
+            return f'{parsed.hostname}:{parsed.port or 5432}'
+    except ValueError:
+        pass
+    return f'replica-{index}'
+
+
+_lock = threading.RLock()
+_replicas = [Replica(_replica_name(i, dsn), dsn)
+             for i, dsn in enumerate(DATABASE_READ_URLS or [DATABASE_URL])]
+
+
+def choose_replica():
+    # Least outstanding queries first, lowest recent latency breaks ties
+    now = time.monotonic()
+    with _lock:
+        candidates = [replica for replica in _replicas if replica.is_available(now)]
+        if not candidates:
+            # Everything is ejected; try the one that has been out the longest
+            candidates = sorted(_replicas, key=lambda replica: replica.ejected_until)[:1]
+        if not candidates:
+            raise NoHealthyReplica('No database configured')
+
+        replica = min(candidates, key=lambda replica: (replica.outstanding, _p50(replica)))
+        replica.outstanding += 1
+        return replica
+
+
+def replica_finished(replica, ok, elapsed_ms=None):
+    # ok=None says nothing about the replica's health, e.g. a wait for a free connection timed out
+    with _lock:
+        replica.outstanding -= 1
+        if ok is None:
+            return
+        if ok:
+            replica.consecutive_failures = 0
+            replica.ejected_until = 0.0
+            if elapsed_ms is not None:
+                replica.latencies.append(elapsed_ms)
+            return
+
+        replica.stats['failures'] += 1
+        replica.consecutive_failures += 1
+        if replica.consecutive_failures >= REPLICA_MAX_FAILURES:
+            if replica.ejected_until <= time.monotonic():
+                replica.stats['ejections'] += 1
+                print(f'Taking replica {replica.name} out of rotation for {REPLICA_RETRY_AFTER}s')
+            replica.ejected_until = time.monotonic() + REPLICA_RETRY_AFTER
+
+
+def _p50(replica):
+    return percentile(replica.latencies, 0.5)
+
+
+def _is_healthy(replica, conn):
+    if conn.closed:
+        return False
+
+    last_used = replica.last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_POOL_HEALTHCHECK_AFTER:
+        return True
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error as e:
+        print(f'Pool health check failed on {replica.name}: {e}')
+        return False
+
+
+def _checkout(replica):
+    db_pool = replica.get_pool()
+    conn = db_pool.getconn()
+
+    if not _is_healthy(replica, conn):
+        with _lock:
+            replica.stats['health_check_failures'] += 1
+        db_pool.putconn(conn, close=True)
+        conn = db_pool.getconn()
+
+    return conn
+
+
+def _return(replica, conn):
+    db_pool = replica.get_pool()
+    close = bool(conn.closed)
+
+    if not close and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            close = True
+
+    if close:
+        replica.last_used.pop(id(conn), None)
+        with _lock:
+            replica.stats['discarded'] += 1
+    else:
+        replica.last_used[id(conn)] = time.monotonic()
+
+    db_pool.putconn(conn, close=close)
+
+
+def is_connection_failure(error):
+    # Errors that say something about the replica, as opposed to the query
+    if isinstance(error, errors.QueryCanceled):
+        return False
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+@contextmanager
+def get_connection():
+    replica = choose_replica()
+    ok = True
+    elapsed_ms = None
+
+    try:
+        start = time.perf_counter()
+        if not replica.slots.acquire(timeout=DB_POOL_TIMEOUT):
+            with _lock:
+                replica.stats['timeouts'] += 1
+            raise PoolTimeout(f'No database connection available on {replica.name} after {DB_POOL_TIMEOUT}s')
+
+        waited_ms = (time.perf_counter() - start) * 1000
+        with _lock:
+            replica.stats['checkouts'] += 1
+            replica.stats['wait_total_ms'] += waited_ms
+            replica.stats['wait_max_ms'] = max(replica.stats['wait_max_ms'], waited_ms)
+
+        conn = None
+        try:
+            conn = _checkout(replica)
+            used_at = time.perf_counter()
+            yield conn
+            elapsed_ms = (time.perf_counter() - used_at) * 1000
+        finally:
+            if conn is not None:
+                _return(replica, conn)
+            replica.slots.release()
+    except BaseException as e:
+        ok = None if isinstance(e, PoolTimeout) else not is_connection_failure(e)
+        raise
+    finally:
+        replica_finished(replica, ok, elapsed_ms)
+
+
+def replica_stats(replica):
+    with _lock:
+        stats = dict(replica.stats)
+        latencies = list(replica.latencies)
+        stats['outstanding'] = replica.outstanding
+        stats['healthy'] = replica.is_available(time.monotonic())
+        stats['consecutive_failures'] = replica.consecutive_failures
+
+    stats['name'] = replica.name
+    stats['wait_avg_ms'] = stats['wait_total_ms'] / stats['checkouts'] if stats['checkouts'] else 0.0
+    stats['latency_p50_ms'] = percentile(latencies, 0.5)
+    stats['latency_p95_ms'] = percentile(latencies, 0.95)
+    return stats
+
+
+def pool_stats():
+    replicas = [replica_stats(replica) for replica in _replicas]
+
+    stats = {
+        'min_size': DB_POOL_MIN,
+        'max_size': DB_POOL_MAX,
+        'in_use': sum(replica['outstanding'] for replica in replicas),
+        'checkouts': sum(replica['checkouts'] for replica in replicas),
+        'timeouts': sum(replica['timeouts'] for replica in replicas),
+        'wait_total_ms': sum(replica['wait_total_ms'] for replica in replicas),
+        'wait_max_ms': max((replica['wait_max_ms'] for replica in replicas), default=0.0),
+        'replicas': replicas,
+    }
+    stats['wait_avg_ms'] = stats['wait_total_ms'] / stats['checkouts'] if stats['checkouts'] else 0.0
+    return stats
+
+
+def close_pool():
+    with _lock:
+        for replica in _replicas:
+            if replica.pool is not None:
+                replica.pool.closeall()
+                replica.pool = None
+                replica.last_used.clear()
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import dotenv
+import numpy as np
+
+from utils.lru import LRUCache
+
+dotenv.load_dotenv()
+
+
+EMBEDDING_CACHE_ENABLED = os.getenv('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true'
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', 5000))
+
+# SQLite file backing the in-memory LRU, so embeddings survive restarts; empty disables it
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', 'embedding_cache.sqlite3')
+
+
+_whitespace = re.compile(r'\s+')
+_trailing_punctuation = re.compile(r'[\s?!.]+$')
+
+
+def normalize_text(text):
+    # "How many yards does Saquon have?" and "how many yards does saquon have" share an entry
+    text = _whitespace.sub(' ', text).strip()
+    return _trailing_punctuation.sub('', text).casefold()
+
+
+def embedding_key(text, model):
+    return hashlib.sha256(f'{model}\0{normalize_text(text)}'.encode('utf-8')).hexdigest()
+
+
+_memory = LRUCache(EMBEDDING_CACHE_MAX_ENTRIES, sizeof=lambda vector: vector.nbytes)
+
+_lock = threading.Lock()
+_db = None
+
+_stats = {
+    'disk_hits': 0,
+    'api_calls': 0,
+    'api_texts': 0,
+    'api_ms': 0.0,
+}
+
+
+def _get_db():
+    global _db
+    if not EMBEDDING_CACHE_PATH:
+        return None
+
+    if _db is None:
+        _db = sqlite3.connect(EMBEDDING_CACHE_PATH, check_same_thread=False)
+        _db.execute('PRAGMA journal_mode=WAL')
+        _db.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                dims INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                created REAL NOT NULL
+            )
+        """)
+        _db.commit()
+    return _db
+
+
+def _load(key):
+    with _lock:
+        try:
+            db = _get_db()
+            if db is None:
+                return None
+            row = db.execute('SELECT vector FROM embeddings WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            print(f'Embedding cache read failed: {e}')
+            return None
+
+        if row is None:
+            return None
+        _stats['disk_hits'] += 1
+    return np.frombuffer(row[0], dtype=np.float32)
+
+
+def _save(items):
+    with _lock:
+        try:
+            db = _get_db()
+            if db is None:
+                return
+            db.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, model, dims, vector, created) VALUES (?, ?, ?, ?, ?)',
+                [(key, model, len(vector), vector.tobytes(), time.time()) for key, model, vector in items])
+            db.commit()
+        except sqlite3.Error as e:
+            print(f'Embedding cache write failed: {e}')
+
+
+def get_cached_embedding(text, model):
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+
+    key = embedding_key(text, model)
+    vector = _memory.get(key)
+    if vector is None:
+        vector = _load(key)
+        if vector is not None:
+            _memory.set(key, vector)
+    return vector
+
+
+def store_embeddings(texts, model, vectors):
+    if not EMBEDDING_CACHE_ENABLED:
+        return
+
+    items = []
+    for text, vector in zip(texts, vectors):
+        key = embedding_key(text, model)
+        vector = np.asarray(vector, dtype=np.float32)
+        _memory.set(key, vector)
+        items.append((key, model, vector))
+    _save(items)
+
+
+def cached_embeddings(texts, model, embed):
+    # embed(texts) is only called with the texts missing from both tiers, in one batch
+    vectors = [get_cached_embedding(text, model) for text in texts]
+
+    missing = {}
+    for text, vector in zip(texts, vectors):
+        if vector is None:
+            missing.setdefault(normalize_text(text), text)
+
+    if missing:
+        start = time.perf_counter()
+        # The API gets the text as typed; the normalized form is only the cache key
+        fresh = embed(list(missing.values()))
+        with _lock:
+            _stats['api_calls'] += 1
+            _stats['api_texts'] += len(missing)
+            _stats['api_ms'] += (time.perf_counter() - start) * 1000
+
+        fresh = [np.asarray(vector, dtype=np.float32) for vector in fresh]
+        store_embeddings(list(missing.values()), model, fresh)
+        by_text = dict(zip(missing, fresh))
+        vectors = [vector if vector is not None else by_text[normalize_text(text)]
+                   for text, vector in zip(texts, vectors)]
+
+    return [vector.tolist() for vector in vectors]
+
+
+def embedding_cache_stats():
+    stats = _memory.stats()
+    with _lock:
+        stats.update(_stats)
+    stats['enabled'] = EMBEDDING_CACHE_ENABLED
+    stats['disk'] = bool(EMBEDDING_CACHE_PATH)
+    return stats
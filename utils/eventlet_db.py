@@ -0,0 +1,33 @@
+import threading
+
+
+# The Socket.IO handler runs under gunicorn's eventlet worker (see the Procfile), where a
+# running psycopg2 query blocks the whole hub: no other client is served, and nothing else
+# (the disconnect handler that cancels the query, parallel SQL candidates) runs until it
+# returns. psycogreen makes psycopg2 wait on its socket cooperatively instead, so database
+# time is spent in a green thread like any other I/O.
+
+_lock = threading.Lock()
+_state = {'patched': False}
+
+
+def patch_for_eventlet():
+    # Only when eventlet has monkey patched sockets, i.e. running under the eventlet worker
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    if not patcher.is_monkey_patched('socket'):
+        return False
+
+    from psycogreen.eventlet import patch_psycopg
+    patch_psycopg()
+    with _lock:
+        _state['patched'] = True
+    print('psycopg2 patched for eventlet')
+    return True
+
+
+def eventlet_db_stats():
+    with _lock:
+        return dict(_state)
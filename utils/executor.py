@@ -1,19 +1,177 @@
 import re
 import dotenv
+import json
 import os
 import psycopg2
+import threading
+from contextlib import contextmanager
+from psycopg2 import errors
 
 from langchain.agents import initialize_agent, AgentExecutor
 from langchain.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
 import time
 from langchain_anthropic import ChatAnthropic
+from utils.db_pool import PoolTimeout, get_connection, is_connection_failure
+from utils.CountUtil import count_tokens
+from utils.result_cache import get_cached_result, store_result
+from utils.sql_repair import classify_error, local_fix
+from utils.schema import columns_for_bucket, validate_sql, SchemaValidationError
+from utils.llm_clients import get_llm
+from utils.model_tiers import repair_tier, stage_call, stage_model
+import uuid
 
 dotenv.load_dotenv()
 
 
+# Results bigger than this are not worth sending to the answer model
+RESULT_TOKEN_BUDGET = int(os.getenv('RESULT_TOKEN_BUDGET', 5000))
+RESULT_ROW_BUDGET = int(os.getenv('RESULT_ROW_BUDGET', 2000))
 
-DATABASE_URL = os.getenv('DATABASE_URL')
+# Attempts per question, counting the first run; every failed attempt but the last gets a repair round
+MAX_QUERY_ATTEMPTS = int(os.getenv('MAX_QUERY_ATTEMPTS', 5))
+
+FETCH_BATCH_SIZE = int(os.getenv('FETCH_BATCH_SIZE', 100))
+SERVER_SIDE_CURSORS = os.getenv('SERVER_SIDE_CURSORS', 'true').lower() == 'true'
+
+# Check generated SQL against the bucket schemas before it reaches the database
+SQL_VALIDATION = os.getenv('SQL_VALIDATION', 'true').lower() == 'true'
+
+
+# Optional EXPLAIN (no ANALYZE) before running a query, to catch queries that are too slow or too big
+EXPLAIN_GATE = os.getenv('EXPLAIN_GATE', 'false').lower() == 'true'
+EXPLAIN_MAX_COST = float(os.getenv('EXPLAIN_MAX_COST', 1000000))
+EXPLAIN_MAX_ROWS = int(os.getenv('EXPLAIN_MAX_ROWS', 5000))
+# What to do when the planner expects too many rows: expert, limit or reject
+EXPLAIN_OVERSIZE_ACTION = os.getenv('EXPLAIN_OVERSIZE_ACTION', 'expert').lower()
+EXPLAIN_LIMIT_ROWS = int(os.getenv('EXPLAIN_LIMIT_ROWS', 200))
+# Rough characters per token when turning the planner's row width into tokens
+CHARS_PER_TOKEN = 4
+
+
+# Statement timeouts (ms) for generated SQL; the heavier buckets get more room
+STATEMENT_TIMEOUT_MS = int(os.getenv('STATEMENT_TIMEOUT_MS', 10000))
+BUCKET_STATEMENT_TIMEOUTS_MS = {
+    'PlayByPlay': int(os.getenv('PLAYBYPLAY_STATEMENT_TIMEOUT_MS', 20000)),
+    'TeamAndPlayerLog': int(os.getenv('JOINED_STATEMENT_TIMEOUT_MS', 15000)),
+    'PlayerLogAndProps': int(os.getenv('JOINED_STATEMENT_TIMEOUT_MS', 15000)),
+    'TeamLogAndProps': int(os.getenv('JOINED_STATEMENT_TIMEOUT_MS', 15000)),
+}
+
+
+class ResultTooLarge(Exception):
+    pass
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+class QueryTooExpensive(Exception):
+    pass
+
+
+# Connections currently running a query, by owner (the socket session id)
+_active_lock = threading.Lock()
+_active_connections = {}
+_busy_owners = {}
+_cancelled_owners = set()
+
+_repair_lock = threading.Lock()
+_repair_stats = {
+    'queries': 0,
+    'repaired': 0,
+    'failed': 0,
+    'rounds': 0,
+    'local_fixes': 0,
+    'llm_fixes': 0,
+    'rejected_before_execution': 0,
+    'repair_ms': 0.0,
+}
+
+_explain_lock = threading.Lock()
+_explain_stats = {
+    'explained': 0,
+    'too_expensive': 0,
+    'oversized': 0,
+    'limited': 0,
+    'sent_to_expert': 0,
+}
+
+
+def statement_timeout_for(bucket):
+    return BUCKET_STATEMENT_TIMEOUTS_MS.get(bucket, STATEMENT_TIMEOUT_MS)
+
+
+@contextmanager
+def read_only_transaction(conn, timeout_ms):
+    # Both settings are transaction scoped, so they are gone once the pool rolls the connection back
+    with conn.cursor() as cur:
+        cur.execute('SET TRANSACTION READ ONLY')
+        cur.execute('SET LOCAL statement_timeout = %s', (timeout_ms,))
+    yield conn
+
+
+@contextmanager
+def owner_request(owner):
+    # Spans the whole repair loop so a cancel between attempts is not lost
+    with _active_lock:
+        _busy_owners[owner] = _busy_owners.get(owner, 0) + 1
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _busy_owners[owner] -= 1
+            if not _busy_owners[owner]:
+                del _busy_owners[owner]
+                _cancelled_owners.discard(owner)
+
+
+@contextmanager
+def track_query(conn, owner):
+    if owner is None:
+        yield
+        return
+
+    with _active_lock:
+        if owner in _cancelled_owners:
+            raise QueryCancelled(f'Queries for {owner} were cancelled')
+        _active_connections.setdefault(owner, set()).add(conn)
+    try:
+        yield
+    finally:
+        with _active_lock:
+            conns = _active_connections.get(owner)
+            if conns is not None:
+                conns.discard(conn)
+                if not conns:
+                    del _active_connections[owner]
+
+
+def cancel_queries(owner):
+    # Ask the server to stop whatever this owner is running, e.g. when its socket disconnects
+    with _active_lock:
+        if owner not in _busy_owners:
+            return 0
+        _cancelled_owners.add(owner)
+        conns = list(_active_connections.get(owner, ()))
+
+    for conn in conns:
+        try:
+            conn.cancel()
+        except psycopg2.Error as e:
+            print(f'Could not cancel query for {owner}: {e}')
+
+    return len(conns)
+
+
+def was_cancelled(owner):
+    with _active_lock:
+        return owner in _cancelled_owners
 
 
 prompt_template = """
@@ -29,54 +187,231 @@ Give me the fixed query to run. Do not include any other information, I want to
 
 """
 
-prompt_template = PromptTemplate.from_template(prompt_template)
+cheaper_query_message = """{reason} The syntax is fine, the query is too expensive.
+Rewrite it so it does less work: filter on Season, SeasonType, Week, Team or Name as early as possible, avoid scanning all of playbyplay, avoid unnecessary joins, subqueries and DISTINCT over whole tables, and only select the columns that are needed."""
 
-def new_sql_query(old_query, error_message, model):
+prompt_template = PromptTemplate.from_template(prompt_template)
 
+def _repair_chain(model, tier=0):
     llm = None
     if model == 'openai':
-        llm = ChatOpenAI(model='gpt-4o')
+        llm = get_llm('openai', stage_model('repair', tier))
 
     elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-5-sonnet-20240620')
+        llm = get_llm('anthropic', 'claude-3-5-sonnet-20240620')
+
+    return prompt_template | llm
+
 
-    llm_chain = prompt_template | llm
-    answer = llm_chain.invoke({'query': old_query, 'error_message': error_message})
+def new_sql_query(old_query, error_message, model, tier=0):
+    with stage_call('repair', tier):
+        answer = _repair_chain(model, tier).invoke({'query': old_query, 'error_message': error_message})
 
     print(answer.content)
 
     return extract_sql_query(answer.content)
 
 
+def repair_message(error, timeout_ms):
+    if isinstance(error, QueryTimeout):
+        return cheaper_query_message.format(
+            reason=f'The query was cancelled because it ran longer than {timeout_ms} ms.')
+    if isinstance(error, QueryTooExpensive):
+        return cheaper_query_message.format(reason=str(error))
+    return str(error)
 
-def execute_query(query, r =0):
 
-    if r == 5:
-        return 'Error : Cannot not execute query'
+def fetch_bounded(cur, max_tokens=None, max_rows=None):
+    rows = []
+    tokens = 0
 
-    # Connect to the PostgreSQL database
-    conn = psycopg2.connect(DATABASE_URL)
+    while True:
+        batch = cur.fetchmany(FETCH_BATCH_SIZE)
+        if not batch:
+            return rows
 
-    # Create a cursor
-    cur = conn.cursor()
+        rows.extend(batch)
+
+        if max_rows is not None and len(rows) > max_rows:
+            raise ResultTooLarge(f'More than {max_rows} rows')
+
+        if max_tokens is not None:
+            tokens += count_tokens(str(batch))
+            if tokens > max_tokens:
+                raise ResultTooLarge(f'More than {max_tokens} tokens after {len(rows)} rows')
 
-    # Execute the query
-    try:
-        cur.execute(query)
-    except Exception as e:
-        print(f'Error: {e}. Retrying...')
-        return execute_query(new_sql_query(query, str(e), 'openai'), r+1)
-        
-        
 
-    rows = cur.fetchall()
+def execute_query(query, max_tokens=None, max_rows=None, bucket=None, owner=None):
+    cached = get_cached_result(query)
+    if cached is not None:
+        rows, tokens = cached
+        # A result cached under a bigger budget may not fit this one; running it again raises as usual
+        if (max_rows is None or len(rows) <= max_rows) and (max_tokens is None or tokens <= max_tokens):
+            print('Result cache hit')
+            return rows
 
-    cur.close()
-    conn.close()
+    if owner is not None:
+        with owner_request(owner):
+            rows = _execute_with_repair(query, max_tokens, max_rows, bucket, owner)
+    else:
+        rows = _execute_with_repair(query, max_tokens, max_rows, bucket, owner)
 
+    # Keyed on the query we were given, so a repaired query is reused for the same input
+    if isinstance(rows, list):
+        store_result(query, rows, count_tokens(str(rows)))
     return rows
 
 
+def explain_query(conn, query):
+    # Planner estimates only; nothing is executed
+    with conn.cursor() as cur:
+        cur.execute('EXPLAIN (FORMAT JSON) ' + query.strip().rstrip(';'))
+        plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]['Plan']
+    return plan['Total Cost'], plan['Plan Rows'], plan['Plan Width']
+
+
+def _count_explain(key):
+    with _explain_lock:
+        _explain_stats[key] += 1
+
+
+def gate_query(conn, query, max_tokens=None):
+    cost, rows, width = explain_query(conn, query)
+    return judge_plan(query, cost, rows, width, max_tokens)
+
+
+def judge_plan(query, cost, rows, width, max_tokens=None):
+    _count_explain('explained')
+    print(f'Planner estimate: cost={cost} rows={rows} width={width}')
+
+    if cost > EXPLAIN_MAX_COST:
+        _count_explain('too_expensive')
+        raise QueryTooExpensive(f'The planner estimated a cost of {cost:.0f}, above the limit of {EXPLAIN_MAX_COST:.0f}.')
+
+    estimated_tokens = rows * width / CHARS_PER_TOKEN
+    if rows <= EXPLAIN_MAX_ROWS and (max_tokens is None or estimated_tokens <= max_tokens):
+        return query
+
+    _count_explain('oversized')
+    if EXPLAIN_OVERSIZE_ACTION == 'limit':
+        _count_explain('limited')
+        return f'SELECT * FROM ({query.strip().rstrip(";")}) AS limited_result LIMIT {EXPLAIN_LIMIT_ROWS}'
+    if EXPLAIN_OVERSIZE_ACTION == 'reject':
+        raise QueryTooExpensive(f'The planner expects about {rows} rows, too many to show the user.')
+
+    _count_explain('sent_to_expert')
+    raise ResultTooLarge(f'Planner expects about {rows} rows (~{estimated_tokens:.0f} tokens)')
+
+
+def explain_stats():
+    with _explain_lock:
+        stats = dict(_explain_stats)
+    stats['enabled'] = EXPLAIN_GATE
+    return stats
+
+
+def _run_query(query, max_tokens, max_rows, timeout_ms, owner):
+    # Borrow a pooled connection; it is handed back before any repair call to the LLM
+    with get_connection() as conn, track_query(conn, owner), read_only_transaction(conn, timeout_ms):
+        if EXPLAIN_GATE:
+            query = gate_query(conn, query, max_tokens)
+
+        # A named cursor streams rows from the server so an oversized result can be
+        # abandoned after the first few batches instead of being transferred in full
+        cursor_name = f'billy_{uuid.uuid4().hex}' if SERVER_SIDE_CURSORS else None
+        with conn.cursor(name=cursor_name) as cur:
+            cur.itersize = FETCH_BATCH_SIZE
+            try:
+                cur.execute(query)
+                return fetch_bounded(cur, max_tokens, max_rows)
+            except errors.QueryCanceled as e:
+                if owner is not None and was_cancelled(owner):
+                    raise QueryCancelled(f'Query for {owner} was cancelled') from e
+                raise QueryTimeout(f'Query exceeded the {timeout_ms} ms statement timeout') from e
+
+
+def _execute_with_repair(query, max_tokens, max_rows, bucket, owner):
+    timeout_ms = statement_timeout_for(bucket)
+    repair = new_repair_record()
+
+    try:
+        for attempt in range(MAX_QUERY_ATTEMPTS):
+            try:
+                if SQL_VALIDATION:
+                    validate_sql(query, bucket)
+                rows = _run_query(query, max_tokens, max_rows, timeout_ms, owner)
+                repair['succeeded'] = True
+                return rows
+            except (ResultTooLarge, QueryCancelled, PoolTimeout):
+                # A pool timeout means the database is saturated; waiting again would only add to it
+                raise
+            except Exception as e:
+                error = e
+
+            if isinstance(error, SchemaValidationError):
+                repair['rejected'] += 1
+            print(f'Error: {error}. Retrying...')
+
+            if attempt == MAX_QUERY_ATTEMPTS - 1:
+                break
+            if owner is not None and was_cancelled(owner):
+                raise QueryCancelled(f'Query for {owner} was cancelled')
+            if is_connection_failure(error):
+                # Nothing wrong with the query; run it again, most likely on another replica
+                continue
+
+            start = time.perf_counter()
+            fixed = local_fix(query, error, columns_for_bucket(bucket))
+            if fixed is not None:
+                print(f'Fixed query locally ({classify_error(error)})')
+                repair['local_fixes'] += 1
+                query = fixed
+            else:
+                tier = repair_tier(repair['llm_fixes'])
+                repair['llm_fixes'] += 1
+                query = new_sql_query(query, repair_message(error, timeout_ms), 'openai', tier)
+            repair['rounds'] += 1
+            repair['ms'] += (time.perf_counter() - start) * 1000
+
+        return 'Error : Cannot not execute query'
+    finally:
+        record_repair(repair)
+
+
+def new_repair_record():
+    return {'rounds': 0, 'local_fixes': 0, 'llm_fixes': 0, 'rejected': 0, 'ms': 0.0, 'succeeded': False}
+
+
+def record_repair(repair):
+    if not repair['rounds']:
+        with _repair_lock:
+            _repair_stats['queries'] += 1
+        return
+
+    print(f"Repair took {repair['rounds']} rounds ({repair['local_fixes']} local, "
+          f"{repair['llm_fixes']} llm) and {repair['ms']:.0f} ms")
+    with _repair_lock:
+        _repair_stats['queries'] += 1
+        _repair_stats['repaired' if repair['succeeded'] else 'failed'] += 1
+        _repair_stats['rounds'] += repair['rounds']
+        _repair_stats['local_fixes'] += repair['local_fixes']
+        _repair_stats['llm_fixes'] += repair['llm_fixes']
+        _repair_stats['rejected_before_execution'] += repair['rejected']
+        _repair_stats['repair_ms'] += repair['ms']
+
+
+def repair_stats():
+    with _repair_lock:
+        stats = dict(_repair_stats)
+    repaired_or_failed = stats['repaired'] + stats['failed']
+    stats['avg_rounds'] = stats['rounds'] / repaired_or_failed if repaired_or_failed else 0.0
+    stats['avg_repair_ms'] = stats['repair_ms'] / repaired_or_failed if repaired_or_failed else 0.0
+    return stats
+
+
 def extract_sql_query(input_string):
     if 'sql' not in input_string:
         return input_string
@@ -8,7 +8,12 @@ import time
 from langchain_anthropic import ChatAnthropic
 import re
 from utils.cache import get_closest_embedding
-from utils.CountUtil import count_tokens
+from utils.CountUtil import count_tokens, usage_counts
+from utils.schema import register_metadata
+from utils.llm_clients import get_llm
+from utils.model_tiers import stage_model
+from utils.prompt_layout import check_prompt_call, register_prompt
+from utils.sql_stream import generate_sql
 
 
 futures_metadata = """
@@ -119,12 +124,13 @@ Updated (text) - Timestamp of when the record was last updated, looks like  look
 
 """
 
+register_metadata(futures_metadata, 'futurestable')
+
 
 prompt_template = """
 
 <instructions>
-You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is:
-`{user_question}`
+You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is at the end of this prompt.
 
 </instructions>
 
@@ -144,12 +150,6 @@ Do not make things more specific than they should be. For example, no need to gi
 </special_instructions>
 
 
-<question>
-
-
-Given the database schema, here is the SQL query that answers `{user_question}`:
-
-</question>
 
 
 
@@ -157,15 +157,6 @@ If the question cannot be answered with the data provided, return the string "ca
 
 This is a postgres database. Do not create any new columns or tables. Only use the columns that are in the table.
 
-Here is an example response for the question: {matched_user_question}
-<example_response>
-
-
-```sql
-{matched_sql_query}
-```
-
-</example_response>
 
 
 Your response will be executed on a database of NFL Betting Prompts and the answer will be returned to the User, so make sure the query is correct and will return the correct information.
@@ -181,33 +172,59 @@ Make sure you surround columns with double quotes since it is case sensitive. An
 This is a postgres database. Do not create any new columns or tables. Only reference columns that are in the database schema provided.
 Make sure you use parentheses correctly in your queries as well as commas to make logical sense. For example AND "TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur' should be AND ("TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur') since the OR should be in parentheses.
 
-Assistant: 
 
 
 """
+
+request_template = """
+Here is an example response for the question: {matched_user_question}
+<example_response>
+
+
+```sql
+{matched_sql_query}
+```
+
+</example_response>
+
+<question>
+Given the database schema, here is the SQL query that answers `{user_question}`:
+</question>
+
+"""
+
+# Everything above is the same on every call; the per-request parts go last so the
+# provider can serve the long static prefix from its prompt cache
+prompt_template += request_template
+prompt_template += "\nAssistant: "
+
 sql_prompt = PromptTemplate.from_template(prompt_template)
 
 
-def futures_log_get_answer(model, question):
+register_prompt('Futures', sql_prompt, {"table_metadata_string": futures_metadata})
+
+# The prompt and schema never change, so they are only tokenized once
+static_input_tokens = count_tokens(prompt_template) + count_tokens(futures_metadata)
+
+
+def futures_log_get_answer(model, question, embedding=None, temperature=None, tier=0, owner=None, match=None):
     llm = None
-    input_count = count_tokens(question)
-    input_count += count_tokens(prompt_template)
-    input_count += count_tokens(futures_metadata)
-    matched_user_question, matched_sql_query = get_closest_embedding(question, model="text-embedding-3-large", top_k=1)
+    input_count = static_input_tokens + count_tokens(question)
+    matched_user_question, matched_sql_query = match or get_closest_embedding(question, model="text-embedding-3-large", top_k=1, embedding=embedding)
     input_count += count_tokens(matched_user_question)
     input_count += count_tokens(matched_sql_query)
     if model == 'openai':
         try:
-            llm = ChatOpenAI(model='gpt-4o', temperature=0.96)
+            llm = get_llm('openai', stage_model('sql', tier), 0.96 if temperature is None else temperature)
         except Exception as e:
             print("key not given", e)
 
     elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-5-sonnet-20240620', temperature=0.5)
+        llm = get_llm('anthropic', 'claude-3-5-sonnet-20240620', 0.5 if temperature is None else temperature)
 
     print(llm)
-    llm_chain = sql_prompt | llm
-    answer = llm_chain.invoke(
-        {'user_question': question, "table_metadata_string": futures_metadata, "matched_user_question": matched_user_question, "matched_sql_query": matched_sql_query, "current_date": str(time.strftime("%Y-%m-%d"))})
-    output_count = count_tokens(answer.content) 
+    values = {'user_question': question, "table_metadata_string": futures_metadata, "matched_user_question": matched_user_question, "matched_sql_query": matched_sql_query, "current_date": str(time.strftime("%Y-%m-%d"))}
+    answer = generate_sql(sql_prompt, llm, values, owner=owner)
+    check_prompt_call('Futures', values, answer)
+    input_count, output_count = usage_counts(answer, input_count)
     return answer.content, input_count, output_count
@@ -0,0 +1,123 @@
+import os
+import threading
+
+import dotenv
+import httpx
+from langchain_anthropic import ChatAnthropic
+from langchain_openai import ChatOpenAI
+from openai import OpenAI
+
+from utils.llm_resilience import FALLBACK_MODELS, LLM_RESILIENCE, ResilientLLM, has_key
+
+dotenv.load_dotenv()
+
+
+# One long-lived client per (provider, model, temperature), so requests reuse open
+# keep-alive connections instead of paying a TLS handshake on every call.
+
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', 100))
+LLM_MAX_KEEPALIVE = int(os.getenv('LLM_MAX_KEEPALIVE', 20))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv('LLM_KEEPALIVE_EXPIRY', 120))
+
+PERPLEXITY_BASE_URL = 'https://api.perplexity.ai'
+
+
+def _http_client():
+    return httpx.Client(limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                                            keepalive_expiry=LLM_KEEPALIVE_EXPIRY))
+
+
+_lock = threading.Lock()
+_clients = {}
+_raw_clients = {}
+_openai_http = None
+_perplexity = None
+
+
+def get_raw_llm(provider, model, temperature=None):
+    # The provider's own chat model, without the fallback layer
+    key = (provider, model, temperature)
+    llm = _raw_clients.get(key)
+    if llm is not None:
+        return llm
+
+    global _openai_http
+    with _lock:
+        if key in _raw_clients:
+            return _raw_clients[key]
+
+        kwargs = {} if temperature is None else {'temperature': temperature}
+        if provider == 'openai':
+            if _openai_http is None:
+                _openai_http = _http_client()
+            llm = ChatOpenAI(model=model, http_client=_openai_http, **kwargs)
+        elif provider == 'anthropic':
+            # ChatAnthropic keeps its own client, so sharing the instance shares the connections
+            llm = ChatAnthropic(model_name=model, **kwargs)
+        else:
+            raise ValueError(f'Unknown LLM provider: {provider}')
+
+        _raw_clients[key] = llm
+    return llm
+
+
+def _fallback_factory(provider, temperature):
+    fallback_provider, fallback_model = FALLBACK_MODELS.get(provider, (None, None))
+    if fallback_provider is None or not has_key(fallback_provider):
+        return None
+    # Anthropic only takes temperatures up to 1
+    if temperature is not None:
+        temperature = min(temperature, 1.0)
+    return lambda: (fallback_provider, get_raw_llm(fallback_provider, fallback_model, temperature))
+
+
+def get_llm(provider, model, temperature=None):
+    key = (provider, model, temperature)
+    llm = _clients.get(key)
+    if llm is not None:
+        return llm
+
+    llm = get_raw_llm(provider, model, temperature)
+    if LLM_RESILIENCE:
+        llm = ResilientLLM(provider, llm, _fallback_factory(provider, temperature))
+
+    with _lock:
+        return _clients.setdefault(key, llm)
+
+
+def get_perplexity_client():
+    global _perplexity
+    if _perplexity is None:
+        with _lock:
+            if _perplexity is None:
+                _perplexity = OpenAI(api_key=os.getenv('PERPLEXITY_KEY'), base_url=PERPLEXITY_BASE_URL,
+                                     http_client=_http_client())
+    return _perplexity
+
+
+# The clients the request path uses; see the *_get_answer functions and question_chooser
+WARM_CLIENTS = [
+    ('openai', 'gpt-4', 0.3),
+    ('openai', 'gpt-4o', 0.9),
+    ('openai', 'gpt-4o', 0.96),
+    ('openai', 'gpt-4o', None),
+]
+
+
+def _warm():
+    for provider, model, temperature in WARM_CLIENTS:
+        try:
+            get_llm(provider, model, temperature)
+        except Exception as e:
+            print(f'Could not create {provider} client for {model}: {e}')
+
+    # Opening a connection now keeps the first user request from paying for the handshake
+    try:
+        get_raw_llm('openai', 'gpt-4o').client._client.models.list()
+    except Exception as e:
+        print(f'Could not warm the OpenAI connection: {e}')
+
+
+def warm_clients():
+    threading.Thread(target=_warm, daemon=True).start()
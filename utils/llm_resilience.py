@@ -0,0 +1,359 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import closing
+
+import dotenv
+import httpx
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import Runnable
+
+from utils.percentile import percentile
+
+dotenv.load_dotenv()
+
+
+# Sits between the prompts and the chat models. Each provider has a circuit breaker: after a
+# run of failures its calls go to the other provider until a cooldown passes. With hedging on,
+# a call that hasn't produced anything within the provider's usual p95 is also sent to the
+# other provider, and whichever answers first is used.
+
+LLM_RESILIENCE = os.getenv('LLM_RESILIENCE', 'true').lower() == 'true'
+LLM_HEDGING = os.getenv('LLM_HEDGING', 'false').lower() == 'true'
+
+# Consecutive failures that open a provider's breaker, and how long it stays open
+BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', 5))
+BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', 30))
+
+# Until a provider has this many samples its p95 isn't trusted and the default delay is used
+HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', 20))
+HEDGE_DEFAULT_MS = float(os.getenv('LLM_HEDGE_DEFAULT_MS', 3000))
+
+LATENCY_SAMPLES = 500
+
+# What to use when a provider is down; only providers with a key configured are used
+FALLBACK_MODELS = {
+    'openai': ('anthropic', os.getenv('ANTHROPIC_FALLBACK_MODEL', 'claude-3-5-sonnet-20240620')),
+    'anthropic': ('openai', os.getenv('OPENAI_FALLBACK_MODEL', 'gpt-4o')),
+}
+PROVIDER_KEYS = {
+    'openai': 'OPENAI_API_KEY',
+    'anthropic': 'ANTHROPIC_API_KEY',
+}
+
+
+_pool = ThreadPoolExecutor(max_workers=int(os.getenv('LLM_HEDGE_WORKERS', 32)))
+
+_lock = threading.Lock()
+_providers = {}
+_stats = {
+    'fallbacks': 0,
+    'hedges': 0,
+    'hedge_wins': 0,
+    'hedges_abandoned': 0,
+}
+
+
+def _provider(provider):
+    return _providers.setdefault(provider, {
+        'calls': 0,
+        'errors': 0,
+        'failures': 0,
+        'opened': 0,
+        'open_until': 0.0,
+        'first_token_ms': deque(maxlen=LATENCY_SAMPLES),
+        'total_ms': deque(maxlen=LATENCY_SAMPLES),
+    })
+
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+
+def has_key(provider):
+    return bool(os.getenv(PROVIDER_KEYS.get(provider, ''), ''))
+
+
+def is_open(provider):
+    with _lock:
+        return _provider(provider)['open_until'] > time.time()
+
+
+def record_success(provider, first_token_ms=None, total_ms=None):
+    with _lock:
+        stats = _provider(provider)
+        stats['failures'] = 0
+        if first_token_ms is not None:
+            stats['first_token_ms'].append(first_token_ms)
+        if total_ms is not None:
+            stats['total_ms'].append(total_ms)
+
+
+def is_provider_failure(error):
+    # Only timeouts, dropped connections and 5xx say the provider is down; a 4xx, a prompt
+    # over the context window or a parsing error would fail the same way on every call
+    status = getattr(error, 'status_code', None)
+    if isinstance(status, int):
+        return status >= 500
+    if isinstance(error, (TimeoutError, ConnectionError, httpx.TimeoutException, httpx.NetworkError)):
+        return True
+    # openai and anthropic both raise APIConnectionError (and its APITimeoutError) without a status
+    return any(cls.__name__ in ('APIConnectionError', 'APITimeoutError') for cls in type(error).__mro__)
+
+
+def record_failure(provider, error):
+    print(f'{provider} call failed: {error}')
+    with _lock:
+        stats = _provider(provider)
+        stats['errors'] += 1
+        if not is_provider_failure(error):
+            return
+        stats['failures'] += 1
+        # Past the cooldown a single failure is enough to open it again
+        if stats['failures'] >= BREAKER_FAILURES:
+            if stats['open_until'] <= time.time():
+                stats['opened'] += 1
+                print(f'Circuit breaker for {provider} opened for {BREAKER_COOLDOWN:.0f}s')
+            stats['open_until'] = time.time() + BREAKER_COOLDOWN
+
+
+def hedge_delay(provider, kind):
+    # Seconds to wait on a provider before asking the other one too
+    with _lock:
+        samples = list(_provider(provider)[kind])
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_MS / 1000
+    return percentile(samples, 0.95) / 1000
+
+
+def _invoke(backend, input, config, kwargs):
+    provider, llm, bound = backend
+    with _lock:
+        _provider(provider)['calls'] += 1
+    start = time.perf_counter()
+    try:
+        result = llm.invoke(input, config, **(kwargs if bound else {}))
+    except Exception as e:
+        record_failure(provider, e)
+        raise
+    record_success(provider, total_ms=(time.perf_counter() - start) * 1000)
+    return result
+
+
+def _stream(backend, input, config, kwargs):
+    provider, llm, bound = backend
+    with _lock:
+        _provider(provider)['calls'] += 1
+    start = time.perf_counter()
+    first = True
+    try:
+        with closing(llm.stream(input, config, **(kwargs if bound else {}))) as stream:
+            for chunk in stream:
+                if first:
+                    # A first token is enough to know the provider is up, even if the reader stops early
+                    record_success(provider, first_token_ms=(time.perf_counter() - start) * 1000)
+                    first = False
+                yield chunk
+    except Exception as e:
+        record_failure(provider, e)
+        raise
+    record_success(provider, total_ms=(time.perf_counter() - start) * 1000)
+
+
+def _pump(index, backend, input, config, kwargs, chunks, cancel):
+    try:
+        with closing(_stream(backend, input, config, kwargs)) as stream:
+            for chunk in stream:
+                if cancel.is_set():
+                    break
+                chunks.put((index, 'chunk', chunk))
+        chunks.put((index, 'done', None))
+    except Exception as e:
+        chunks.put((index, 'error', e))
+
+
+class ResilientLLM(Runnable[LanguageModelInput, BaseMessage]):
+    # Bound kwargs (stream_options, logprobs, ...) are provider specific, so only the primary gets them
+
+    def __init__(self, provider, llm, secondary=None):
+        self.provider = provider
+        self.llm = llm
+        # Builds (provider, llm) for the other provider the first time it is needed
+        self._secondary = secondary
+        self._secondary_llm = None
+
+    def __repr__(self):
+        return f'ResilientLLM({self.provider}, {self.llm!r})'
+
+    def _fallback(self):
+        if self._secondary is None:
+            return None
+        if self._secondary_llm is None:
+            try:
+                self._secondary_llm = self._secondary()
+            except Exception as e:
+                print(f'Could not create fallback for {self.provider}: {e}')
+                self._secondary = None
+                return None
+        return self._secondary_llm
+
+    def _backends(self):
+        primary = (self.provider, self.llm, True)
+        fallback = self._fallback()
+        if fallback is None:
+            return [primary]
+
+        secondary = (fallback[0], fallback[1], False)
+        # An open breaker sends the call to the other provider first; the primary is still
+        # tried last, since failing outright is worse than a slow answer
+        if is_open(self.provider) and not is_open(secondary[0]):
+            return [secondary, primary]
+        return [primary, secondary]
+
+    def invoke(self, input, config=None, **kwargs):
+        backends = self._backends()
+        if LLM_HEDGING and len(backends) > 1:
+            return self._hedged_invoke(backends, input, config, kwargs)
+
+        error = None
+        for i, backend in enumerate(backends):
+            if i:
+                _count('fallbacks')
+            try:
+                return _invoke(backend, input, config, kwargs)
+            except Exception as e:
+                error = e
+        raise error
+
+    def _hedged_invoke(self, backends, input, config, kwargs):
+        futures = [_pool.submit(_invoke, backends[0], input, config, kwargs)]
+        done, _ = wait(futures, timeout=hedge_delay(backends[0][0], 'total_ms'))
+        if not done:
+            _count('hedges')
+            futures.append(_pool.submit(_invoke, backends[1], input, config, kwargs))
+
+        error = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is not futures[0]:
+                _count('hedge_wins')
+            # A blocking invoke can't be interrupted: a loser still waiting for a worker is
+            # cancelled, one already sent finishes in the background and its answer is dropped
+            for loser in futures:
+                if loser is not future and not loser.cancel() and not loser.done():
+                    _count('hedges_abandoned')
+            return result
+
+        if len(futures) == 1:
+            # The primary failed before the hedge was due
+            _count('fallbacks')
+            return _invoke(backends[1], input, config, kwargs)
+        raise error
+
+    def stream(self, input, config=None, **kwargs):
+        backends = self._backends()
+        if LLM_HEDGING and len(backends) > 1:
+            yield from self._hedged_stream(backends, input, config, kwargs)
+            return
+
+        error = None
+        for i, backend in enumerate(backends):
+            if i:
+                _count('fallbacks')
+            started = False
+            try:
+                for chunk in _stream(backend, input, config, kwargs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                # Half an answer from one provider can't be finished by the other
+                if started:
+                    raise
+                error = e
+        raise error
+
+    def _hedged_stream(self, backends, input, config, kwargs):
+        chunks = queue.Queue()
+        cancel = [threading.Event(), threading.Event()]
+        _pool.submit(_pump, 0, backends[0], input, config, kwargs, chunks, cancel[0])
+        started = 1
+        winner = None
+        errors = []
+        delay = hedge_delay(backends[0][0], 'first_token_ms')
+
+        try:
+            while True:
+                try:
+                    index, kind, value = chunks.get(timeout=delay if winner is None and started == 1 else None)
+                except queue.Empty:
+                    # The primary is slower than it usually is to start; ask the other provider as well
+                    _count('hedges')
+                    _pool.submit(_pump, 1, backends[1], input, config, kwargs, chunks, cancel[1])
+                    started = 2
+                    continue
+
+                if winner is not None and index != winner:
+                    continue
+
+                if kind == 'error':
+                    if winner is not None:
+                        raise value
+                    errors.append(value)
+                    if started == 1:
+                        _count('fallbacks')
+                        _pool.submit(_pump, 1, backends[1], input, config, kwargs, chunks, cancel[1])
+                        started = 2
+                    elif len(errors) == started:
+                        raise errors[0]
+                    continue
+
+                if winner is None:
+                    winner = index
+                    cancel[1 - index].set()
+                    if index == 1 and not errors:
+                        _count('hedge_wins')
+
+                if kind == 'done':
+                    return
+                yield value
+        finally:
+            for event in cancel:
+                event.set()
+
+
+def llm_resilience_stats():
+    now = time.time()
+    with _lock:
+        stats = dict(_stats)
+        providers = {provider: dict(values, first_token_ms=list(values['first_token_ms']), total_ms=list(values['total_ms']))
+                     for provider, values in _providers.items()}
+
+    for provider, values in providers.items():
+        first_token = values.pop('first_token_ms')
+        total = values.pop('total_ms')
+        # Past the cooldown with the failure run intact, the next call decides whether it closes or reopens
+        if values.pop('open_until') > now:
+            values['state'] = 'open'
+        elif values['failures'] >= BREAKER_FAILURES:
+            values['state'] = 'half_open'
+        else:
+            values['state'] = 'closed'
+        values['first_token_p50_ms'] = percentile(first_token, 0.5)
+        values['first_token_p95_ms'] = percentile(first_token, 0.95)
+        values['total_p50_ms'] = percentile(total, 0.5)
+        values['total_p95_ms'] = percentile(total, 0.95)
+
+    stats['enabled'] = LLM_RESILIENCE
+    stats['hedging'] = LLM_HEDGING
+    stats['providers'] = providers
+    return stats
@@ -0,0 +1,179 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import dotenv
+
+from utils.percentile import percentile
+from utils.schema import SchemaValidationError, validate_sql
+
+dotenv.load_dotenv()
+
+
+# Each stage starts on a cheaper, faster model and only moves to the stronger one when the
+# cheap output is not good enough: the router is unsure, the SQL fails validation or
+# execution, or a repair attempt did not work. With tiering off every stage keeps its
+# current model.
+
+MODEL_TIERING = os.getenv('MODEL_TIERING', 'false').lower() == 'true'
+
+CHEAP_MODEL = os.getenv('CHEAP_MODEL', 'gpt-4o-mini')
+
+# The models each stage used before tiering, which stay the last tier
+STRONG_MODELS = {
+    'router': os.getenv('ROUTER_STRONG_MODEL', 'gpt-4'),
+    'sql': os.getenv('SQL_STRONG_MODEL', 'gpt-4o'),
+    'repair': os.getenv('REPAIR_STRONG_MODEL', 'gpt-4o'),
+    'answer': os.getenv('ANSWER_STRONG_MODEL', 'gpt-4o'),
+}
+
+# Probability the cheap router gives its bucket below which the strong router decides
+ROUTER_MIN_CONFIDENCE = float(os.getenv('ROUTER_MIN_CONFIDENCE', 0.8))
+
+# Results bigger than this go to the strong answer model, small ones are easy to summarize
+ANSWER_STRONG_MIN_RESULT_TOKENS = int(os.getenv('ANSWER_STRONG_MIN_RESULT_TOKENS', 1500))
+
+ROUTER_BUCKETS = {
+    'TeamGameLog', 'PlayerGameLog', 'PlayByPlay', 'TeamAndPlayerLog', 'Props', 'PlayerLogAndProps',
+    'TeamLogAndProps', 'Futures', 'ExpertAnalysis', 'Conversation', 'NoBucket',
+}
+
+# Latency samples kept per stage for the percentiles
+LATENCY_SAMPLES = 1000
+
+
+def stage_models(stage):
+    if not MODEL_TIERING or CHEAP_MODEL == STRONG_MODELS[stage]:
+        return [STRONG_MODELS[stage]]
+    return [CHEAP_MODEL, STRONG_MODELS[stage]]
+
+
+def stage_model(stage, tier=0):
+    models = stage_models(stage)
+    return models[min(tier, len(models) - 1)]
+
+
+def can_escalate(stage, tier):
+    return tier + 1 < len(stage_models(stage))
+
+
+_lock = threading.Lock()
+_stats = {stage: {'requests': 0, 'calls': {}, 'escalations': 0, 'reasons': {}, 'ms': deque(maxlen=LATENCY_SAMPLES)}
+          for stage in STRONG_MODELS}
+
+
+def record_request(stage):
+    # One per question reaching the stage, however many calls it then takes
+    with _lock:
+        _stats[stage]['requests'] += 1
+
+
+def record_call(stage, tier, ms):
+    model = stage_model(stage, tier)
+    with _lock:
+        stats = _stats[stage]
+        stats['calls'][model] = stats['calls'].get(model, 0) + 1
+        stats['ms'].append(ms)
+
+
+def record_escalation(stage, reason):
+    print(f'Escalating {stage} to {stage_model(stage, 1)}: {reason}')
+    with _lock:
+        stats = _stats[stage]
+        stats['escalations'] += 1
+        stats['reasons'][reason] = stats['reasons'].get(reason, 0) + 1
+
+
+@contextmanager
+def stage_call(stage, tier=0):
+    start = time.perf_counter()
+    try:
+        yield stage_model(stage, tier)
+    finally:
+        record_call(stage, tier, (time.perf_counter() - start) * 1000)
+
+
+def router_confidence(response, bucket):
+    # Probability of the bucket name from the token logprobs, None when the response has none
+    logprobs = ((getattr(response, 'response_metadata', None) or {}).get('logprobs') or {}).get('content')
+    if not logprobs or not bucket:
+        return None
+
+    start = response.content.find(bucket, max(response.content.find('Bucket:'), 0))
+    if start < 0:
+        return None
+    end = start + len(bucket)
+
+    position = 0
+    total = 0.0
+    for token in logprobs:
+        token_start = position
+        position += len(token['token'])
+        if position > start and token_start < end:
+            total += token['logprob']
+    return math.exp(total)
+
+
+def router_escalation(response, bucket):
+    # Why the cheap router's answer should not be used, or None
+    if bucket not in ROUTER_BUCKETS:
+        return 'unknown_bucket'
+    confidence = router_confidence(response, bucket)
+    if confidence is not None and confidence < ROUTER_MIN_CONFIDENCE:
+        return 'low_confidence'
+    return None
+
+
+def sql_escalation(raw_query, query, bucket=None):
+    # Why the cheap model's SQL should be regenerated by the strong one before running it, or None
+    if 'error' in raw_query.lower() or 'cannot' in raw_query.lower():
+        return 'cannot_answer'
+    if not query:
+        return 'no_sql'
+    try:
+        validate_sql(query, bucket)
+    except SchemaValidationError:
+        return 'validation_failed'
+    return None
+
+
+def repair_tier(previous_fixes):
+    # The first LLM repair goes to the cheap model; once one of its fixes has failed, the strong one takes over
+    if previous_fixes == 0:
+        record_request('repair')
+    elif previous_fixes == 1 and can_escalate('repair', 0):
+        record_escalation('repair', 'fix_failed')
+    return min(previous_fixes, 1)
+
+
+def answer_tier(result_tokens, sql_escalated=False):
+    # The answer can't be checked before it is streamed, so the tier is picked up front
+    record_request('answer')
+    if not can_escalate('answer', 0):
+        return 0
+    if sql_escalated:
+        record_escalation('answer', 'sql_escalated')
+        return 1
+    if result_tokens > ANSWER_STRONG_MIN_RESULT_TOKENS:
+        record_escalation('answer', 'large_result')
+        return 1
+    return 0
+
+
+def model_tier_stats():
+    with _lock:
+        stats = {stage: {'requests': values['requests'], 'calls': dict(values['calls']), 'escalations': values['escalations'],
+                         'reasons': dict(values['reasons']), 'ms': list(values['ms'])}
+                 for stage, values in _stats.items()}
+
+    for stage, values in stats.items():
+        samples = values.pop('ms')
+        values['models'] = stage_models(stage)
+        values['escalation_rate'] = values['escalations'] / values['requests'] if values['requests'] else 0.0
+        values['p50_ms'] = percentile(samples, 0.5)
+        values['p95_ms'] = percentile(samples, 0.95)
+
+    return {'enabled': MODEL_TIERING, 'stages': stats}
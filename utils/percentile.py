@@ -0,0 +1,8 @@
+# Nearest-rank percentile over the latency samples the /stats sections keep
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
@@ -1,6 +1,7 @@
 from openai import OpenAI
 import dotenv
 import os
+from utils.llm_clients import get_perplexity_client
 
 dotenv.load_dotenv()
 
@@ -22,8 +23,7 @@ def ask_expert(question):
         },
     ]
 
-    client = OpenAI(api_key=os.getenv('PERPLEXITY_KEY'),
-                    base_url="https://api.perplexity.ai")
+    client = get_perplexity_client()
 
 
 
@@ -10,7 +10,12 @@ from langchain_openai import ChatOpenAI
 import time
 from langchain_anthropic import ChatAnthropic
 from utils.cache import get_closest_embedding
-from utils.CountUtil import count_tokens
+from utils.CountUtil import count_tokens, usage_counts
+from utils.schema import register_metadata
+from utils.llm_clients import get_llm
+from utils.model_tiers import stage_model
+from utils.prompt_layout import check_prompt_call, register_prompt
+from utils.sql_stream import generate_sql
 import dotenv
 dotenv.load_dotenv()
 
@@ -27,8 +32,7 @@ prompt_template = """
 User:
 
 <instructions>
-You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is:
-`{user_question}`
+You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is at the end of this prompt.
 
 </instructions>
 
@@ -79,21 +83,7 @@ Note: The database is a PostgreSQL database, and the data only goes back to the
 
 </special_instructions>
 
-<question>
-
-
-Given the database schema, here is the SQL query that answers `{user_question}`:
-
-</question>
-
-Here is an example response for the question: {matched_question}
-<example_response>
 
-```sql
-{matched_sql_query}
-```
-
-</example_response>
 
 
 
@@ -108,10 +98,31 @@ If the question cannot be answered with the data provided, please return the str
 
 This is a postgres database. Do not create any new columns.
 Make sure you use parentheses correctly in your queries as well as commas to make logical sense. For example AND "TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur' should be AND ("TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur') since the OR should be in parentheses.
+"""
+
+request_template = """
 This is the current date: {current_date}.
+
+Here is an example response for the question: {matched_question}
+<example_response>
+
+```sql
+{matched_sql_query}
+```
+
+</example_response>
+
+<question>
+Given the database schema, here is the SQL query that answers `{user_question}`:
+</question>
+
 """
 
+
 prompt_template += add_line
+# Everything above is the same on every call; the per-request parts go last so the
+# provider can serve the long static prefix from its prompt cache
+prompt_template += request_template
 prompt_template += "Assitant: "
 
 
@@ -221,29 +232,34 @@ HomeScore (double precision) - If this is a scoring play, the HomeScore (double
 ScoreID (double precision) - If this is a scoring play, the ScoreID (double precision)
 """
 
+register_metadata(testnfl_metadata, 'playbyplay')
+
 
-def play_by_play_get_answer(model, question):
+register_prompt('PlayByPlay', sql_prompt, {"table_metadata_string": testnfl_metadata})
+
+# The prompt and schema never change, so they are only tokenized once
+static_input_tokens = count_tokens(prompt_template) + count_tokens(testnfl_metadata)
+
+
+def play_by_play_get_answer(model, question, embedding=None, temperature=None, tier=0, owner=None, match=None):
     llm = None
 
-    input_count = count_tokens(question)
-    input_count += count_tokens(prompt_template)
-    input_count += count_tokens(testnfl_metadata)
+    input_count = static_input_tokens + count_tokens(question)
     
-    matched_question, matched_sql_query = get_closest_embedding(question)
+    matched_question, matched_sql_query = match or get_closest_embedding(question, embedding=embedding)
 
     input_count += count_tokens(matched_question)
     input_count += count_tokens(matched_sql_query)
 
 
     if model == 'openai':
-        llm = ChatOpenAI(model='gpt-4o', temperature=0.9)
+        llm = get_llm('openai', stage_model('sql', tier), 0.9 if temperature is None else temperature)
 
     elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-5-sonnet-20240620', temperature=0.5)
-
-    llm_chain = sql_prompt | llm
-    answer = llm_chain.invoke(
-        {'user_question': question, "table_metadata_string": testnfl_metadata, "matched_question": matched_question, "matched_sql_query": matched_sql_query, "current_date": str(time.strftime("%Y-%m-%d"))})
-    output_count = count_tokens(answer.content)
+        llm = get_llm('anthropic', 'claude-3-5-sonnet-20240620', 0.5 if temperature is None else temperature)
+    values = {'user_question': question, "table_metadata_string": testnfl_metadata, "matched_question": matched_question, "matched_sql_query": matched_sql_query, "current_date": str(time.strftime("%Y-%m-%d"))}
+    answer = generate_sql(sql_prompt, llm, values, owner=owner)
+    check_prompt_call('PlayByPlay', values, answer)
+    input_count, output_count = usage_counts(answer, input_count)
     return answer.content, input_count, output_count
 
@@ -12,7 +12,14 @@ from langchain_anthropic import ChatAnthropic
 import re
 from utils.cache import get_closest_embedding
 import datetime
-from utils.CountUtil import count_tokens
+from utils.CountUtil import count_tokens, usage_counts
+from utils.schema import register_metadata
+from utils.llm_clients import get_llm
+from utils.model_tiers import stage_model
+from utils.prompt_layout import check_prompt_call, register_prompt
+from utils.sql_stream import generate_sql
+from utils.schema_pruning import (PLAYER_KEY_COLUMNS, SCHEMA_PRUNING_ENABLED, TEAM_KEY_COLUMNS,
+                                  prune_schema, schema_last)
 import dotenv
 dotenv.load_dotenv()
 
@@ -23,8 +30,7 @@ prompt_template = """
 User:
 
 <instructions>
-You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is:
-`{user_question}`
+You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is at the end of this prompt.
 
 </instructions>
 
@@ -87,12 +93,22 @@ When asking about a player, assume that we want logs where the player has played
 
 </special_instructions>
 
-<question>
 
 
-Given the database schema, here is the SQL query that answers `{user_question}`:
 
-</question>
+Your response will be executed on a database of NFL Player Logs and NFL Team Logs and the answer will be returned to the User, so make sure the query is correct and will return the correct information.
+
+If the question cannot be answered with the data provided, please return the string "Error: Cannot answer question with data provided."
+
+This is a postgres database. Do not create any new columns or tables. Only reference columns that are in the database schema provided.
+
+There could be two players with the same name, so make sure to use the Team column to differentiate between them.
+
+Make sure you use parentheses correctly in your queries as well as commas to make logical sense. 
+"""
+
+request_template = """
+This is the current date: {current_date}
 
 Here is an example response for the question: {matched_question}
 
@@ -104,20 +120,17 @@ Here is an example response for the question: {matched_question}
 
 </example_response>
 
+<question>
+Given the database schema, here is the SQL query that answers `{user_question}`:
+</question>
 
-Your response will be executed on a database of NFL Player Logs and NFL Team Logs and the answer will be returned to the User, so make sure the query is correct and will return the correct information.
-
-If the question cannot be answered with the data provided, please return the string "Error: Cannot answer question with data provided."
-
-This is a postgres database. Do not create any new columns or tables. Only reference columns that are in the database schema provided.
-
-There could be two players with the same name, so make sure to use the Team column to differentiate between them.
-
-This is the current date: {current_date}
-Make sure you use parentheses correctly in your queries as well as commas to make logical sense. 
 """
 
+
 prompt_template += add_line
+# Everything above is the same on every call; the per-request parts go last so the
+# provider can serve the long static prefix from its prompt cache
+prompt_template += request_template
 prompt_template += "Assistant: "
 
 
@@ -571,32 +584,48 @@ Experience (double precision) - The number of years the player has played in the
 
 """
 
+register_metadata(testnfl_metadata)
+
+
+# Used instead of sql_prompt when the schema is pruned for the question
+pruned_sql_prompt = PromptTemplate.from_template(schema_last(prompt_template, request_template))
 
-def player_and_team_log_get_answer(model, question):
+register_prompt('TeamAndPlayerLog', sql_prompt, {"table_metadata_string": testnfl_metadata})
+register_prompt('TeamAndPlayerLog (pruned)', pruned_sql_prompt, {}, enabled=SCHEMA_PRUNING_ENABLED)
+
+# The prompt and full schema never change, so they are only tokenized once; a pruned
+# schema is counted for the call that renders it
+static_input_tokens = count_tokens(prompt_template)
+schema_tokens = count_tokens(testnfl_metadata)
+
+
+def player_and_team_log_get_answer(model, question, embedding=None, temperature=None, tier=0, owner=None, match=None):
     llm = None
-    input_count = count_tokens(question)
-    input_count += count_tokens(prompt_template)
-    input_count += count_tokens(testnfl_metadata)
+    input_count = static_input_tokens + count_tokens(question)
     
 
-    matched_question, matched_sql_query = get_closest_embedding(
-        question, top_k=1)
+    matched_question, matched_sql_query = match or get_closest_embedding(
+        question, top_k=1, embedding=embedding)
     
     input_count += count_tokens(matched_question)
     input_count += count_tokens(matched_sql_query)
 
 
     if model == 'openai':
-        llm = ChatOpenAI(model='gpt-4o', temperature=0.9)
+        llm = get_llm('openai', stage_model('sql', tier), 0.9 if temperature is None else temperature)
 
     elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-5-sonnet-20240620', temperature=0.5)
-
-    llm_chain = sql_prompt | llm
-    answer = llm_chain.invoke(
-        {'user_question': question, "table_metadata_string": testnfl_metadata, "matched_question": matched_question, "matched_sql_query": matched_sql_query, "current_date": str(datetime.datetime.today()).split()[0]})
+        llm = get_llm('anthropic', 'claude-3-5-sonnet-20240620', 0.5 if temperature is None else temperature)
+
+    (table_metadata,), pruned = prune_schema(
+        'TeamAndPlayerLog', question, embedding, [(testnfl_metadata, PLAYER_KEY_COLUMNS + TEAM_KEY_COLUMNS)], owner=owner)
+    prompt = pruned_sql_prompt if pruned else sql_prompt
+    input_count += count_tokens(table_metadata) if pruned else schema_tokens
+    values = {'user_question': question, "table_metadata_string": table_metadata, "matched_question": matched_question, "matched_sql_query": matched_sql_query, "current_date": str(datetime.datetime.today()).split()[0]}
+    answer = generate_sql(prompt, llm, values, owner=owner)
+    check_prompt_call('TeamAndPlayerLog (pruned)' if pruned else 'TeamAndPlayerLog', values, answer)
     return_answer = answer.content
-    output_count = count_tokens(return_answer)
+    input_count, output_count = usage_counts(answer, input_count)
     return return_answer, input_count, output_count
 
 
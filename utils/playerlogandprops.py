@@ -10,7 +10,14 @@ from langchain_anthropic import ChatAnthropic
 import re
 import datetime
 from utils.cache import get_closest_embedding
-from utils.CountUtil import count_tokens
+from utils.CountUtil import count_tokens, usage_counts
+from utils.schema import register_metadata
+from utils.llm_clients import get_llm
+from utils.model_tiers import stage_model
+from utils.prompt_layout import check_prompt_call, register_prompt
+from utils.sql_stream import generate_sql
+from utils.schema_pruning import (PLAYER_KEY_COLUMNS, PROPS_KEY_COLUMNS, SCHEMA_PRUNING_ENABLED,
+                                  prune_schema, schema_last)
 import dotenv
 dotenv.load_dotenv()
 
@@ -21,8 +28,7 @@ prompt_template = """
 User:
 
 <instructions>
-You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is:
-`{user_question}`
+You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is at the end of this prompt.
 
 </instructions>
 
@@ -101,13 +107,24 @@ To calculate record, use Wins and Losses, and you're going to have to add the mo
 Don't query on BettingBetType unless the user specifically asks for one of these. This is because not all players or games have these types of bets and you are likely to get an empty response.
 </special_instructions_props>
 
-<question>
 
 
-Given the database schema, here is the SQL query that answers `{user_question}`:
 
-</question>
 
+Your response will be executed on a database of NFL Player Logs and the answer will be returned to the User, so make sure the query is correct and will return the correct information.
+You may have to use the "like" operator to match player names, as the user may not provide the full name of the player or the database may have a different format for the player name. Please don't use the "like" operator unless necessary since it can lead to overcounting.
+
+If the question cannot be answered with the data provided, please return the string "Error: Cannot answer question with data provided."
+
+Do not use functions that are not available in SQLite. Do not use functions that are not available in SQLite. Do not create new columns, only use what is provided.
+Make sure you surround columns with double quotes since it is case sensitive. An example is p."PlayerName". 
+For game days, you can use the Day column, if you don't have the time of the game. Make sure your date format is consistent with the data.
+This is a postgres database. Do not create any new columns or tables. Only reference columns that are in the database schema provided.
+Make sure you use parentheses correctly in your queries as well as commas to make logical sense. For example AND "TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur' should be AND ("TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur') since the OR should be in parentheses.
+"""
+
+request_template = """
+This is the current date: {current_date}
 
 Here is an example response for the question {match_question}:
 
@@ -119,21 +136,17 @@ Here is an example response for the question {match_question}:
 
 </example_response>
 
+<question>
+Given the database schema, here is the SQL query that answers `{user_question}`:
+</question>
 
-Your response will be executed on a database of NFL Player Logs and the answer will be returned to the User, so make sure the query is correct and will return the correct information.
-You may have to use the "like" operator to match player names, as the user may not provide the full name of the player or the database may have a different format for the player name. Please don't use the "like" operator unless necessary since it can lead to overcounting.
-
-If the question cannot be answered with the data provided, please return the string "Error: Cannot answer question with data provided."
-
-Do not use functions that are not available in SQLite. Do not use functions that are not available in SQLite. Do not create new columns, only use what is provided.
-Make sure you surround columns with double quotes since it is case sensitive. An example is p."PlayerName". 
-This is the current date: {current_date}
-For game days, you can use the Day column, if you don't have the time of the game. Make sure your date format is consistent with the data.
-This is a postgres database. Do not create any new columns or tables. Only reference columns that are in the database schema provided.
-Make sure you use parentheses correctly in your queries as well as commas to make logical sense. For example AND "TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur' should be AND ("TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur') since the OR should be in parentheses.
 """
 
+
 prompt_template += add_line
+# Everything above is the same on every call; the per-request parts go last so the
+# provider can serve the long static prefix from its prompt cache
+prompt_template += request_template
 prompt_template +=  "Assistant: "
 
 
@@ -318,6 +331,8 @@ College (text) - The college the player attended
 Experience (double precision) - The number of years the player has played in the NFL. Since it is updated every spring, rookies in the 2024 season have a value of 2.
 """
 
+register_metadata(testnfl_metadata, 'playerlog')
+
 props_metadata = """
 GlobalHomeTeamID (bigint) 
 PointSpreadAwayTeamMoneyLine (bigint)
@@ -415,29 +430,44 @@ MoneyPercentage (double precision) - Percentage of money on this outcome, a lot
 
 """
 
+register_metadata(props_metadata, 'props')
+
+
+# Used instead of sql_prompt when the schema is pruned for the question
+pruned_sql_prompt = PromptTemplate.from_template(schema_last(prompt_template, request_template))
+
+register_prompt('PlayerLogAndProps', sql_prompt, {"player_log_table_metadata_string": testnfl_metadata, "props_table_metadata_string": props_metadata})
+register_prompt('PlayerLogAndProps (pruned)', pruned_sql_prompt, {}, enabled=SCHEMA_PRUNING_ENABLED)
+
+# The prompt and full schema never change, so they are only tokenized once; a pruned
+# schema is counted for the call that renders it
+static_input_tokens = count_tokens(prompt_template)
+schema_tokens = count_tokens(testnfl_metadata) + count_tokens(props_metadata)
+
 
-def player_log_and_props_get_answer(model, question):
+def player_log_and_props_get_answer(model, question, embedding=None, temperature=None, tier=0, owner=None, match=None):
     llm = None
-    input_count = count_tokens(question)
-    input_count += count_tokens(prompt_template)
-    input_count += count_tokens(testnfl_metadata)
-    input_count += count_tokens(props_metadata)
-    matched_question, matched_sql_query = get_closest_embedding(question, model="text-embedding-3-large", top_k=1)
+    input_count = static_input_tokens + count_tokens(question)
+    matched_question, matched_sql_query = match or get_closest_embedding(question, model="text-embedding-3-large", top_k=1, embedding=embedding)
     input_count += count_tokens(matched_question)
     input_count += count_tokens(matched_sql_query)
     if model == 'openai':
         try:
-            llm = ChatOpenAI(model='gpt-4o', temperature=0.96)
+            llm = get_llm('openai', stage_model('sql', tier), 0.96 if temperature is None else temperature)
         except Exception as e:
             print("key not given", e)
 
     elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-5-sonnet-20240620', temperature=0.5)
+        llm = get_llm('anthropic', 'claude-3-5-sonnet-20240620', 0.5 if temperature is None else temperature)
 
     print(llm)
-    llm_chain = sql_prompt | llm
-    answer = llm_chain.invoke(
-        {'user_question': question, "player_log_table_metadata_string": testnfl_metadata, "props_table_metadata_string": props_metadata, "current_date": str(datetime.datetime.today()).split()[0], "match_question": matched_question, "matched_sql_query": matched_sql_query})
+    (player_log_table_metadata, props_table_metadata), pruned = prune_schema(
+        'PlayerLogAndProps', question, embedding, [(testnfl_metadata, PLAYER_KEY_COLUMNS), (props_metadata, PROPS_KEY_COLUMNS)], owner=owner)
+    prompt = pruned_sql_prompt if pruned else sql_prompt
+    input_count += count_tokens(player_log_table_metadata) + count_tokens(props_table_metadata) if pruned else schema_tokens
+    values = {'user_question': question, "player_log_table_metadata_string": player_log_table_metadata, "props_table_metadata_string": props_table_metadata, "current_date": str(datetime.datetime.today()).split()[0], "match_question": matched_question, "matched_sql_query": matched_sql_query}
+    answer = generate_sql(prompt, llm, values, owner=owner)
+    check_prompt_call('PlayerLogAndProps (pruned)' if pruned else 'PlayerLogAndProps', values, answer)
     return_answer = answer.content
-    output_count = count_tokens(return_answer)
+    input_count, output_count = usage_counts(answer, input_count)
     return return_answer, input_count, output_count
@@ -0,0 +1,108 @@
+import os
+import re
+import threading
+
+import dotenv
+
+from utils.sql_reuse import TEAMS
+
+dotenv.load_dotenv()
+
+
+# Answers small talk and rejects obviously off-topic messages before they cost a router call.
+# Rules only ever match whole messages, so anything with a real question in it goes through.
+
+PRE_ROUTER_ENABLED = os.getenv('PRE_ROUTER_ENABLED', 'true').lower() == 'true'
+
+
+_name = r'(?:\s+(?:billy|bot|there|man|bro|guys))?'
+_end = r'[\s!.,?:)(-]*$'
+
+RULES = [
+    ('greeting', 'Conversation',
+     re.compile(r'^\s*(?:hi+|hello+|hey+|yo+|sup|what\'?s up|howdy|hiya|good (?:morning|afternoon|evening))' + _name + _end, re.IGNORECASE),
+     "Hey! I'm Billy. Ask me anything about NFL teams, players, games or betting lines."),
+    ('thanks', 'Conversation',
+     re.compile(r'^\s*(?:thanks?(?: you)?(?: so much| a lot)?|thx|ty|appreciate it|cheers|great|awesome|nice|cool|perfect|got it|ok(?:ay)?)' + _name + _end, re.IGNORECASE),
+     "Anytime! Let me know if you have any other NFL questions."),
+    ('goodbye', 'Conversation',
+     re.compile(r'^\s*(?:bye+|goodbye|see y(?:a|ou)(?: later)?|later|good ?night|gn)' + _name + _end, re.IGNORECASE),
+     "See you later! Come back any time you have an NFL question."),
+    ('help', 'Conversation',
+     re.compile(r'^\s*(?:help|who are you|what are you|what can you do|how does this work)' + _name + _end, re.IGNORECASE),
+     "I'm Billy. I can look up NFL team and player stats, play by play data, game results, "
+     "against the spread records, player props and futures. Try something like "
+     "\"How many rushing yards does Saquon Barkley have this season?\""),
+]
+
+OFF_TOPIC = [
+    re.compile(r'\b(?:nba|mlb|nhl|mls|wnba|ncaa|premier league|la liga|champions league|formula 1|f1|ufc|pga|nascar)\b', re.IGNORECASE),
+    re.compile(r'\b(?:basketball|baseball|hockey|soccer|tennis|golf|cricket)\b', re.IGNORECASE),
+    re.compile(r'\b(?:write|give) me (?:a|an|some) (?:poem|essay|story|song|recipe|joke|code|program|script)\b', re.IGNORECASE),
+    re.compile(r'\b(?:recipe|stock price|crypto|bitcoin|translate)\b', re.IGNORECASE),
+]
+
+OFF_TOPIC_RESPONSE = "I can only help with NFL questions, such as stats, games, players and betting lines."
+
+# Anything that looks like football keeps the message away from the off-topic rules. Being
+# rejected here is final, so when in doubt a word goes on this list and the router decides.
+_football = re.compile(
+    r'\b(?:nfl|football|super ?bowl|touchdowns?|td|quarterbacks?|qb|rb|wr|te|yards?|rushing|passing|'
+    r'receiving|receivers?|running backs?|tight ends?|linebackers?|cornerbacks?|kickers?|punters?|'
+    r'sacks?|tackles?|interceptions?|fumbles?|field goals?|fantasy|spread|over/under|props?|odds|'
+    r'bets?|betting|draft(?:ed)?|playoffs?|players?|teams?|coach(?:es)?|rookies?|roster|mvp|'
+    r'games?|season|week|contracts?|salary|signed|paid|injur(?:y|ies|ed)|'
+    + '|'.join(re.escape(name.lower()) for team in TEAMS for name in team[1:] if name) + r')\b',
+    re.IGNORECASE)
+
+
+_lock = threading.Lock()
+_stats = {
+    'messages': 0,
+    'answered': 0,
+    'rejected': 0,
+    'rules': {},
+}
+
+
+def _count(rule):
+    with _lock:
+        _stats['rules'][rule] = _stats['rules'].get(rule, 0) + 1
+
+
+def pre_route(message):
+    # Returns (bucket, response) for messages that need no LLM, or None
+    with _lock:
+        _stats['messages'] += 1
+
+    if not PRE_ROUTER_ENABLED or not message or '\n' in message.strip():
+        return None
+
+    for rule, bucket, pattern, response in RULES:
+        if pattern.match(message):
+            _count(rule)
+            with _lock:
+                _stats['answered'] += 1
+            return bucket, response
+
+    if not _football.search(message):
+        for pattern in OFF_TOPIC:
+            if pattern.search(message):
+                _count('off_topic')
+                with _lock:
+                    _stats['rejected'] += 1
+                return 'NoBucket', OFF_TOPIC_RESPONSE
+
+    return None
+
+
+def pre_router_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['rules'] = dict(_stats['rules'])
+
+    stats['enabled'] = PRE_ROUTER_ENABLED
+    absorbed = stats['answered'] + stats['rejected']
+    stats['absorbed'] = absorbed
+    stats['absorbed_rate'] = absorbed / stats['messages'] if stats['messages'] else 0.0
+    return stats
@@ -0,0 +1,107 @@
+import hashlib
+import logging
+import os
+import threading
+
+import dotenv
+
+from utils.CountUtil import count_tokens
+
+dotenv.load_dotenv()
+
+
+# Provider prompt caching only matches on an identical prefix, so each SQL prompt keeps its
+# instructions and schema first and the question, example and date last. This module checks
+# that the layout holds: at import for the template, and on each call for the values passed in.
+# The import-time findings are debug logs, since they are about the template, not a request.
+
+# Share of a prompt's static text that should sit in front of the first per-request value
+PROMPT_PREFIX_MIN_RATIO = float(os.getenv('PROMPT_PREFIX_MIN_RATIO', 0.9))
+
+# OpenAI only caches prompts of at least this many tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_layouts = {}
+
+
+def stable_prefix(prompt, static_values):
+    # Renders the prompt with two different sets of per-request values; what they share is the prefix
+    dynamic = [name for name in prompt.input_variables if name not in static_values]
+    first = prompt.format(**static_values, **{name: f'\x00{name}' for name in dynamic})
+    second = prompt.format(**static_values, **{name: f'\x01{name}' for name in dynamic})
+    prefix = os.path.commonprefix([first, second])
+
+    static_chars = len(first) - sum(len(f'\x00{name}') for name in dynamic)
+    return prefix, static_chars
+
+
+def _fingerprint(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def register_prompt(name, prompt, static_values, enabled=True):
+    # enabled is False for a prompt that won't be used, e.g. the pruned one with pruning off
+    if not enabled:
+        return
+
+    prefix, static_chars = stable_prefix(prompt, static_values)
+    ratio = len(prefix) / static_chars if static_chars else 0.0
+    prefix_tokens = count_tokens(prefix)
+
+    if ratio < PROMPT_PREFIX_MIN_RATIO:
+        logger.debug('Prompt %s: only %.0f%% of the static text is in the cacheable prefix', name, ratio * 100)
+    if prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+        logger.debug('Prompt %s: prefix is %d tokens, too short to be cached', name, prefix_tokens)
+
+    with _lock:
+        _layouts[name] = {
+            'static': dict(static_values),
+            'fingerprint': _fingerprint(prefix),
+            'prefix_tokens': prefix_tokens,
+            'prefix_ratio': ratio,
+            'calls': 0,
+            'unstable': 0,
+            'input_tokens': 0,
+            'cached_tokens': 0,
+        }
+
+
+def _cached_tokens(response):
+    # Only newer OpenAI responses report this; anything else counts as unknown (0)
+    metadata = getattr(response, 'response_metadata', None) or {}
+    usage = metadata.get('token_usage') or metadata.get('usage') or {}
+    details = usage.get('prompt_tokens_details') or {}
+    return details.get('cached_tokens') or usage.get('cache_read_input_tokens') or 0
+
+
+def check_prompt_call(name, values, response=None):
+    layout = _layouts.get(name)
+    if layout is None:
+        return
+
+    # The template is fixed, so the prefix only changes if a static value does; comparing
+    # the values saves rendering the prompt again next to the chain's own render
+    stable = all(values[key] == value for key, value in layout['static'].items())
+    if not stable:
+        print(f'Prompt {name}: static prefix changed between calls, provider prompt cache will miss')
+
+    usage = getattr(response, 'usage_metadata', None) or {}
+    with _lock:
+        layout['calls'] += 1
+        layout['unstable'] += 0 if stable else 1
+        layout['input_tokens'] += usage.get('input_tokens', 0)
+        layout['cached_tokens'] += _cached_tokens(response)
+
+
+def prompt_layout_stats():
+    stats = {}
+    with _lock:
+        for name, layout in _layouts.items():
+            stats[name] = {key: value for key, value in layout.items() if key != 'static'}
+            stats[name]['cached_ratio'] = (layout['cached_tokens'] / layout['input_tokens']
+                                           if layout['input_tokens'] else 0.0)
+    return stats
@@ -9,7 +9,12 @@ from langchain_anthropic import ChatAnthropic
 import re
 from datetime import datetime
 from utils.cache import get_closest_embedding
-from utils.CountUtil import count_tokens
+from utils.CountUtil import count_tokens, usage_counts
+from utils.schema import register_metadata
+from utils.llm_clients import get_llm
+from utils.model_tiers import stage_model
+from utils.prompt_layout import check_prompt_call, register_prompt
+from utils.sql_stream import generate_sql
 import dotenv
 dotenv.load_dotenv()
 
@@ -110,12 +115,13 @@ BetPercentage (double precision) - Percentage of bets on this outcome, a lot of
 MoneyPercentage (double precision) - Percentage of money on this outcome, a lot of these are NaN, but some are not
 """
 
+register_metadata(props_metadata, 'props')
+
 
 prompt_template = """
 
 <instructions>
-You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is:
-`{user_question}`
+You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is at the end of this prompt.
 
 </instructions>
 
@@ -138,12 +144,6 @@ Don't query on BettingBetType unless the user specifically asks for one of these
 </special_instructions>
 
 
-<question>
-
-
-Given the database schema, here is the SQL query that answers `{user_question}`:
-
-</question>
 
 
 Here is an example response for the question: "What is the average point spread for home teams in games where the over/under is greater than 45 and the game has already started but is not yet over?"
@@ -153,15 +153,6 @@ If the question cannot be answered with the data provided, return the string "ca
 This is a postgres database. Do not create any new columns or tables. Only use the columns that are in the table.
 
 
-Here is an example response for the question: {matched_question}
-<example_response>
-
-
-```sql
-{matched_sql_query}
-```
-
-</example_response>
 
 
 Your response will be executed on a database of NFL Betting Prompts and the answer will be returned to the User, so make sure the query is correct and will return the correct information.
@@ -174,30 +165,56 @@ If the question cannot be answered with the data provided, please return the str
 
 Do not use functions that are not available in SQLite. Do not use functions that are not available in SQLite. Do not create new columns, only use what is provided.
 Make sure you surround columns with double quotes since it is case sensitive. An example is p."PlayerName". 
-This is the current date: {current_date}
 For game days, you can use the Day column, if you don't have the time of the game. Make sure your date format is consistent with the data.
 This is a postgres database. Do not create any new columns or tables. Only reference columns that are in the database schema provided.
 Make sure you use parentheses correctly in your queries as well as commas to make logical sense. For example AND "TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur' should be AND ("TeamCoach" = 'Matt LaFleur' OR "OpponentCoach" = 'Matt LaFleur') since the OR should be in parentheses.
 """
 
+request_template = """
+This is the current date: {current_date}
+
+Here is an example response for the question: {matched_question}
+<example_response>
+
+
+```sql
+{matched_sql_query}
+```
+
+</example_response>
+
+<question>
+Given the database schema, here is the SQL query that answers `{user_question}`:
+</question>
+
+"""
+
+
 prompt_template += add_line
+# Everything above is the same on every call; the per-request parts go last so the
+# provider can serve the long static prefix from its prompt cache
+prompt_template += request_template
 prompt_template += "Assistant: "
 
 
 sql_prompt = PromptTemplate.from_template(prompt_template)
 
 
-def props_log_get_answer(model, question):
+register_prompt('Props', sql_prompt, {"table_metadata_string": props_metadata})
+
+# The prompt and schema never change, so they are only tokenized once
+static_input_tokens = count_tokens(prompt_template) + count_tokens(props_metadata)
+
+
+def props_log_get_answer(model, question, embedding=None, temperature=None, tier=0, owner=None, match=None):
     llm = None
-    input_count = count_tokens(question)
-    input_count += count_tokens(prompt_template)
-    input_count += count_tokens(props_metadata)
+    input_count = static_input_tokens + count_tokens(question)
 
 
 
 
 
-    matched_question, matched_sql_query = get_closest_embedding(question, model="text-embedding-3-large", top_k=1)
+    matched_question, matched_sql_query = match or get_closest_embedding(question, model="text-embedding-3-large", top_k=1, embedding=embedding)
 
     input_count += count_tokens(matched_question)
     input_count += count_tokens(matched_sql_query)
@@ -205,18 +222,18 @@ def props_log_get_answer(model, question):
 
     if model == 'openai':
         try:
-            llm = ChatOpenAI(model='gpt-4o', temperature=0.96)
+            llm = get_llm('openai', stage_model('sql', tier), 0.96 if temperature is None else temperature)
         except Exception as e:
             print("key not given", e)
 
     elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-5-sonnet-20240620', temperature=0.5)
+        llm = get_llm('anthropic', 'claude-3-5-sonnet-20240620', 0.5 if temperature is None else temperature)
 
     print(llm)
-    llm_chain = sql_prompt | llm
     print(sql_prompt)
-    answer = llm_chain.invoke(
-        {'user_question': question, "table_metadata_string": props_metadata, 'current_date': datetime.now().strftime('%Y-%m-%d-%H-%M-%S'), 'matched_question': matched_question, 'matched_sql_query': matched_sql_query})
-    output_count = count_tokens(answer.content)
+    values = {'user_question': question, "table_metadata_string": props_metadata, 'current_date': datetime.now().strftime('%Y-%m-%d-%H-%M-%S'), 'matched_question': matched_question, 'matched_sql_query': matched_sql_query}
+    answer = generate_sql(sql_prompt, llm, values, owner=owner)
+    check_prompt_call('Props', values, answer)
+    input_count, output_count = usage_counts(answer, input_count)
 
     return answer.content, input_count, output_count
@@ -4,7 +4,9 @@ from langchain_openai import OpenAI, ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from dotenv import load_dotenv
 import datetime
-from utils.CountUtil import count_tokens
+from utils.CountUtil import count_tokens, usage_counts
+from utils.llm_clients import get_llm
+from utils.model_tiers import can_escalate, record_escalation, record_request, router_escalation, stage_call
 
 load_dotenv()
 
@@ -72,38 +74,52 @@ billy_prompt = PromptTemplate.from_template(prompt_template)
 # Function to ask Billy
 
 
+# The prompt never changes, so it is only tokenized once
+static_input_tokens = count_tokens(prompt_template)
+
+
 def question_chooser(model, question):
 
-    input_count = count_tokens(question)
-    input_count += count_tokens(prompt_template)
+    input_count = static_input_tokens + count_tokens(question)
 
 
     current_date = str(datetime.datetime.today()).split()[0]
     print('Question: ' + question)
     start = time.time()
 
-    llm = None
-    if model == 'openai':
-        llm = ChatOpenAI(model='gpt-4', temperature=0.3)
-
-    elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-5-sonnet-20240620', temperature=0.5,
-                            )
-
-    llm_chain = billy_prompt | llm
-
-    llm_response = llm_chain.invoke({'user_question': question, 'current_date': current_date})
-
-
-    response_text = llm_response.content
-
-    output_count = count_tokens(response_text)
-
-    bucket, question = extract_bucket_and_question(response_text)
-
-  
-
-    return bucket, question, input_count, output_count
+    record_request('router')
+    total_input = total_output = 0
+    tier = 0
+    while True:
+        # Only the OpenAI router is tiered
+        escalate = model == 'openai' and can_escalate('router', tier)
+        with stage_call('router', tier) as router_model:
+            llm = None
+            if model == 'openai':
+                llm = get_llm('openai', router_model, 0.3)
+                if escalate:
+                    # Logprobs give a confidence for the bucket the cheap router picks
+                    llm = llm.bind(logprobs=True)
+
+            elif model == 'anthropic':
+                llm = get_llm('anthropic', 'claude-3-5-sonnet-20240620', 0.5)
+
+            llm_chain = billy_prompt | llm
+
+            llm_response = llm_chain.invoke({'user_question': question, 'current_date': current_date})
+
+        response_input, response_output = usage_counts(llm_response, input_count)
+        total_input += response_input
+        total_output += response_output
+
+        bucket, rewritten = extract_bucket_and_question(llm_response.content)
+        reason = router_escalation(llm_response, bucket) if escalate else None
+        if reason is None:
+            break
+        record_escalation('router', reason)
+        tier += 1
+
+    return bucket, rewritten, total_input, total_output
 
 
 def extract_bucket_and_question(input_string):
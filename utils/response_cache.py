@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+
+import dotenv
+
+from utils.data_version import get_data_version, on_data_version_change
+from utils.embedding_cache import normalize_text
+from utils.lru import LRUCache
+
+dotenv.load_dotenv()
+
+
+# Whole answers for questions that were already asked against the current data: the SQL,
+# its result and the answer text, so a repeat skips routing, retrieval, SQL generation,
+# execution and the answer model. Entries are keyed on the data version, so a data load
+# retires them, and they expire after a week regardless in case a load doesn't bump it.
+
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 5000))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 7 * 24 * 3600))
+
+# Characters per socket event when replaying an answer, so it still arrives as a stream
+REPLAY_CHUNK_CHARS = 40
+
+
+# (question, bucket, data version) -> stored response
+_responses = LRUCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES,
+                      sizeof=lambda response: len(repr(response)))
+
+# Message as typed -> (bucket, question) the router made of it, so hits skip the router too
+_routes = LRUCache(RESPONSE_CACHE_MAX_ENTRIES * 2)
+
+
+def _clear(version):
+    _responses.clear()
+    _routes.clear()
+
+
+on_data_version_change(_clear)
+
+
+_lock = threading.Lock()
+_stats = {
+    'lookups': 0,
+    'hits': 0,
+    'expired': 0,
+    'stored': 0,
+    'saved_cost': 0.0,
+}
+
+
+def _cacheable(message):
+    # A message carrying chat history depends on the conversation, not just the question
+    return RESPONSE_CACHE_ENABLED and bool(message) and '\n' not in message.strip()
+
+
+def _key(question, bucket):
+    return normalize_text(question), bucket, get_data_version()
+
+
+def get_cached_response(message):
+    if not _cacheable(message):
+        return None
+
+    with _lock:
+        _stats['lookups'] += 1
+
+    route = _routes.get((normalize_text(message), get_data_version()))
+    if route is None:
+        return None
+
+    key = _key(route[1], route[0])
+    response = _responses.get(key)
+    if response is None:
+        return None
+    if time.time() - response['stored_at'] > RESPONSE_CACHE_TTL:
+        _responses.pop(key)
+        with _lock:
+            _stats['expired'] += 1
+        return None
+
+    with _lock:
+        _stats['hits'] += 1
+        _stats['saved_cost'] += response['cost']
+    return response
+
+
+def store_response(message, bucket, question, query, result, answer, cost):
+    if not _cacheable(message) or not answer or not isinstance(result, list) or not result:
+        return
+
+    _responses.set(_key(question, bucket), {
+        'bucket': bucket,
+        'question': question,
+        'query': query,
+        'result': result,
+        'answer': answer,
+        'cost': cost,
+        'stored_at': time.time(),
+    })
+    _routes.set((normalize_text(message), get_data_version()), (bucket, question))
+    with _lock:
+        _stats['stored'] += 1
+
+
+def replay_chunks(answer):
+    # The growing answer text, the same shape the live stream emits
+    for end in range(REPLAY_CHUNK_CHARS, len(answer) + REPLAY_CHUNK_CHARS, REPLAY_CHUNK_CHARS):
+        yield answer[:end]
+
+
+def response_cache_stats():
+    with _lock:
+        stats = dict(_stats)
+
+    stats.update({key: value for key, value in _responses.stats().items() if key in ('entries', 'bytes', 'evictions')})
+    stats['enabled'] = RESPONSE_CACHE_ENABLED
+    stats['ttl'] = RESPONSE_CACHE_TTL
+    stats['data_version'] = get_data_version()
+    stats['hit_rate'] = stats['hits'] / stats['lookups'] if stats['lookups'] else 0.0
+    return stats
@@ -0,0 +1,68 @@
+import hashlib
+import os
+import re
+
+import dotenv
+
+from utils.data_version import get_data_version, on_data_version_change
+from utils.lru import LRUCache
+
+dotenv.load_dotenv()
+
+
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 2000))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+
+# Quoted identifiers and string literals are case sensitive, so they are kept as-is
+_quoted = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+_comments = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+_whitespace = re.compile(r'\s+')
+_punctuation_space = re.compile(r'\s*([(),;=<>+\-*/])\s*')
+
+
+def canonicalize_sql(query):
+    parts = []
+    for i, part in enumerate(_quoted.split(query)):
+        if i % 2:
+            parts.append(part)
+            continue
+        part = _comments.sub(' ', part)
+        part = _whitespace.sub(' ', part).lower()
+        part = _punctuation_space.sub(r'\1', part)
+        parts.append(part)
+
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def sql_fingerprint(query):
+    return hashlib.sha256(canonicalize_sql(query).encode('utf-8')).hexdigest()
+
+
+# Values are (rows, tokens), so a hit can be checked against the caller's token budget
+_cache = LRUCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES,
+                  sizeof=lambda entry: len(repr(entry[0])))
+
+# Entries are keyed on the data version as well, this just frees the memory early
+on_data_version_change(lambda version: _cache.clear())
+
+
+def get_cached_result(query):
+    # Returns (rows, tokens) or None
+    if not RESULT_CACHE_ENABLED or not query:
+        return None
+    return _cache.get((sql_fingerprint(query), get_data_version()))
+
+
+def store_result(query, rows, tokens):
+    if not RESULT_CACHE_ENABLED or not query or not isinstance(rows, list):
+        return
+    _cache.set((sql_fingerprint(query), get_data_version()), (rows, tokens))
+
+
+def result_cache_stats():
+    stats = _cache.stats()
+    stats['enabled'] = RESULT_CACHE_ENABLED
+    stats['data_version'] = get_data_version()
+    return stats
@@ -0,0 +1,318 @@
+import re
+import threading
+from collections import OrderedDict
+
+from utils.sql_repair import UNDEFINED_COLUMN, UNDEFINED_TABLE
+
+
+# Which tables each bucket's prompt lets the model query
+BUCKET_TABLES = {
+    'TeamGameLog': ['teamlog', 'teamgames'],
+    'PlayerGameLog': ['playerlog'],
+    'PlayByPlay': ['playbyplay'],
+    'TeamAndPlayerLog': ['teamlog', 'playerlog'],
+    'Props': ['props'],
+    'PlayerLogAndProps': ['playerlog', 'props'],
+    'TeamLogAndProps': ['teamlog', 'teamgames', 'props'],
+    'Futures': ['futurestable'],
+}
+
+
+class SchemaValidationError(Exception):
+    # Carries a SQLSTATE so the repair loop treats it like the error Postgres would have raised
+
+    def __init__(self, message, pgcode):
+        super().__init__(message)
+        self.pgcode = pgcode
+
+
+_lock = threading.Lock()
+_tables = {}
+
+_column_line = re.compile(r'^\s*"?([A-Za-z_]\w*)"?\s*\(')
+_table_header = re.compile(r"""^\s*(?:Table:\s*|Columns in table\s+)['"`]?(\w+)""", re.IGNORECASE)
+
+
+def parse_metadata(metadata, table=None):
+    # Turns a bucket's hand-written schema block into {table: {column: description}}
+    tables = OrderedDict()
+    current = None
+
+    for line in metadata.splitlines():
+        header = _table_header.match(line)
+        if header:
+            table = header.group(1).lower()
+            continue
+
+        match = _column_line.match(line)
+        if match and table:
+            current = match.group(1)
+            tables.setdefault(table, OrderedDict())[current] = line.strip()
+        elif current and table and line.strip():
+            # Continuation of a multi-line description, e.g. a list of possible values
+            tables[table][current] += ' ' + line.strip()
+
+    return tables
+
+
+def metadata_lines(metadata):
+    # Yields (column, line) for each line, with column None for headers, blank lines and prose
+    current = None
+    for line in metadata.splitlines():
+        if _table_header.match(line):
+            current = None
+            yield None, line
+            continue
+
+        match = _column_line.match(line)
+        if match:
+            current = match.group(1)
+        elif not line.strip():
+            current = None
+        yield current, line
+
+
+def register_metadata(metadata, table=None):
+    for name, columns in parse_metadata(metadata, table).items():
+        with _lock:
+            known = _tables.setdefault(name, OrderedDict())
+            for column, description in columns.items():
+                known.setdefault(column, description)
+
+
+def register_columns(table, columns):
+    with _lock:
+        known = _tables.setdefault(table.lower(), OrderedDict())
+        for column in columns:
+            known.setdefault(column, column)
+
+
+def set_table_columns(table, columns):
+    # Replaces what is known about a table, keeping the descriptions of columns it still has
+    with _lock:
+        known = _tables.get(table.lower(), {})
+        _tables[table.lower()] = OrderedDict((column, known.get(column, column)) for column in columns)
+
+
+def tables_for_bucket(bucket):
+    if bucket in BUCKET_TABLES:
+        return BUCKET_TABLES[bucket]
+    with _lock:
+        return list(_tables)
+
+
+def table_columns(table):
+    with _lock:
+        return OrderedDict(_tables.get(table.lower(), ()))
+
+
+def columns_for_bucket(bucket):
+    columns = OrderedDict()
+    for table in tables_for_bucket(bucket):
+        columns.update(table_columns(table))
+    return columns
+
+
+_token = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>(?:[EeBbXxNn])?'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*")
+  | (?P<word>[A-Za-z_][\w$]*)
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)
+  | (?P<cast>::)
+  | (?P<symbol>[^\s\w])
+""", re.VERBOSE | re.DOTALL)
+
+_clause_end = {
+    'where', 'group', 'order', 'having', 'limit', 'offset', 'union', 'except', 'intersect',
+    'window', 'fetch', 'for', 'on', 'using', 'returning',
+}
+_not_aliases = _clause_end | {
+    'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'natural', 'lateral', 'as',
+}
+
+# Keywords that double as column names (Day, Date, Week...), so a bare one proves nothing
+_keyword_columns = {'date', 'day', 'week', 'month', 'year', 'time', 'type', 'name', 'value', 'status'}
+
+
+def _tokenize(query):
+    tokens = []
+    for match in _token.finditer(query):
+        kind = match.lastgroup
+        if kind == 'comment':
+            continue
+        text = match.group(kind)
+        if kind == 'quoted':
+            text = text[1:-1].replace('""', '"')
+        tokens.append((kind, text))
+    return tokens
+
+
+def _is_word(token, *words):
+    return token is not None and token[0] == 'word' and token[1].lower() in words
+
+
+def _scan(tokens):
+    # Collects table references, CTE names, aliases and identifiers in one pass
+    tables = []
+    ctes = set()
+    aliases = set()
+    alias_tables = {}
+    identifiers = []
+
+    # Each open parenthesis is either a subquery, where FROM introduces tables,
+    # or an expression / function call, e.g. EXTRACT(YEAR FROM "Date"), where it does not
+    stack = ['query']
+    in_from = False
+
+    def at(i):
+        return tokens[i] if 0 <= i < len(tokens) else None
+
+    i = 0
+    while i < len(tokens):
+        kind, text = tokens[i]
+        lower = text.lower() if kind == 'word' else None
+
+        if kind == 'symbol' and text == '(':
+            nxt = at(i + 1)
+            stack.append('query' if _is_word(nxt, 'select', 'with', 'values') else 'expr')
+            in_from = False
+            i += 1
+            continue
+
+        if kind == 'symbol' and text == ')':
+            if len(stack) > 1:
+                stack.pop()
+            in_from = False
+            i += 1
+            continue
+
+        if kind in ('word', 'quoted') and (_is_word(at(i - 1), 'with', 'recursive') or (
+                at(i - 1) is not None and at(i - 1)[1] == ',')):
+            # name AS ( ... ) or name (column, ...) AS ( ... ) inside a WITH clause
+            j = i + 1
+            columns = []
+            if at(j) is not None and at(j)[1] == '(':
+                j += 1
+                while at(j) is not None and at(j)[0] in ('word', 'quoted'):
+                    columns.append(at(j)[1].lower())
+                    j += 1
+                    if at(j) is None or at(j)[1] != ',':
+                        break
+                    j += 1
+                j = j + 1 if at(j) is not None and at(j)[1] == ')' and columns else i + 1
+            if _is_word(at(j), 'as'):
+                k = j + 1
+                if _is_word(at(k), 'not'):
+                    k += 1
+                if _is_word(at(k), 'materialized'):
+                    k += 1
+                if at(k) is not None and at(k)[1] == '(':
+                    ctes.add(text.lower())
+                    aliases.update(columns)
+                    i = k
+                    continue
+
+        if _is_word(at(i), 'as') and at(i + 1) is not None and at(i + 1)[0] in ('word', 'quoted'):
+            aliases.add(at(i + 1)[1].lower())
+
+        is_distinct_from = lower == 'from' and _is_word(at(i - 1), 'distinct')
+        if (stack[-1] == 'query' and lower in ('from', 'join') and not is_distinct_from) or (
+                in_from and kind == 'symbol' and text == ','):
+            in_from = True
+            j = i + 1
+            if _is_word(at(j), 'lateral', 'only'):
+                j += 1
+            name = at(j)
+            if name is not None and name[0] in ('word', 'quoted'):
+                table = name[1]
+                if at(j + 1) is not None and at(j + 1)[1] == '.' and at(j + 2) is not None and at(j + 2)[0] in ('word', 'quoted'):
+                    j += 2
+                    table = at(j)[1]
+                if at(j + 1) is None or at(j + 1)[1] != '(':
+                    tables.append(table.lower())
+                    k = j + 1
+                    if _is_word(at(k), 'as'):
+                        k += 1
+                    alias = at(k)
+                    if alias is not None and alias[0] in ('word', 'quoted') and alias[1].lower() not in _not_aliases:
+                        alias_tables[alias[1].lower()] = table.lower()
+                        aliases.add(alias[1].lower())
+                    alias_tables[table.lower()] = table.lower()
+                    identifiers.append((j, 'table', table))
+                    i = j + 1
+                    continue
+            i += 1
+            continue
+
+        if lower in _clause_end or lower in ('select', 'set'):
+            in_from = False
+
+        if kind in ('quoted', 'word'):
+            # An alias without AS, e.g. SUM("Score") "total_points" or "Score" points
+            prev, nxt = at(i - 1), at(i + 1)
+            if prev is not None and (prev[1] == ')' or prev[0] in ('quoted', 'string', 'number') or _is_word(prev, 'end')) and (
+                    nxt is None or nxt[1] in (',', ')', ';') or _is_word(nxt, 'from')):
+                aliases.add(text.lower())
+            identifiers.append((i, kind, text))
+
+        i += 1
+
+    return tables, ctes, aliases, alias_tables, identifiers
+
+
+def validate_sql(query, bucket=None):
+    # Raises SchemaValidationError for identifiers the bucket's schema does not know about
+    if not query:
+        return
+
+    with _lock:
+        if not _tables:
+            return
+
+    tokens = _tokenize(query)
+    tables, ctes, aliases, alias_tables, identifiers = _scan(tokens)
+
+    allowed_tables = {table.lower() for table in tables_for_bucket(bucket)}
+    for table in tables:
+        if table in ctes or table in allowed_tables:
+            continue
+        with _lock:
+            known = table in _tables
+        if not known:
+            raise SchemaValidationError(f'relation "{table}" does not exist', UNDEFINED_TABLE)
+
+    referenced = [table for table in tables if table not in ctes]
+    if not referenced:
+        return
+
+    columns = {}
+    for table in referenced:
+        columns.update({column: table for column in table_columns(table)})
+    lowered = {column.lower(): column for column in columns}
+    names = ctes | aliases | set(alias_tables) | set(referenced)
+
+    for index, kind, text in identifiers:
+        if kind == 'table':
+            continue
+
+        nxt = tokens[index + 1] if index + 1 < len(tokens) else None
+        prev = tokens[index - 1] if index > 0 else None
+
+        # Qualifiers like p."Name" and function calls like "SUM"(...) are not columns
+        if nxt is not None and nxt[1] in ('.', '('):
+            continue
+        if prev is not None and prev[0] == 'cast':
+            continue
+
+        if kind == 'quoted':
+            if text in columns or text.lower() in names:
+                continue
+            raise SchemaValidationError(f'column "{text}" does not exist', UNDEFINED_COLUMN)
+
+        # An unquoted CamelCase column is folded to lowercase by Postgres and will not be found
+        if text.lower() in _keyword_columns or (nxt is not None and nxt[0] in ('string', 'word')):
+            continue
+        column = lowered.get(text.lower())
+        if column is not None and column != column.lower() and text.lower() not in names:
+            raise SchemaValidationError(f'column "{text.lower()}" does not exist', UNDEFINED_COLUMN)
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import random
+import re
+import threading
+
+import dotenv
+import numpy as np
+
+from utils.cache import get_embedding, get_embeddings
+from utils.CountUtil import count_tokens
+from utils.lru import LRUCache
+from utils.schema import metadata_lines
+
+dotenv.load_dotenv()
+
+
+# Sends only the columns relevant to the question instead of the whole catalog. Columns are
+# ranked by how close their description is to the question embedding; the key columns every
+# query needs are always kept.
+
+SCHEMA_PRUNING_ENABLED = os.getenv('SCHEMA_PRUNING_ENABLED', 'false').lower() == 'true'
+SCHEMA_PRUNING_TOP_K = int(os.getenv('SCHEMA_PRUNING_TOP_K', 40))
+
+# Share of requests that get a pruned schema, so accuracy can be compared against full prompts
+SCHEMA_PRUNING_SAMPLE = float(os.getenv('SCHEMA_PRUNING_SAMPLE', 1.0))
+
+PLAYER_KEY_COLUMNS = ['GameKey', 'PlayerID', 'Name', 'Team', 'Opponent', 'HomeOrAway', 'Position',
+                      'Season', 'SeasonType', 'Week', 'GameDate', 'Played', 'Started']
+TEAM_KEY_COLUMNS = ['GameKey', 'Date', 'Team', 'Opponent', 'HomeOrAway', 'Season', 'SeasonType', 'Week',
+                    'Score', 'OpponentScore', 'PointSpread', 'OverUnder', 'Wins', 'Losses']
+PROPS_KEY_COLUMNS = ['GameKey', 'PlayerID', 'Name', 'Team', 'Season', 'SeasonType', 'Week', 'SportsBook',
+                     'BettingMarketType', 'BettingBetType', 'Value', 'PayoutAmerican', 'Url']
+
+# Question words, to spot columns like "RushingYards" asked about as "rushing yards"
+_word = re.compile(r'[a-z0-9]+')
+
+
+_lock = threading.Lock()
+_indexes = {}
+
+# Which calls were pruned, so their outcome can be attributed when it comes in. Keyed by
+# owner too, since parallel SQL candidates for one question can get different variants
+_pending = LRUCache(1000)
+
+_stats = {}
+
+
+def _bucket_stats(bucket):
+    return _stats.setdefault(bucket, {
+        'requests': 0,
+        'pruned': 0,
+        'full_tokens': 0,
+        'pruned_tokens': 0,
+        'outcomes': {'pruned': {'ok': 0, 'failed': 0}, 'full': {'ok': 0, 'failed': 0}},
+    })
+
+
+def _column_index(metadata):
+    # Column descriptions and their embeddings, built once per metadata string
+    key = hashlib.sha256(metadata.encode('utf-8')).hexdigest()
+    index = _indexes.get(key)
+    if index is not None:
+        return index
+
+    descriptions = {}
+    for column, line in metadata_lines(metadata):
+        if column:
+            descriptions[column] = (descriptions.get(column, '') + ' ' + line.strip()).strip()
+
+    columns = list(descriptions)
+    matrix = np.asarray(get_embeddings([descriptions[column] for column in columns]), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    index = (columns, matrix / norms)
+    with _lock:
+        _indexes[key] = index
+    return index
+
+
+def _mentioned(columns, question):
+    # Columns named outright in the question, e.g. "PassingYards" or "passing yards"
+    words = ''.join(_word.findall(question.lower()))
+    return {column for column in columns if len(column) > 3 and column.lower() in words}
+
+
+def prune_metadata(metadata, embedding, question='', always_include=(), top_k=None):
+    columns, matrix = _column_index(metadata)
+    top_k = top_k or SCHEMA_PRUNING_TOP_K
+    if len(columns) <= top_k:
+        return metadata
+
+    vector = np.asarray(embedding, dtype=np.float32)
+    scores = matrix @ (vector / (np.linalg.norm(vector) or 1.0))
+    best = np.argpartition(-scores, top_k - 1)[:top_k]
+
+    keep = {columns[i] for i in best} | set(always_include) | _mentioned(columns, question)
+    return '\n'.join(line for column, line in metadata_lines(metadata) if column is None or column in keep)
+
+
+def prune_schema(bucket, question, embedding, schemas, owner=None):
+    # schemas is [(metadata, key columns)]; returns the metadata strings to render, pruned or not
+    full = [metadata for metadata, _ in schemas]
+    with _lock:
+        stats = _bucket_stats(bucket)
+        stats['requests'] += 1
+
+    if not SCHEMA_PRUNING_ENABLED or random.random() >= SCHEMA_PRUNING_SAMPLE:
+        _pending.set((bucket, question, owner), 'full')
+        return full, False
+
+    try:
+        if embedding is None:
+            embedding = get_embedding(question)
+        pruned = [prune_metadata(metadata, embedding, question, key_columns) for metadata, key_columns in schemas]
+    except Exception as e:
+        print(f'Schema pruning failed, sending the full schema: {e}')
+        _pending.set((bucket, question, owner), 'full')
+        return full, False
+
+    full_tokens = sum(count_tokens(metadata) for metadata in full)
+    pruned_tokens = sum(count_tokens(metadata) for metadata in pruned)
+    print(f'Schema pruned from {full_tokens} to {pruned_tokens} tokens')
+
+    with _lock:
+        stats['pruned'] += 1
+        stats['full_tokens'] += full_tokens
+        stats['pruned_tokens'] += pruned_tokens
+    _pending.set((bucket, question, owner), 'pruned')
+    return pruned, True
+
+
+def record_schema_outcome(bucket, question, ok, owner=None):
+    # ok None drops the call without an outcome, e.g. a candidate cancelled before it ran
+    variant = _pending.pop((bucket, question, owner))
+    if variant is None or ok is None:
+        return
+    with _lock:
+        _bucket_stats(bucket)['outcomes'][variant]['ok' if ok else 'failed'] += 1
+
+
+def schema_last(prompt_template, request_template):
+    # The same prompt with the <database_schema> block moved down to just before the
+    # per-request part, so a per-question schema doesn't break the cacheable prefix
+    block = re.search(r'<database_schema>.*?</database_schema>\n', prompt_template, re.DOTALL)
+    if block is None:
+        return prompt_template
+
+    pointer = '<database_schema>\nThe schema for this question is given after these instructions.\n</database_schema>\n'
+    template = prompt_template[:block.start()] + pointer + prompt_template[block.end():]
+    position = template.rindex(request_template)
+    return template[:position] + '\n' + block.group(0) + template[position:]
+
+
+def schema_pruning_stats():
+    with _lock:
+        stats = {bucket: dict(values, outcomes={variant: dict(counts) for variant, counts in values['outcomes'].items()})
+                 for bucket, values in _stats.items()}
+
+    for values in stats.values():
+        values['saved_tokens'] = values['full_tokens'] - values['pruned_tokens']
+        values['saved_ratio'] = values['saved_tokens'] / values['full_tokens'] if values['full_tokens'] else 0.0
+        for counts in values['outcomes'].values():
+            total = counts['ok'] + counts['failed']
+            counts['success_rate'] = counts['ok'] / total if total else 0.0
+
+    return {
+        'enabled': SCHEMA_PRUNING_ENABLED,
+        'top_k': SCHEMA_PRUNING_TOP_K,
+        'sample': SCHEMA_PRUNING_SAMPLE,
+        'buckets': stats,
+    }
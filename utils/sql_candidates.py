@@ -0,0 +1,256 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+import dotenv
+
+from utils.executor import QueryCancelled, ResultTooLarge, cancel_queries, execute_query, extract_sql_query
+from utils.model_tiers import can_escalate, record_escalation, record_request, sql_escalation, stage_call
+from utils.schema_pruning import record_schema_outcome
+from utils.sql_reuse import is_plausible
+from utils.sql_stream import cancel_generation
+
+dotenv.load_dotenv()
+
+
+# Asks for several SQL queries at once instead of waiting on the serial repair loop. Each
+# candidate is generated at its own temperature, then validated and executed; the first one
+# that comes back with rows wins and the rest are cancelled, whether they are still
+# generating or already running their query. With model tiering the candidates start on the
+# cheap model, and a new round runs on the strong one when none of them gives a usable query.
+
+# 1 keeps the single query path
+SQL_CANDIDATES = int(os.getenv('SQL_CANDIDATES', 1))
+
+SQL_CANDIDATE_TEMPERATURES = [float(t) for t in os.getenv('SQL_CANDIDATE_TEMPERATURES', '0.2,0.6,0.9,1.0').split(',')]
+
+SQL_CANDIDATE_WORKERS = int(os.getenv('SQL_CANDIDATE_WORKERS', 16))
+
+# Seconds to wait for the losing candidates to stop, so their tokens are part of the request's cost
+SQL_CANDIDATE_CANCEL_WAIT = float(os.getenv('SQL_CANDIDATE_CANCEL_WAIT', 2))
+
+
+_pool = ThreadPoolExecutor(max_workers=SQL_CANDIDATE_WORKERS)
+
+_lock = threading.Lock()
+
+# Request owner -> the owners its candidates run their queries under
+_running = {}
+
+_stats = {
+    'requests': 0,
+    'candidates': 0,
+    'no_winner': 0,
+    'cancelled': 0,
+    'abandoned': 0,
+    'winners': {},
+    'input_tokens': 0,
+    'output_tokens': 0,
+    'ms': 0.0,
+}
+
+
+def candidate_temperatures(n=None):
+    n = n or SQL_CANDIDATES
+    return [SQL_CANDIDATE_TEMPERATURES[i % len(SQL_CANDIDATE_TEMPERATURES)] for i in range(n)]
+
+
+def _candidate(get_answer_func, bucket, question, embedding, match, temperature, tier, owner, max_tokens, max_rows, done):
+    candidate = {'temperature': temperature, 'tier': tier, 'owner': owner, 'raw_query': '', 'query': None, 'result': None,
+                 'too_large': False, 'cancelled': False, 'input_tokens': 0, 'output_tokens': 0}
+    if done.is_set():
+        candidate['cancelled'] = True
+        return candidate
+
+    with stage_call('sql', tier):
+        raw_query, input_tokens, output_tokens = get_answer_func('openai', question, embedding=embedding, match=match,
+                                                                 temperature=temperature, tier=tier, owner=owner)
+    with _lock:
+        _stats['input_tokens'] += input_tokens
+        _stats['output_tokens'] += output_tokens
+
+    candidate.update(raw_query=raw_query, input_tokens=input_tokens, output_tokens=output_tokens)
+    if 'error' in raw_query.lower() or 'cannot' in raw_query.lower():
+        return candidate
+
+    candidate['query'] = extract_sql_query(raw_query)
+    if done.is_set():
+        # Another candidate won while this one was generating
+        candidate['cancelled'] = True
+        return candidate
+    if not candidate['query']:
+        return candidate
+
+    try:
+        candidate['result'] = execute_query(candidate['query'], max_tokens=max_tokens, max_rows=max_rows,
+                                            bucket=bucket, owner=owner)
+    except ResultTooLarge:
+        candidate['too_large'] = True
+    except QueryCancelled:
+        candidate['cancelled'] = True
+    return candidate
+
+
+def _schema_outcome(candidate):
+    # Same outcomes the single query path records; a cancelled candidate never got one
+    if candidate['cancelled']:
+        return None
+    if candidate['too_large']:
+        return True
+    if 'error' in candidate['raw_query'].lower() or 'cannot' in candidate['raw_query'].lower():
+        return False
+    return is_plausible(candidate['result'])
+
+
+def _fallback(finished):
+    # Nobody returned rows: an empty result can still be the right answer, then a result
+    # that was too big to show, then whatever error came back
+    finished = sorted(finished, key=lambda candidate: candidate['temperature'])
+    for candidate in finished:
+        if isinstance(candidate['result'], list):
+            return candidate
+    for candidate in finished:
+        if candidate['too_large']:
+            raise ResultTooLarge('Every candidate query returned too much data')
+    for candidate in finished:
+        if candidate['query']:
+            return candidate
+    return finished[0] if finished else None
+
+
+def _escalation(candidate, bucket):
+    # Same reasons as the single query path; an empty result is an answer, not a failure
+    if candidate is None:
+        return 'no_candidate'
+    if isinstance(candidate['result'], list):
+        return None
+    return sql_escalation(candidate['raw_query'], candidate['query'], bucket) or 'execution_error'
+
+
+def _run_round(get_answer_func, bucket, question, embedding, match, tier, owner, max_tokens, max_rows, n):
+    # One candidate per temperature on the tier's model; returns the winner (or None) and every finished candidate
+    temperatures = candidate_temperatures(n)
+    owners = [f'{owner}#{tier}.{i}' if owner is not None else None for i in range(len(temperatures))]
+    done = threading.Event()
+    with _lock:
+        _stats['candidates'] += len(temperatures)
+        if owner is not None:
+            _running[owner] = owners
+
+    futures = {
+        _pool.submit(_candidate, get_answer_func, bucket, question, embedding, match, temperature, tier, candidate_owner,
+                     max_tokens, max_rows, done): candidate_owner
+        for temperature, candidate_owner in zip(temperatures, owners)
+    }
+
+    winner = None
+    finished = []
+    collected = set()
+
+    def collect(future):
+        collected.add(future)
+        try:
+            candidate = future.result()
+        except Exception as e:
+            print(f'SQL candidate failed: {e}')
+            record_schema_outcome(bucket, question, None, owner=futures[future])
+            return None
+        finished.append(candidate)
+        record_schema_outcome(bucket, question, _schema_outcome(candidate), owner=candidate['owner'])
+        return candidate
+
+    try:
+        for future in as_completed(futures):
+            candidate = collect(future)
+            if candidate is not None and is_plausible(candidate['result']):
+                winner = candidate
+                break
+    finally:
+        # Candidates that haven't started are dropped; the others stop generating or running
+        # their query, and are waited for so their tokens are counted
+        done.set()
+        pending = [future for future in futures if not future.done()]
+        for future in futures:
+            # Finished in the meantime, but as_completed hadn't handed it over yet
+            if future.done() and future not in pending and future not in collected:
+                collect(future)
+        for future in pending:
+            if not future.cancel() and futures[future] is not None:
+                cancel_generation(futures[future])
+                cancel_queries(futures[future])
+        stopped, abandoned = wait([future for future in pending if not future.cancelled()], timeout=SQL_CANDIDATE_CANCEL_WAIT)
+        for future in stopped:
+            collect(future)
+        for future in abandoned:
+            # Its tokens still reach the totals in /stats when it finishes
+            future.add_done_callback(lambda future: record_schema_outcome(bucket, question, None, owner=futures[future]))
+        with _lock:
+            _running.pop(owner, None)
+            _stats['cancelled'] += len(pending)
+            _stats['abandoned'] += len(abandoned)
+
+    return winner, finished
+
+
+def run_candidates(get_answer_func, bucket, question, embedding=None, match=None, owner=None, max_tokens=None, max_rows=None,
+                   n=None):
+    # Returns (raw_query, query, result, input_tokens, output_tokens, tier) like the single query path;
+    # tokens cover every candidate, including the ones stopped once the winner was picked
+    start = time.perf_counter()
+    record_request('sql')
+    with _lock:
+        _stats['requests'] += 1
+
+    tier = 0
+    finished = []
+    while True:
+        winner, round_finished = _run_round(get_answer_func, bucket, question, embedding, match, tier, owner,
+                                            max_tokens, max_rows, n)
+        finished += round_finished
+        if winner is not None or not can_escalate('sql', tier):
+            break
+        fallback = _fallback([candidate for candidate in round_finished if not candidate['cancelled']])
+        reason = _escalation(fallback, bucket)
+        if reason is None:
+            break
+        record_escalation('sql', reason)
+        tier += 1
+
+    ms = (time.perf_counter() - start) * 1000
+    with _lock:
+        _stats['ms'] += ms
+        if winner is None:
+            _stats['no_winner'] += 1
+        else:
+            key = str(winner['temperature'])
+            _stats['winners'][key] = _stats['winners'].get(key, 0) + 1
+
+    if winner is None:
+        # Only the last round's candidates: an earlier tier's query is what escalating replaced
+        winner = _fallback([candidate for candidate in round_finished if not candidate['cancelled']])
+        if winner is None:
+            return 'Error: Cannot answer question with data provided.', None, None, 0, 0, tier
+    else:
+        print(f"SQL candidate at temperature {winner['temperature']} won after {ms:.0f} ms")
+
+    input_tokens = sum(candidate['input_tokens'] for candidate in finished)
+    output_tokens = sum(candidate['output_tokens'] for candidate in finished)
+    return winner['raw_query'], winner['query'], winner['result'], input_tokens, output_tokens, tier
+
+
+def cancel_candidates(owner):
+    with _lock:
+        owners = list(_running.get(owner, ()))
+    return sum(cancel_generation(candidate_owner) + cancel_queries(candidate_owner) for candidate_owner in owners)
+
+
+def sql_candidates_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['winners'] = dict(_stats['winners'])
+
+    stats['enabled'] = SQL_CANDIDATES > 1
+    stats['temperatures'] = candidate_temperatures()
+    stats['avg_ms'] = stats['ms'] / stats['requests'] if stats['requests'] else 0.0
+    return stats
@@ -0,0 +1,116 @@
+import difflib
+import re
+
+
+# Postgres SQLSTATE codes we know how to react to
+UNDEFINED_COLUMN = '42703'
+UNDEFINED_TABLE = '42P01'
+SYNTAX_ERROR = '42601'
+AMBIGUOUS_COLUMN = '42702'
+QUERY_CANCELED = '57014'
+
+
+_missing_column = re.compile(r'column (?:"?(\w+)"?\.)?"?([^"\s]+)"? does not exist')
+_hinted_column = re.compile(r'Perhaps you meant to reference the column "(?:\w+\.)?(\w+)"')
+_semicolon_before_paren = re.compile(r';\s*\)')
+_quoted = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def classify_error(error):
+    code = getattr(error, 'pgcode', None) or getattr(error, 'sqlstate', None)
+    message = str(error)
+
+    if code == QUERY_CANCELED or type(error).__name__ == 'QueryTimeout':
+        return 'timeout'
+    if code == UNDEFINED_COLUMN or _missing_column.search(message):
+        return 'undefined_column'
+    if code == UNDEFINED_TABLE or ('relation' in message and 'does not exist' in message):
+        return 'undefined_table'
+    if code == AMBIGUOUS_COLUMN:
+        return 'ambiguous_column'
+    if code == SYNTAX_ERROR or 'syntax error' in message:
+        return 'syntax'
+    return 'other'
+
+
+def _replace_outside_strings(query, pattern, replacement):
+    # Only touch SQL text and double-quoted identifiers, never string literals
+    parts = _quoted.split(query)
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            parts[i] = pattern.sub(replacement, part)
+    return ''.join(parts)
+
+
+def _quote_identifier(query, bad_name, column):
+    # Replace both the quoted and the bare spelling of the bad identifier
+    quoted_bad = re.compile(r'"' + re.escape(bad_name) + r'"')
+    parts = _quoted.split(query)
+    for i, part in enumerate(parts):
+        if i % 2 and quoted_bad.fullmatch(part):
+            parts[i] = f'"{column}"'
+    query = ''.join(parts)
+
+    bare_bad = re.compile(r'(?<![\w"])' + re.escape(bad_name) + r'(?![\w"(])', re.IGNORECASE)
+    return _replace_outside_strings(query, bare_bad, f'"{column}"')
+
+
+def _fix_undefined_column(query, error, columns):
+    message = str(error)
+    match = _missing_column.search(message)
+    if not match:
+        return None
+    bad_name = match.group(2)
+
+    # Postgres usually suggests the right column itself
+    hint = _hinted_column.search(message)
+    if hint:
+        return _quote_identifier(query, bad_name, hint.group(1))
+
+    # An unquoted CamelCase column gets folded to lowercase by Postgres
+    if bad_name == bad_name.lower():
+        bare = re.search(r'(?<![\w"])(' + re.escape(bad_name) + r')(?![\w"])', query, re.IGNORECASE)
+        if bare and bare.group(1) != bad_name:
+            return _quote_identifier(query, bad_name, bare.group(1))
+
+    if columns:
+        lowered = {column.lower(): column for column in columns}
+        if bad_name.lower() in lowered:
+            return _quote_identifier(query, bad_name, lowered[bad_name.lower()])
+
+        close = difflib.get_close_matches(bad_name, list(columns), n=1, cutoff=0.8)
+        if close:
+            return _quote_identifier(query, bad_name, close[0])
+
+    return None
+
+
+def _fix_syntax(query, error):
+    # A statement terminator inside a subquery, e.g. "(SELECT ... ;)"
+    fixed = _replace_outside_strings(query, _semicolon_before_paren, ')')
+    if fixed != query:
+        return fixed
+
+    # More than one trailing semicolon
+    if re.search(r';\s*;\s*$', query):
+        return re.sub(r'[;\s]+$', '', query) + ';'
+
+    return None
+
+
+def local_fix(query, error, columns=None):
+    # Cheap deterministic fixes tried before asking the LLM; returns None if nothing applies
+    if not query:
+        return None
+
+    kind = classify_error(error)
+    if kind == 'undefined_column':
+        fixed = _fix_undefined_column(query, error, columns)
+    elif kind == 'syntax':
+        fixed = _fix_syntax(query, error)
+    else:
+        fixed = None
+
+    if fixed is None or fixed == query:
+        return None
+    return fixed
@@ -0,0 +1,313 @@
+import difflib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import dotenv
+
+from utils.executor import RESULT_ROW_BUDGET, RESULT_TOKEN_BUDGET, execute_query
+from utils.schema import SchemaValidationError, validate_sql
+
+dotenv.load_dotenv()
+
+
+# When a question is a near-duplicate of a curated example, the example's SQL is reused
+# with the teams, seasons and players swapped in, and SQL generation is skipped.
+#   off    - never (the default)
+#   shadow - build the reused query, but still generate one, and compare what the two return
+#   on     - execute the reused query, falling back to generation if it fails or is empty
+# Shadow mode runs every reused query a second time against the database, so it is meant for a
+# measurement window: set SQL_REUSE_MODE=shadow and restart, watch sql_reuse in /stats until
+# shadow_compared is large enough to trust shadow_agreement at the current SQL_REUSE_THRESHOLD,
+# then set it back to off, or to on if the agreement is good enough.
+SQL_REUSE_MODE = os.getenv('SQL_REUSE_MODE', 'off').lower()
+SQL_REUSE_THRESHOLD = float(os.getenv('SQL_REUSE_THRESHOLD', 0.93))
+
+
+# (abbreviation, city, nickname); ambiguous cities like New York or Los Angeles are left out
+TEAMS = [
+    ('ARI', 'Arizona', 'Cardinals'), ('ATL', 'Atlanta', 'Falcons'), ('BAL', 'Baltimore', 'Ravens'),
+    ('BUF', 'Buffalo', 'Bills'), ('CAR', 'Carolina', 'Panthers'), ('CHI', 'Chicago', 'Bears'),
+    ('CIN', 'Cincinnati', 'Bengals'), ('CLE', 'Cleveland', 'Browns'), ('DAL', 'Dallas', 'Cowboys'),
+    ('DEN', 'Denver', 'Broncos'), ('DET', 'Detroit', 'Lions'), ('GB', 'Green Bay', 'Packers'),
+    ('HOU', 'Houston', 'Texans'), ('IND', 'Indianapolis', 'Colts'), ('JAX', 'Jacksonville', 'Jaguars'),
+    ('KC', 'Kansas City', 'Chiefs'), ('LAC', None, 'Chargers'), ('LAR', None, 'Rams'),
+    ('LV', 'Las Vegas', 'Raiders'), ('MIA', 'Miami', 'Dolphins'), ('MIN', 'Minnesota', 'Vikings'),
+    ('NE', 'New England', 'Patriots'), ('NO', 'New Orleans', 'Saints'), ('NYG', None, 'Giants'),
+    ('NYJ', None, 'Jets'), ('PHI', 'Philadelphia', 'Eagles'), ('PIT', 'Pittsburgh', 'Steelers'),
+    ('SEA', 'Seattle', 'Seahawks'), ('SF', 'San Francisco', '49ers'), ('TB', 'Tampa Bay', 'Buccaneers'),
+    ('TEN', 'Tennessee', 'Titans'), ('WAS', 'Washington', 'Commanders'),
+]
+
+_team_names = {}
+for _abbreviation, _city, _nickname in TEAMS:
+    _team_names[_nickname.lower()] = _abbreviation
+    if _city:
+        _team_names[_city.lower()] = _abbreviation
+        _team_names[f'{_city} {_nickname}'.lower()] = _abbreviation
+_team_names.update({'niners': 'SF', 'bucs': 'TB', 'pats': 'NE', 'jags': 'JAX', 'commies': 'WAS'})
+
+# Abbreviations are matched case-sensitively so "NO" and "NE" don't fire on ordinary words
+_team_pattern = re.compile(
+    r'\b(' + '|'.join(sorted((re.escape(name) for name in _team_names), key=len, reverse=True)) + r')\b'
+    r'|\b(' + '|'.join(abbreviation for abbreviation, _, _ in TEAMS) + r')\b',
+    re.IGNORECASE)
+
+_season = re.compile(r'\b(19[5-9]\d|20\d\d)\b')
+_word = re.compile(r"[A-Za-z0-9][\w'.-]*")
+_literal = re.compile(r"'((?:[^']|'')*)'")
+
+# Words that can differ between two phrasings of the same question
+_filler = {
+    'a', 'an', 'the', 'this', 'that', 'these', 'those', 'is', 'are', 'was', 'were', 'be', 'been',
+    'do', 'does', 'did', 'has', 'have', 'had', 'please', 'so', 'far', 'currently', 'now', "what's",
+    'whats', 'what', 'tell', 'me', 'show', 'us', 'i', 'you', 'can', 'could', 'would', 'will',
+}
+
+
+# Shadow comparisons run the reused query off the request path
+_shadow_pool = ThreadPoolExecutor(max_workers=int(os.getenv('SQL_REUSE_SHADOW_WORKERS', 2)))
+
+_lock = threading.Lock()
+_stats = {
+    'lookups': 0,
+    'candidates': 0,
+    'reused': 0,
+    'rejected': {},
+    'executions': 0,
+    'execution_failures': 0,
+    'shadow_compared': 0,
+    'shadow_agreed': 0,
+    'shadow_skipped': 0,
+}
+
+
+def _team_of(match):
+    name, abbreviation = match.group(1), match.group(2)
+    if name:
+        return _team_names[name.lower()]
+    if abbreviation.isupper():
+        return abbreviation
+    return None
+
+
+def _entities(question):
+    # Returns the question's words with teams and seasons masked, plus the teams and seasons in order
+    teams = []
+    seasons = []
+    tokens = []
+
+    position = 0
+    spans = []
+    for match in _team_pattern.finditer(question):
+        team = _team_of(match)
+        if team:
+            spans.append((match.start(), match.end(), '<team>'))
+            teams.append(team)
+    for match in _season.finditer(question):
+        if not any(start <= match.start() < end for start, end, _ in spans):
+            spans.append((match.start(), match.end(), '<season>'))
+    spans.sort()
+    seasons = [question[start:end] for start, end, kind in spans if kind == '<season>']
+
+    for start, end, kind in spans:
+        tokens.extend(_word.findall(question[position:start]))
+        tokens.append(kind)
+        position = end
+    tokens.extend(_word.findall(question[position:]))
+
+    return tokens, teams, seasons
+
+
+def _is_filler(words):
+    return all(word.lower().strip('.') in _filler for word in words)
+
+
+def _trim_filler(words):
+    while words and _is_filler(words[:1]):
+        words = words[1:]
+    while words and _is_filler(words[-1:]):
+        words = words[:-1]
+    return words
+
+
+def _player_swaps(old_tokens, new_tokens):
+    # Differing spans between the two phrasings; anything that isn't filler must be a name
+    # that the SQL mentions in a string literal, otherwise the questions really differ
+    matcher = difflib.SequenceMatcher(a=[token.lower() for token in old_tokens],
+                                      b=[token.lower() for token in new_tokens], autojunk=False)
+    swaps = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        old_words, new_words = old_tokens[i1:i2], new_tokens[j1:j2]
+        if _is_filler(old_words) and _is_filler(new_words):
+            continue
+        if tag != 'replace' or '<team>' in old_words + new_words or '<season>' in old_words + new_words:
+            return None
+
+        # "did Saquon Barkley" vs "does Josh Allen" is a swap of the names only
+        old_words, new_words = _trim_filler(old_words), _trim_filler(new_words)
+        if not old_words or not new_words:
+            return None
+        new_name = ' '.join(new_words)
+        if new_name == new_name.lower():
+            new_name = new_name.title()
+        swaps.append((' '.join(old_words), new_name))
+    return swaps
+
+
+def substitute(sql_query, teams, seasons, swaps):
+    # One pass over the query so swapping KC and BUF around doesn't undo itself.
+    # Returns the new query and which of the old entities were actually found.
+    used = set()
+
+    def swap_seasons(text):
+        def season(match):
+            used.add(('season', match.group(0)))
+            return seasons[match.group(0)]
+        if not seasons:
+            return text
+        return re.sub(r'\b(' + '|'.join(map(re.escape, seasons)) + r')\b', season, text)
+
+    def literal(match):
+        text = match.group(1).replace("''", "'")
+        if text.upper() in teams:
+            used.add(('team', text.upper()))
+            text = teams[text.upper()]
+        else:
+            for old, new in swaps:
+                swapped = re.sub(re.escape(old), new, text, flags=re.IGNORECASE)
+                if swapped != text:
+                    used.add(('player', old))
+                    text = swapped
+            text = swap_seasons(text)
+        return "'" + text.replace("'", "''") + "'"
+
+    parts = []
+    position = 0
+    for match in _literal.finditer(sql_query):
+        parts.append(swap_seasons(sql_query[position:match.start()]))
+        parts.append(literal(match))
+        position = match.end()
+    parts.append(swap_seasons(sql_query[position:]))
+
+    return ''.join(parts), used
+
+
+def _reject(reason):
+    with _lock:
+        _stats['rejected'][reason] = _stats['rejected'].get(reason, 0) + 1
+    print(f'SQL reuse rejected: {reason}')
+    return None
+
+
+def reuse_sql(question, matched_question, matched_sql_query, score):
+    # The matched example's SQL rewritten for this question, or None if it can't be reused safely
+    with _lock:
+        _stats['lookups'] += 1
+
+    if SQL_REUSE_MODE == 'off' or not matched_sql_query or score is None or score < SQL_REUSE_THRESHOLD:
+        return None
+    with _lock:
+        _stats['candidates'] += 1
+
+    old_tokens, old_teams, old_seasons = _entities(matched_question)
+    new_tokens, new_teams, new_seasons = _entities(question)
+
+    if len(old_teams) != len(new_teams):
+        return _reject('team_count')
+    if len(old_seasons) != len(new_seasons):
+        return _reject('season_count')
+
+    swaps = _player_swaps(old_tokens, new_tokens)
+    if swaps is None:
+        return _reject('different_question')
+
+    teams = {old: new for old, new in zip(old_teams, new_teams) if old != new}
+    seasons = {old: new for old, new in zip(old_seasons, new_seasons) if old != new}
+
+    query, used = substitute(matched_sql_query, teams, seasons, swaps)
+
+    # Every entity that changed has to have been found in the SQL, or the result is stale
+    if any(('team', old) not in used for old in teams):
+        return _reject('team_not_in_sql')
+    if any(('season', old) not in used for old in seasons):
+        return _reject('season_not_in_sql')
+    if any(('player', old) not in used for old, _ in swaps):
+        return _reject('difference_not_in_sql')
+
+    try:
+        validate_sql(query)
+    except SchemaValidationError as e:
+        return _reject(f'invalid_sql: {e}')
+
+    with _lock:
+        _stats['reused'] += 1
+    print(f'Reusing SQL from "{matched_question}" (score {score:.3f})')
+    return query
+
+
+def is_plausible(result):
+    return isinstance(result, list) and len(result) > 0
+
+
+def record_execution(result):
+    with _lock:
+        _stats['executions'] += 1
+        if not is_plausible(result):
+            _stats['execution_failures'] += 1
+
+
+def _canonical(result):
+    # Rows as sorted value tuples, so column names, column order and row order don't matter
+    rows = []
+    for row in result:
+        values = row.values() if isinstance(row, dict) else row
+        rows.append(tuple(sorted(repr(round(float(value), 4)) if isinstance(value, (float, Decimal)) else repr(value)
+                                 for value in values)))
+    return sorted(rows)
+
+
+def _shadow(reused_query, generated_result, bucket):
+    try:
+        reused_result = execute_query(reused_query, max_tokens=RESULT_TOKEN_BUDGET, max_rows=RESULT_ROW_BUDGET,
+                                      bucket=bucket)
+    except Exception as e:
+        print(f'SQL reuse shadow query failed: {e}')
+        reused_result = None
+
+    agreed = isinstance(reused_result, list) and _canonical(reused_result) == _canonical(generated_result)
+    with _lock:
+        _stats['shadow_compared'] += 1
+        if agreed:
+            _stats['shadow_agreed'] += 1
+    print(f'SQL reuse shadow comparison: {"agreed" if agreed else "differed"}')
+
+
+def record_shadow(reused_query, generated_result, bucket=None):
+    # Whether the reused query returns what the generated one did is the accuracy estimate for
+    # the threshold. Comparing the SQL itself would count every rewording by the model as a miss.
+    if not isinstance(generated_result, list):
+        # Nothing trustworthy to compare against
+        with _lock:
+            _stats['shadow_skipped'] += 1
+        return
+    _shadow_pool.submit(_shadow, reused_query, generated_result, bucket)
+
+
+def sql_reuse_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['rejected'] = dict(_stats['rejected'])
+
+    stats['mode'] = SQL_REUSE_MODE
+    stats['threshold'] = SQL_REUSE_THRESHOLD
+    stats['hit_rate'] = stats['reused'] / stats['lookups'] if stats['lookups'] else 0.0
+    stats['shadow_agreement'] = (stats['shadow_agreed'] / stats['shadow_compared']
+                                 if stats['shadow_compared'] else 0.0)
+    stats['execution_success'] = (1 - stats['execution_failures'] / stats['executions']
+                                  if stats['executions'] else 0.0)
+    return stats
@@ -0,0 +1,125 @@
+import os
+import re
+import threading
+import time
+
+import dotenv
+from langchain_core.messages import AIMessage
+from langchain_openai import ChatOpenAI
+
+dotenv.load_dotenv()
+
+
+# Streams SQL generation so a generation nobody needs anymore can be stopped: cancelling its
+# owner stops it at the next chunk. With SQL_STREAM_STOP_EARLY it also stops reading as soon
+# as the ```sql block closes, so whatever the model would have written after the query is
+# never waited for and closing the stream makes the provider stop generating it.
+
+SQL_STREAMING = os.getenv('SQL_STREAMING', 'true').lower() == 'true'
+
+# The provider only reports usage in the stream's last chunk, so stopping early trades the
+# exact token counts for latency and falls back to estimates
+SQL_STREAM_STOP_EARLY = os.getenv('SQL_STREAM_STOP_EARLY', 'false').lower() == 'true'
+
+# Same block extract_sql_query looks for
+_closed_block = re.compile(r'```sql\n(.*?)\n```', re.DOTALL)
+
+
+_lock = threading.Lock()
+_stats = {
+    'calls': 0,
+    'streamed': 0,
+    'query_closed': 0,
+    'stopped_early': 0,
+    'cancelled': 0,
+    'exact_usage': 0,
+    'ms_to_query': 0.0,
+    'ms': 0.0,
+}
+
+# Generations currently streaming, by owner, and whether they have been cancelled
+_generating = {}
+
+
+def cancel_generation(owner):
+    # Stops the owner's streaming generation at its next chunk; a blocking invoke can't be stopped
+    with _lock:
+        cancel = _generating.get(owner)
+    if cancel is None:
+        return 0
+    cancel.set()
+    return 1
+
+
+def _with_usage(llm):
+    # langchain-openai only sends usage on a stream when asked to, and only the OpenAI API
+    # takes stream_options; a ResilientLLM passes bound kwargs to its primary only
+    if getattr(llm, 'provider', None) == 'openai' or isinstance(llm, ChatOpenAI):
+        return llm.bind(stream_options={'include_usage': True})
+    return llm
+
+
+def generate_sql(prompt, llm, values, owner=None):
+    # Drop-in for (prompt | llm).invoke(values); returns the message received, up to the end
+    # of the SQL block when stopping early
+    with _lock:
+        _stats['calls'] += 1
+
+    if not SQL_STREAMING:
+        return (prompt | llm).invoke(values)
+
+    start = time.perf_counter()
+    message = None
+    query_ms = None
+    cancel = threading.Event()
+    if owner is not None:
+        with _lock:
+            _generating[owner] = cancel
+    stream = (prompt | _with_usage(llm)).stream(values)
+    try:
+        for chunk in stream:
+            message = chunk if message is None else message + chunk
+            if cancel.is_set():
+                break
+            # The fence can be split across chunks, so any backtick is worth a look
+            if (query_ms is None and isinstance(chunk.content, str) and '`' in chunk.content
+                    and _closed_block.search(message.content)):
+                query_ms = (time.perf_counter() - start) * 1000
+                if SQL_STREAM_STOP_EARLY:
+                    break
+    finally:
+        stream.close()
+        if owner is not None:
+            with _lock:
+                _generating.pop(owner, None)
+
+    ms = (time.perf_counter() - start) * 1000
+    with _lock:
+        _stats['streamed'] += 1
+        _stats['ms'] += ms
+        if cancel.is_set():
+            _stats['cancelled'] += 1
+        if query_ms is not None:
+            _stats['stopped_early' if SQL_STREAM_STOP_EARLY else 'query_closed'] += 1
+            _stats['ms_to_query'] += query_ms
+        if getattr(message, 'usage_metadata', None):
+            _stats['exact_usage'] += 1
+
+    if message is None:
+        if cancel.is_set():
+            return AIMessage(content='')
+        # Nothing came back; let the regular call raise or return whatever it does
+        return (prompt | llm).invoke(values)
+    return message
+
+
+def sql_stream_stats():
+    with _lock:
+        stats = dict(_stats)
+
+    stats['enabled'] = SQL_STREAMING
+    stats['stop_early'] = SQL_STREAM_STOP_EARLY
+    closed = stats['query_closed'] + stats['stopped_early']
+    stats['avg_ms'] = stats['ms'] / stats['streamed'] if stats['streamed'] else 0.0
+    stats['avg_ms_to_query'] = stats['ms_to_query'] / closed if closed else 0.0
+    return stats
@@ -0,0 +1,107 @@
+import re
+import sys
+
+import dotenv
+import psycopg2
+
+from utils.db_pool import DATABASE_URL
+from utils.schema import register_metadata, set_table_columns, table_columns
+
+dotenv.load_dotenv()
+
+
+# teamlog has two rows per game, one from each side. teamgames keeps the home team's row
+# so record and ATS questions don't need SELECT DISTINCT ON ("GameKey") over teamlog.
+create_view_sql = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS teamgames AS
+SELECT DISTINCT ON (t."GameKey")
+    t.*,
+    (t."Score" + t."PointSpread") - t."OpponentScore" AS "CoverMargin",
+    CASE
+        WHEN t."PointSpread" IS NULL THEN NULL
+        WHEN (t."Score" + t."PointSpread") - t."OpponentScore" > 0 THEN 'Cover'
+        WHEN (t."Score" + t."PointSpread") - t."OpponentScore" < 0 THEN 'Loss'
+        ELSE 'Push'
+    END AS "ATSResult",
+    t."OpponentScore" - (t."Score" + t."PointSpread") AS "OpponentCoverMargin",
+    CASE
+        WHEN t."PointSpread" IS NULL THEN NULL
+        WHEN t."OpponentScore" - (t."Score" + t."PointSpread") > 0 THEN 'Cover'
+        WHEN t."OpponentScore" - (t."Score" + t."PointSpread") < 0 THEN 'Loss'
+        ELSE 'Push'
+    END AS "OpponentATSResult"
+FROM teamlog t
+ORDER BY t."GameKey", (t."HomeOrAway" = 'HOME') DESC;
+"""
+
+# REFRESH ... CONCURRENTLY needs a unique index and keeps the view readable while it runs
+create_index_sql = """
+CREATE UNIQUE INDEX IF NOT EXISTS teamgames_gamekey ON teamgames ("GameKey");
+"""
+
+refresh_view_sql = """
+REFRESH MATERIALIZED VIEW CONCURRENTLY teamgames;
+"""
+
+# Materialized views aren't in information_schema.columns
+columns_sql = """
+SELECT attname FROM pg_attribute
+WHERE attrelid = 'teamgames'::regclass AND attnum > 0 AND NOT attisdropped
+ORDER BY attnum;
+"""
+
+# The columns the view adds to teamlog's
+computed_columns = re.findall(r'AS "(\w+)"', create_view_sql)
+
+
+team_games_metadata = """
+Table: teamgames
+teamgames has exactly one row per game. It is the home team's row of teamlog, so Team is the home team and Opponent is the away team, and it has every teamlog column plus:
+CoverMargin (DOUBLE PRECISION): (Score + PointSpread) - OpponentScore for the home team (Team).
+ATSResult (TEXT): Against the spread result for the home team (Team). Can be 'Cover', 'Loss' or 'Push'. NULL if there was no spread.
+OpponentCoverMargin (DOUBLE PRECISION): The cover margin for the away team (Opponent).
+OpponentATSResult (TEXT): Against the spread result for the away team (Opponent). Can be 'Cover', 'Loss' or 'Push'. NULL if there was no spread.
+"""
+
+register_metadata(team_games_metadata)
+
+
+def _run(*statements):
+    # The view lives on the primary; the executor's pooled connections are read-only.
+    # Returns the rows of the last statement, if it has any.
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        with conn, conn.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement)
+            return cur.fetchall() if cur.description else None
+    finally:
+        conn.close()
+
+
+def create_team_games():
+    _run(create_view_sql, create_index_sql)
+
+
+def refresh_team_games():
+    _run(refresh_view_sql)
+
+
+def register_team_games_columns():
+    # t.* is expanded when the view is created, so teamgames only has the teamlog columns that
+    # existed then. Its own catalog entry is the truth; without a database the view definition
+    # is the next best thing. Called at startup, after the bucket modules registered teamlog.
+    try:
+        columns = [row[0] for row in _run(columns_sql)]
+    except Exception as e:
+        print(f'Could not read the teamgames columns, deriving them from the view definition: {e}')
+        columns = list(table_columns('teamlog')) + computed_columns
+    set_table_columns('teamgames', columns)
+    return columns
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'create':
+        create_team_games()
+    refresh_team_games()
+    print('teamgames refreshed')
@@ -10,7 +10,13 @@ import time
 from langchain_anthropic import ChatAnthropic
 import re
 from utils.cache import get_closest_embedding
-from utils.CountUtil import count_tokens
+from utils.CountUtil import count_tokens, usage_counts
+from utils.schema import register_metadata
+from utils.team_games import team_games_metadata
+from utils.llm_clients import get_llm
+from utils.model_tiers import stage_model
+from utils.prompt_layout import check_prompt_call, register_prompt
+from utils.sql_stream import generate_sql
 import dotenv
 dotenv.load_dotenv()
 
@@ -25,8 +31,7 @@ prompt_template = """
 User:
 
 <instructions>
-You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is:
-`{user_question}`
+You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is at the end of this prompt.
 
 </instructions>
 
@@ -70,33 +75,20 @@ There is no weather column, so use a combination of temperature, humidity, and w
 
 To calculate record, use WinsAfter for record after the game and Wins for record before the game. The same goes for losses.
 
-The games are doubled counted in the TeamLog, so you will have to use DISTINCT to get the unique games for a team. They are double counted in that in one occurrence the home team is the Team and away the Opponent and in the other occurrence the away team is the Team and the home team is the Opponent. You can do this with SELECT DISTINCT ON ("GameKey").
+The games are doubled counted in the TeamLog. They are double counted in that in one occurrence the home team is the Team and away the Opponent and in the other occurrence the away team is the Team and the home team is the Opponent. Filtering teamlog on one "Team" already gives one row per game for that team. When you need every game once (e.g. league-wide counts, or a team's games from both sides), query the teamgames table instead of using SELECT DISTINCT ON ("GameKey"). teamgames has one row per game where Team is the home team and Opponent is the away team, so use CASE WHEN "Team" = 'X' THEN ... ELSE ... END to get one team's side.
+
+For against the spread questions use teamgames' CoverMargin and ATSResult (home team) or OpponentCoverMargin and OpponentATSResult (away team) instead of computing them from Score, OpponentScore and PointSpread.
 
 The team in the Team column isn't always the home team, it could be the away team, so use HomeOrAway to determine if the team is the home team or the away team. This is very important for determining who is what team in the game.
 
 
 </special_instructions>
 
-<question>
-
-
-Given the database schema, here is the SQL query that answers `{user_question}`:
-
-</question>
 
 
 If the question cannot be answered with the data provided, return the string "cannot be answered".
 
 This is a postgres database. Do not create any new columns or tables. Only use the columns that are in the table.
-Here is an example response for the question: {matched_question}
-<example_response>
-
-
-```sql
-{matched_sql_query}
-```
-
-</example_response>
 
 Your response will be executed on a database of NFL Team Logs and the answer will be returned to the User, so make sure the query is correct and will return the correct information.
 The default SeasonType is Regular Season or 1. If the question is about a different SeasonType, please specify in the query. The default season is 2024.
@@ -107,12 +99,34 @@ If the question cannot be answered with the data provided, please return the str
 Not all Sunday games are played at night.
 Do not use functions that are not available in SQLite. Do not use functions that are not available in SQLite. Do not create new columns, only use what is provided.
 This is a postgres database. Do not create any new columns or tables. Only reference columns that are in the database schema provided.
-This is today's date: {current_date}. If the question mentions today, or tonight or anything of the sort, include this date in the response.
 Make sure you use parentheses correctly in your queries as well as commas to make logical sense. 
 
 """
 
+request_template = """
+This is today's date: {current_date}. If the question mentions today, or tonight or anything of the sort, include this date in the response.
+
+Here is an example response for the question: {matched_question}
+<example_response>
+
+
+```sql
+{matched_sql_query}
+```
+
+</example_response>
+
+<question>
+Given the database schema, here is the SQL query that answers `{user_question}`:
+</question>
+
+"""
+
+
 prompt_template += add_line
+# Everything above is the same on every call; the per-request parts go last so the
+# provider can serve the long static prefix from its prompt cache
+prompt_template += request_template
 prompt_template += "\nAssistant:"
 
 
@@ -390,35 +404,39 @@ Type (TEXT): Home team type of stadium (Outdoor or Indoor).
 IsShortWeek (BIGINT): 1 if the team is playing on a short week, 0 if not.
 """
 
+register_metadata(testnfl_metadata, 'teamlog')
 
-def team_log_get_answer(model, question):
+
+register_prompt('TeamGameLog', sql_prompt, {"table_metadata_string": testnfl_metadata + team_games_metadata})
+
+# The prompt and schema never change, so they are only tokenized once
+static_input_tokens = count_tokens(prompt_template) + count_tokens(testnfl_metadata) + count_tokens(team_games_metadata)
+
+
+def team_log_get_answer(model, question, embedding=None, temperature=None, tier=0, owner=None, match=None):
     llm = None
-    input_count = count_tokens(question)
-    input_count += count_tokens(prompt_template)
-    input_count += count_tokens(testnfl_metadata)
+    input_count = static_input_tokens + count_tokens(question)
     
 
 
-    matched_question, matched_sql_query = get_closest_embedding(question, top_k=1)
+    matched_question, matched_sql_query = match or get_closest_embedding(question, top_k=1, embedding=embedding)
 
     input_count += count_tokens(matched_question)
     input_count += count_tokens(matched_sql_query)
 
 
     if model == 'openai':
-        llm = ChatOpenAI(model='gpt-4o', temperature=0.9)
+        llm = get_llm('openai', stage_model('sql', tier), 0.9 if temperature is None else temperature)
 
     elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-5-sonnet-20240620', temperature=0.5)
-        
-
-    llm_chain = sql_prompt | llm
-    answer = llm_chain.invoke(
-        {'user_question': question, "table_metadata_string": testnfl_metadata, "matched_question": matched_question, "matched_sql_query": matched_sql_query, "current_date": str(time.strftime("%Y-%m-%d"))})
+        llm = get_llm('anthropic', 'claude-3-5-sonnet-20240620', 0.5 if temperature is None else temperature)
+    values = {'user_question': question, "table_metadata_string": testnfl_metadata + team_games_metadata, "matched_question": matched_question, "matched_sql_query": matched_sql_query, "current_date": str(time.strftime("%Y-%m-%d"))}
+    answer = generate_sql(sql_prompt, llm, values, owner=owner)
+    check_prompt_call('TeamGameLog', values, answer)
     
     return_answer = answer.content
 
-    output_count = count_tokens(return_answer)
+    input_count, output_count = usage_counts(answer, input_count)
     
     
 
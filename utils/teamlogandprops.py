@@ -10,7 +10,15 @@ from langchain_anthropic import ChatAnthropic
 import re
 import datetime
 from utils.cache import get_closest_embedding
-from utils.CountUtil import count_tokens
+from utils.CountUtil import count_tokens, usage_counts
+from utils.schema import register_metadata
+from utils.team_games import team_games_metadata
+from utils.llm_clients import get_llm
+from utils.model_tiers import stage_model
+from utils.prompt_layout import check_prompt_call, register_prompt
+from utils.sql_stream import generate_sql
+from utils.schema_pruning import (PROPS_KEY_COLUMNS, SCHEMA_PRUNING_ENABLED, TEAM_KEY_COLUMNS,
+                                  prune_schema, schema_last)
 import dotenv
 dotenv.load_dotenv()
 
@@ -21,8 +29,7 @@ prompt_template = """
 User:
 
 <instructions>
-You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is:
-`{user_question}`
+You are a data analyst for an NFL team and you have been asked to generate a SQL query to answer the following question. You do not have to completely answer the question, just generate the SQL query to answer the question, and the result will be processed. Do your best to answer the question and do not use placeholder information. The question is at the end of this prompt.
 
 </instructions>
 
@@ -69,7 +76,9 @@ All columns must be surrounded by double quotes, such as "Name" or "Team".
 There is no weather column, so use a combination of temperature, humidity, and wind speed to determine the weather conditions of the game.
 To calculate record, use WinsAfter for record after the game and Wins for record before the game. The same goes for losses.
 
-The games are doubled counted in the TeamLog, so you will have to use DISTINCT to get the unique games for a team. They are double counted in that in one occurrence the home team is the Team and away the Opponent and in the other occurrence the away team is the Team and the home team is the Opponent. You can do this with SELECT DISTINCT ON ("GameKey")
+The games are doubled counted in the TeamLog. They are double counted in that in one occurrence the home team is the Team and away the Opponent and in the other occurrence the away team is the Team and the home team is the Opponent. Filtering teamlog on one "Team" already gives one row per game for that team. When you need every game once (e.g. league-wide counts, or a team's games from both sides), query the teamgames table instead of using SELECT DISTINCT ON ("GameKey"). teamgames has one row per game where Team is the home team and Opponent is the away team, so use CASE WHEN "Team" = 'X' THEN ... ELSE ... END to get one team's side.
+
+For against the spread questions use teamgames' CoverMargin and ATSResult (home team) or OpponentCoverMargin and OpponentATSResult (away team) instead of computing them from Score, OpponentScore and PointSpread.
 
 The team in the Team column isn't always the home team, it could be the away team, so use HomeOrAway to determine if the team is the home team or the away team. This is very important for determining who is what team in the game.
 
@@ -87,13 +96,23 @@ Don't query on BettingBetType unless the user specifically asks for one of these
 
 </special_instructions_props>
 
-<question>
 
 
-Given the database schema, here is the SQL query that answers `{user_question}`:
 
-</question>
 
+Your response will be executed on a database of NFL Team Logs and the answer will be returned to the User, so make sure the query is correct and will return the correct information.
+
+If the question cannot be answered with the data provided, please return the string "Error: Cannot answer question with data provided."
+
+Do not use functions that are not available in SQLite. Do not use functions that are not available in SQLite. Do not create new columns, only use what is provided.
+Make sure you surround columns with double quotes since it is case sensitive. An example is p."PlayerName". 
+For game days, you can use the Day column, if you don't have the time of the game. Make sure your date format is consistent with the data.
+This is a postgres database. Do not create any new columns or tables. Only reference columns that are in the database schema provided.
+Make sure you use parentheses correctly in your queries as well as commas to make logical sense. 
+"""
+
+request_template = """
+This is the current date: {current_date}
 
 Here is an example response for the question: {matched_question}
 
@@ -104,20 +123,17 @@ Here is an example response for the question: {matched_question}
 ```
 </example_response>
 
+<question>
+Given the database schema, here is the SQL query that answers `{user_question}`:
+</question>
 
-Your response will be executed on a database of NFL Team Logs and the answer will be returned to the User, so make sure the query is correct and will return the correct information.
-
-If the question cannot be answered with the data provided, please return the string "Error: Cannot answer question with data provided."
-
-Do not use functions that are not available in SQLite. Do not use functions that are not available in SQLite. Do not create new columns, only use what is provided.
-Make sure you surround columns with double quotes since it is case sensitive. An example is p."PlayerName". 
-This is the current date: {current_date}
-For game days, you can use the Day column, if you don't have the time of the game. Make sure your date format is consistent with the data.
-This is a postgres database. Do not create any new columns or tables. Only reference columns that are in the database schema provided.
-Make sure you use parentheses correctly in your queries as well as commas to make logical sense. 
 """
 
+
 prompt_template += add_line
+# Everything above is the same on every call; the per-request parts go last so the
+# provider can serve the long static prefix from its prompt cache
+prompt_template += request_template
 prompt_template += "Assistant:"
 
 
@@ -393,6 +409,8 @@ Type (TEXT): Home team type of stadium (Outdoor or Indoor).
 IsShortWeek (BIGINT): 1 if the team is playing on a short week, 0 if not.
 """
 
+register_metadata(testnfl_metadata, 'teamlog')
+
 
 props_metadata = """
 PointSpreadAwayTeamMoneyLine (bigint)
@@ -488,17 +506,28 @@ MoneyPercentage (double precision) - Percentage of money on this outcome, a lot
 
 """
 
+register_metadata(props_metadata, 'props')
+
+
+# Used instead of sql_prompt when the schema is pruned for the question
+pruned_sql_prompt = PromptTemplate.from_template(schema_last(prompt_template, request_template))
+
+register_prompt('TeamLogAndProps', sql_prompt, {"team_log_table_metadata_string": testnfl_metadata + team_games_metadata, "props_table_metadata_string": props_metadata})
+register_prompt('TeamLogAndProps (pruned)', pruned_sql_prompt, {}, enabled=SCHEMA_PRUNING_ENABLED)
+
+# The prompt and full schema never change, so they are only tokenized once; a pruned
+# schema is counted for the call that renders it
+static_input_tokens = count_tokens(prompt_template)
+schema_tokens = count_tokens(testnfl_metadata) + count_tokens(team_games_metadata) + count_tokens(props_metadata)
+
 
-def team_log_and_props_get_answer(model, question):
+def team_log_and_props_get_answer(model, question, embedding=None, temperature=None, tier=0, owner=None, match=None):
     llm = None
 
-    input_count = count_tokens(question)
-    input_count += count_tokens(prompt_template)
-    input_count += count_tokens(testnfl_metadata)
-    input_count += count_tokens(props_metadata)
+    input_count = static_input_tokens + count_tokens(question)
 
 
-    matched_question, matched_sql_query = get_closest_embedding(question, model="text-embedding-3-large", top_k=1)
+    matched_question, matched_sql_query = match or get_closest_embedding(question, model="text-embedding-3-large", top_k=1, embedding=embedding)
 
     input_count += count_tokens(matched_question)
     input_count += count_tokens(matched_sql_query)
@@ -507,21 +536,25 @@ def team_log_and_props_get_answer(model, question):
 
     if model == 'openai':
         try:
-            llm = ChatOpenAI(model='gpt-4o', temperature=0.96)
+            llm = get_llm('openai', stage_model('sql', tier), 0.96 if temperature is None else temperature)
         except Exception as e:
             print("key not given", e)
 
     elif model == 'anthropic':
-        llm = ChatAnthropic(model_name='claude-3-5-sonnet-20240620', temperature=0.5)
+        llm = get_llm('anthropic', 'claude-3-5-sonnet-20240620', 0.5 if temperature is None else temperature)
 
     print(llm)
-    llm_chain = sql_prompt | llm
-    answer = llm_chain.invoke(
-        {'user_question': question, "player_log_table_metadata_string": testnfl_metadata, "props_table_metadata_string": props_metadata, "current_date": str(datetime.datetime.today()).split()[0]}, matched_question=matched_question, matched_sql_query=matched_sql_query)
+    (team_log_table_metadata, props_table_metadata), pruned = prune_schema(
+        'TeamLogAndProps', question, embedding, [(testnfl_metadata + team_games_metadata, TEAM_KEY_COLUMNS), (props_metadata, PROPS_KEY_COLUMNS)], owner=owner)
+    prompt = pruned_sql_prompt if pruned else sql_prompt
+    input_count += count_tokens(team_log_table_metadata) + count_tokens(props_table_metadata) if pruned else schema_tokens
+    values = {'user_question': question, "team_log_table_metadata_string": team_log_table_metadata, "props_table_metadata_string": props_table_metadata, "matched_question": matched_question, "matched_sql_query": matched_sql_query, "current_date": str(datetime.datetime.today()).split()[0]}
+    answer = generate_sql(prompt, llm, values, owner=owner)
+    check_prompt_call('TeamLogAndProps (pruned)' if pruned else 'TeamLogAndProps', values, answer)
     
     return_answer = answer.content
 
-    output_count = count_tokens(return_answer)
+    input_count, output_count = usage_counts(answer, input_count)
 
 
     return return_answer, input_count, output_count
@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+
+import dotenv
+import numpy as np
+
+dotenv.load_dotenv()
+
+
+# Local mirror of the Pinecone example index. The corpus is a few thousand curated
+# question/SQL pairs, so a normalized matrix and one matrix-vector product is plenty.
+
+VECTOR_INDEX_ENABLED = os.getenv('VECTOR_INDEX_ENABLED', 'true').lower() == 'true'
+VECTOR_INDEX_SNAPSHOT = os.getenv('VECTOR_INDEX_SNAPSHOT', 'vector_index.npz')
+
+# Seconds between syncs from Pinecone; 0 only syncs once at startup
+VECTOR_INDEX_SYNC_INTERVAL = float(os.getenv('VECTOR_INDEX_SYNC_INTERVAL', 3600))
+
+FETCH_BATCH = 100
+
+
+_lock = threading.Lock()
+
+# (ids, normalized matrix, metadata), swapped as a whole so readers never see a half update
+_index = ([], np.zeros((0, 0), dtype=np.float32), [])
+
+_stats = {
+    'queries': 0,
+    'query_ms': 0.0,
+    'syncs': 0,
+    'sync_failures': 0,
+    'last_sync': None,
+    'source': None,
+}
+
+_sync_thread = None
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def set_index(ids, vectors, metadata, source):
+    global _index
+    matrix = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+    with _lock:
+        _index = (list(ids), matrix, list(metadata))
+        _stats['source'] = source
+    print(f'Vector index loaded {len(ids)} vectors from {source}')
+
+
+def index_size():
+    return len(_index[0])
+
+
+def query(vector, top_k=1):
+    # Same shape as Pinecone's matches: [{'id', 'score', 'metadata'}], best first
+    ids, matrix, metadata = _index
+    if not ids:
+        return []
+
+    start = time.perf_counter()
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    scores = matrix @ (vector / norm if norm else vector)
+
+    top_k = min(top_k, len(ids))
+    best = np.argpartition(-scores, top_k - 1)[:top_k]
+    best = best[np.argsort(-scores[best])]
+
+    with _lock:
+        _stats['queries'] += 1
+        _stats['query_ms'] += (time.perf_counter() - start) * 1000
+
+    return [{'id': ids[i], 'score': float(scores[i]), 'metadata': metadata[i]} for i in best]
+
+
+def load_snapshot(path=None):
+    path = path or VECTOR_INDEX_SNAPSHOT
+    if not path or not os.path.exists(path):
+        return False
+
+    try:
+        with np.load(path, allow_pickle=False) as snapshot:
+            ids = [str(i) for i in snapshot['ids']]
+            vectors = snapshot['vectors']
+            metadata = json.loads(str(snapshot['metadata']))
+    except (OSError, KeyError, ValueError) as e:
+        print(f'Could not load vector index snapshot {path}: {e}')
+        return False
+
+    set_index(ids, vectors, metadata, f'snapshot {path}')
+    return True
+
+
+def save_snapshot(path=None):
+    path = path or VECTOR_INDEX_SNAPSHOT
+    if not path:
+        return
+
+    ids, matrix, metadata = _index
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, ids=np.array(ids), vectors=matrix, metadata=np.array(json.dumps(metadata)))
+    os.replace(tmp, path)
+
+
+def sync_from_pinecone(index):
+    ids = [vector_id for page in index.list() for vector_id in page]
+
+    vectors = []
+    metadata = []
+    fetched_ids = []
+    for start in range(0, len(ids), FETCH_BATCH):
+        response = index.fetch(ids=ids[start:start + FETCH_BATCH])
+        for vector_id, vector in response.vectors.items():
+            fetched_ids.append(vector_id)
+            vectors.append(vector.values)
+            metadata.append(dict(vector.metadata or {}))
+
+    if not fetched_ids:
+        # An empty listing is more likely a Pinecone hiccup than an empty corpus
+        raise ValueError('Pinecone returned no vectors')
+
+    set_index(fetched_ids, vectors, metadata, 'pinecone')
+    save_snapshot()
+
+    with _lock:
+        _stats['syncs'] += 1
+        _stats['last_sync'] = time.time()
+
+
+def _sync_loop(index):
+    while True:
+        try:
+            sync_from_pinecone(index)
+        except Exception as e:
+            with _lock:
+                _stats['sync_failures'] += 1
+            print(f'Vector index sync failed: {e}')
+
+        if VECTOR_INDEX_SYNC_INTERVAL <= 0:
+            return
+        time.sleep(VECTOR_INDEX_SYNC_INTERVAL)
+
+
+def start_vector_index(index):
+    global _sync_thread
+    if not VECTOR_INDEX_ENABLED or _sync_thread is not None:
+        return
+
+    load_snapshot()
+    _sync_thread = threading.Thread(target=_sync_loop, args=(index,), daemon=True)
+    _sync_thread.start()
+
+
+def vector_index_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats['enabled'] = VECTOR_INDEX_ENABLED
+    stats['vectors'] = index_size()
+    stats['query_avg_ms'] = stats['query_ms'] / stats['queries'] if stats['queries'] else 0.0
+    return stats